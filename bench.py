@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Offline microbenchmarks for the Dumper, utils and formatters, run over
+synthetic Telethon objects so that no connection to Telegram is needed.
+
+Results are saved as JSON, and can be compared against those of a
+previous run (the baseline) to spot regressions before a release:
+
+    ./bench.py --output baseline.json
+    ./bench.py --baseline baseline.json
+"""
+import argparse
+import configparser
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from telethon.tl import types
+
+import utils
+from dumper import Dumper
+from formatters import NAME_TO_FORMATTER
+
+# The context every synthetic message belongs to, and who exported it
+CONTEXT_ID = 123
+SELF_ID = 1
+
+# Benchmarks slower than the baseline by more than this are regressions
+DEFAULT_THRESHOLD = 0.25
+
+# name: factory(env) -> (operations, function to time)
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark factory under the given name. The factory is
+    called before every repetition to set up fresh state, and returns
+    how many operations the returned function performs when timed.
+    """
+    def decorator(factory):
+        BENCHMARKS[name] = factory
+        return factory
+    return decorator
+
+
+def make_media(rng, i):
+    """Makes a random photo, document, location or web page"""
+    kind = rng.randrange(4)
+    location = types.FileLocation(
+        dc_id=2, volume_id=rng.getrandbits(48),
+        local_id=i, secret=rng.getrandbits(63)
+    )
+    date = datetime(2017, 1, 1)
+    if kind == 0:
+        return types.MessageMediaPhoto(types.Photo(
+            id=i, access_hash=rng.getrandbits(63), date=date, sizes=[
+                types.PhotoSize('s', location, 90, 90, 1024),
+                types.PhotoSize('x', types.FileLocation(
+                    2, location.volume_id, -i, location.secret
+                ), 800, 800, 80 * 1024)
+            ]
+        ))
+    if kind == 1:
+        return types.MessageMediaDocument(types.Document(
+            id=i, access_hash=rng.getrandbits(63), date=date,
+            mime_type='application/pdf', size=rng.randrange(1, 2**24),
+            thumb=types.PhotoSize('s', location, 90, 90, 1024),
+            dc_id=2, version=0, attributes=[
+                types.DocumentAttributeFilename('file{}.pdf'.format(i))
+            ]
+        ))
+    if kind == 2:
+        return types.MessageMediaGeo(
+            types.GeoPoint(long=rng.uniform(-180, 180),
+                           lat=rng.uniform(-90, 90))
+        )
+    return types.MessageMediaWebPage(types.WebPage(
+        id=i, url='https://example.com/{}'.format(i),
+        display_url='example.com/{}'.format(i), hash=rng.getrandbits(31),
+        title='Page {}'.format(i), description='A page ' * 20
+    ))
+
+
+def make_entities(rng, length):
+    """Makes a random list of formatting entities for a text of length"""
+    entities = []
+    for _ in range(rng.randrange(4)):
+        offset = rng.randrange(length)
+        size = rng.randrange(1, length - offset + 1)
+        kind = rng.choice((types.MessageEntityBold, types.MessageEntityItalic,
+                           types.MessageEntityCode, types.MessageEntityTextUrl,
+                           types.MessageEntityMentionName))
+        if kind is types.MessageEntityTextUrl:
+            entities.append(kind(offset, size, 'https://example.com/a,b;c'))
+        elif kind is types.MessageEntityMentionName:
+            entities.append(kind(offset, size, rng.getrandbits(31)))
+        else:
+            entities.append(kind(offset, size))
+    return entities or None
+
+
+def make_messages(rng, count):
+    """
+    Makes count messages for CONTEXT_ID, one per minute, with a mix
+    of formatting, media, replies and forwards.
+    """
+    words = ('hello', 'world', 'telegram', 'export', 'message', 'some', 'text')
+    date = datetime(2017, 1, 1)
+    messages = []
+    for i in range(1, count + 1):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randrange(1, 30)))
+        messages.append(types.Message(
+            id=i,
+            to_id=types.PeerUser(CONTEXT_ID),
+            date=date + timedelta(minutes=i),
+            message=text,
+            from_id=rng.choice((SELF_ID, CONTEXT_ID)),
+            reply_to_msg_id=rng.randrange(1, i + 1) if rng.random() < 0.1
+            else None,
+            fwd_from=types.MessageFwdHeader(date=date, from_id=42)
+            if rng.random() < 0.05 else None,
+            media=make_media(rng, i) if rng.random() < 0.2 else None,
+            entities=make_entities(rng, len(text))
+        ))
+    return messages
+
+
+def make_service_messages(rng, count):
+    """Makes count service messages for CONTEXT_ID"""
+    date = datetime(2017, 1, 1)
+    return [types.MessageService(
+        id=i,
+        to_id=types.PeerChat(CONTEXT_ID),
+        date=date + timedelta(minutes=i),
+        from_id=SELF_ID,
+        action=types.MessageActionChatAddUser(
+            [rng.getrandbits(31) for _ in range(rng.randrange(1, 5))])
+        if i % 2 else types.MessageActionChatEditTitle('Title {}'.format(i))
+    ) for i in range(1, count + 1)]
+
+
+class Environment:
+    """
+    The synthetic data shared by all the benchmarks, and a scratch
+    directory where their databases are created.
+    """
+    def __init__(self, scale, seed=0):
+        rng = random.Random(seed)
+        self.scale = scale
+        self.work_dir = tempfile.mkdtemp(prefix='telegram-export-bench-')
+        self.messages = make_messages(rng, scale)
+        self.service_messages = make_service_messages(rng, scale)
+        self.media = [make_media(rng, i) for i in range(1, scale + 1)]
+        self.participants = [rng.getrandbits(31) for _ in range(scale)]
+        self._databases = 0
+        self._formatter_db = None
+
+    def new_dumper(self, **options):
+        """
+        Returns a Dumper over a new, empty database, with any other
+        options of the Dumper section of the configuration given.
+        """
+        self._databases += 1
+        config = configparser.ConfigParser()
+        config['Dumper'] = {'DBFileName': 'bench{}'.format(self._databases),
+                            'OutputDirectory': self.work_dir,
+                            'InvalidationTime': '0', **options}
+        dumper = Dumper(config['Dumper'])
+        dumper.check_self_user(SELF_ID)
+        return dumper
+
+    def formatter_db(self):
+        """
+        Returns the filename of a database with all the messages (and
+        their media and forwards) dumped, filled on first use.
+        """
+        if self._formatter_db is None:
+            dumper = self.new_dumper()
+            dumper._insert('User', (CONTEXT_ID, 0, 'Bench', 'User', 'bench',
+                                    None, None, 0, 0, None))
+            for message in self.messages:
+                dumper.dump_message(
+                    message, CONTEXT_ID,
+                    forward_id=dumper.dump_forward(message.fwd_from),
+                    media_id=dumper.dump_media(message.media)
+                )
+            dumper.commit()
+            dumper.conn.close()
+            self._formatter_db = os.path.join(
+                self.work_dir, 'bench{}.db'.format(self._databases))
+        return self._formatter_db
+
+    def close(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+@benchmark('dumper.dump_message')
+def _bench_dump_message(env):
+    dumper = env.new_dumper()
+
+    def run():
+        for message in env.messages:
+            dumper.dump_message(message, CONTEXT_ID,
+                                forward_id=None, media_id=None)
+        dumper.commit()
+    return len(env.messages), run
+
+
+@benchmark('dumper.dump_message_service')
+def _bench_dump_message_service(env):
+    dumper = env.new_dumper()
+
+    def run():
+        for message in env.service_messages:
+            dumper.dump_message_service(message, CONTEXT_ID, media_id=None)
+        dumper.commit()
+    return len(env.service_messages), run
+
+
+@benchmark('dumper.dump_media')
+def _bench_dump_media(env):
+    dumper = env.new_dumper()
+
+    def run():
+        # Every media is dumped twice to also measure finding duplicates
+        for media in env.media:
+            dumper.dump_media(media)
+        for media in env.media:
+            dumper.dump_media(media)
+        dumper.commit()
+    return len(env.media) * 2, run
+
+
+@benchmark('dumper.dump_media_raw')
+def _bench_dump_media_raw(env):
+    dumper = env.new_dumper(StoreRawTL='true')
+
+    def run():
+        for media in env.media:
+            dumper.dump_media(media)
+        for media in env.media:
+            dumper.dump_media(media)
+        dumper.commit()
+    return len(env.media) * 2, run
+
+
+@benchmark('dumper.dump_participants_delta')
+def _bench_dump_participants_delta(env):
+    dumper = env.new_dumper()
+    rounds = 20
+    # Every round some participants leave and as many new ones join
+    step = max(len(env.participants) // 100, 1)
+    rounds_ids = [env.participants[i * step:] + list(range(-i * step, 0))
+                  for i in range(rounds)]
+
+    def run():
+        for i, ids in enumerate(rounds_ids):
+            dumper.dump_participants_delta(CONTEXT_ID, ids)
+            # Deltas are keyed by date, so pretend a second passed
+            dumper.conn.execute('UPDATE ChatParticipants SET DateUpdated = ? '
+                                'WHERE DateUpdated > ?', (i, rounds))
+        dumper.commit()
+    return rounds, run
+
+
+@benchmark('dumper._insert_if_valid_date')
+def _bench_insert_if_valid_date(env):
+    dumper = env.new_dumper()
+    users = max(env.scale // 10, 1)
+    # A tenth of the rows change, so the rest are skipped as duplicates
+    rows = [(i % users, i, 'First{}'.format(i // users if i % 10 == 0 else 0),
+             None, None, None, None, 0, 0, None) for i in range(env.scale)]
+
+    def run():
+        for row in rows:
+            dumper._insert_if_valid_date('User', row, date_column=1,
+                                         where=('ID', row[0]))
+        dumper.commit()
+    return len(rows), run
+
+
+@benchmark('utils.encode_msg_entities')
+def _bench_encode_msg_entities(env):
+    entities = [m.entities for m in env.messages]
+
+    def run():
+        for e in entities:
+            utils.encode_msg_entities(e)
+    return len(entities), run
+
+
+@benchmark('utils.decode_msg_entities')
+def _bench_decode_msg_entities(env):
+    encoded = [utils.encode_msg_entities(m.entities) for m in env.messages]
+
+    def run():
+        for data in encoded:
+            utils.decode_msg_entities(data)
+    return len(encoded), run
+
+
+@benchmark('utils.sanitize_dict')
+def _bench_sanitize_dict(env):
+    # sanitize_dict works in place, so new dicts are needed every time
+    dicts = [media.to_dict() for media in env.media]
+
+    def run():
+        for d in dicts:
+            utils.sanitize_dict(d)
+    return len(dicts), run
+
+
+def _formatter_benchmark(cls):
+    def factory(env):
+        formatter = cls(env.formatter_db())
+
+        def run():
+            formatter._format(CONTEXT_ID, io.StringIO())
+        return len(env.messages), run
+    return factory
+
+
+for _name, _cls in sorted(NAME_TO_FORMATTER.items()):
+    benchmark('formatter.{}'.format(_name))(_formatter_benchmark(_cls))
+
+
+def run_benchmarks(scale, repeat=3, names=None, seed=0, file=sys.stderr):
+    """
+    Runs the benchmarks whose names start with any of the given names
+    (or all of them), repeat times each over scale synthetic messages,
+    and returns a JSON-serializable dictionary with the best times.
+    """
+    env = Environment(scale, seed=seed)
+    results = {}
+    try:
+        for name, factory in BENCHMARKS.items():
+            if names and not name.startswith(tuple(names)):
+                continue
+
+            best = float('inf')
+            for _ in range(max(repeat, 1)):
+                operations, function = factory(env)
+                start = perf_counter()
+                function()
+                best = min(best, perf_counter() - start)
+
+            results[name] = {
+                'operations': operations,
+                'seconds': best,
+                'ops_per_second': operations / best if best else None
+            }
+            if file:
+                print('{:<40} {:>12.0f} ops/s'.format(
+                    name, results[name]['ops_per_second'] or 0), file=file)
+    finally:
+        env.close()
+
+    return {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares the results of two runs, returning a list of
+    (name, baseline ops/s, current ops/s, change, is regression)
+    for the benchmarks present in both. Only the time per operation is
+    compared, so runs at different scales can still be compared.
+    """
+    comparison = []
+    for name, result in current['results'].items():
+        old = baseline['results'].get(name)
+        if not old or not old['ops_per_second'] \
+                or not result['ops_per_second']:
+            continue
+        change = result['ops_per_second'] / old['ops_per_second'] - 1
+        comparison.append((name, old['ops_per_second'],
+                           result['ops_per_second'], change,
+                           change < -threshold))
+    return comparison
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Dumper, utils and formatters offline')
+    parser.add_argument('names', nargs='*',
+                        help='only run the benchmarks starting with these '
+                             'names (e.g. dumper. or formatter.html)')
+    parser.add_argument('--scale', '-n', type=int, default=10000,
+                        help='amount of synthetic messages (and media) to '
+                             'use in every benchmark')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='times every benchmark is repeated, keeping '
+                             'the best time')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to generate the synthetic data')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='save the results as JSON to FILE, which can '
+                             'be used as the baseline of later runs')
+    parser.add_argument('--baseline', '-b', metavar='FILE',
+                        help='compare the results against those saved in '
+                             'FILE, exiting with status 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='fraction of throughput a benchmark may lose '
+                             'against the baseline before it is considered '
+                             'a regression (default {})'
+                        .format(DEFAULT_THRESHOLD))
+    parser.add_argument('--list', action='store_true',
+                        help='list the available benchmarks and exit')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.list:
+        print('\n'.join(BENCHMARKS))
+        return 0
+
+    results = run_benchmarks(args.scale, repeat=args.repeat,
+                             names=args.names, seed=args.seed)
+    if not results['results']:
+        print('No benchmark matches the given names', file=sys.stderr)
+        return 2
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = 0
+    print('{:<40} {:>12} {:>12} {:>8}'.format(
+        'benchmark', 'baseline', 'current', 'change'))
+    for name, old, new, change, regression in compare(
+            results, baseline, threshold=args.threshold):
+        regressions += regression
+        print('{:<40} {:>12.0f} {:>12.0f} {:>+7.1%}{}'.format(
+            name, old, new, change, '  REGRESSION' if regression else ''))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Compression for the large and repetitive columns of the database (the
+JSON or raw TL objects of media, admin log events and service messages)
+with zstd and dictionaries trained on the database itself, or with zlib
+if zstandard is not installed.
+
+Compressed values are stored as blobs starting with MAGIC, so they can
+be told apart from the values stored before compression was enabled.
+"""
+import logging
+import struct
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__log__ = logging.getLogger(__name__)
+
+# Prefix of compressed values, followed by the (codec, kind, dictionary
+# ID) header. A raw TL object never starts like this, since it would
+# need a constructor ID of 0x5a584754.
+MAGIC = b'TGXZ'
+HEADER = struct.Struct('<BBI')
+
+CODEC_ZSTD = 1
+CODEC_ZLIB = 2
+CODECS = {'zstd': CODEC_ZSTD, 'zlib': CODEC_ZLIB}
+
+# What the value was before compression, to give back the same type
+KIND_TEXT = 0
+KIND_BYTES = 1
+
+# Values smaller than this aren't worth compressing
+MIN_SIZE = 64
+
+# Values compressed before a dictionary is trained with them, and the
+# size of the trained dictionaries. Training takes a fraction of a
+# second, and about 100 times the dictionary size of samples is best.
+TRAIN_SAMPLES = 2000
+DICT_SIZE = 16 * 1024
+
+
+class ColumnCompressor:
+    """
+    Compresses and decompresses the values of the columns using the
+    dictionaries in the CompressionDict table of the given connection.
+
+    If codec is None values are only decompressed. With 'zstd', the
+    first train_samples values are kept to train a dictionary, which
+    is saved to the database and used to compress any value after.
+    """
+    def __init__(self, conn, codec=None, level=3,
+                 train_samples=TRAIN_SAMPLES, dict_size=DICT_SIZE):
+        if codec == 'zstd' and not zstandard:
+            __log__.warning('zstandard is not installed, compressing '
+                            'the database with zlib instead')
+            codec = 'zlib'
+        if codec is not None and codec not in CODECS:
+            raise ValueError('Unknown codec {}, must be one of {}'
+                             .format(codec, ', '.join(CODECS)))
+        self.conn = conn
+        self.codec = codec
+        self.level = level
+        self.train_samples = train_samples
+        self.dict_size = dict_size
+        self._samples = []
+        self._decompressors = {}  # {dictionary ID: ZstdDecompressor}
+        self._compressor = None
+        self.dict_id = 0
+        if codec == 'zstd':
+            row = self.conn.execute(
+                "SELECT ID, Data FROM CompressionDict "
+                "ORDER BY ID DESC LIMIT 1").fetchone()
+            if row:
+                self._use_dictionary(*row)
+            else:
+                self._compressor = zstandard.ZstdCompressor(level=level)
+
+    def _use_dictionary(self, dict_id, data):
+        """Compresses any value after with the given dictionary"""
+        self.dict_id = dict_id
+        self._compressor = zstandard.ZstdCompressor(
+            level=self.level,
+            dict_data=zstandard.ZstdCompressionDict(data)
+        )
+        self._samples = None
+
+    def train(self, samples):
+        """
+        Trains a new zstd dictionary with the given samples (bytes),
+        saves it to the database and uses it from now on. Returns its
+        ID, or None if there weren't enough samples to train it.
+        """
+        try:
+            data = zstandard.train_dictionary(
+                self.dict_size, samples).as_bytes()
+        except zstandard.ZstdError:
+            __log__.info('Not enough samples to train a dictionary')
+            return None
+
+        dict_id = self.conn.execute(
+            "INSERT INTO CompressionDict (DateCreated, Data) VALUES (?, ?)",
+            (round(time.time()), data)
+        ).lastrowid
+        self._use_dictionary(dict_id, data)
+        return dict_id
+
+    def compress(self, value):
+        """
+        Returns the compressed value, or the value as-is if it's too
+        small (or compressing it doesn't make it any smaller).
+        """
+        if self.codec is None or value is None:
+            return value
+        if isinstance(value, str):
+            kind, data = KIND_TEXT, value.encode('utf-8')
+        else:
+            kind, data = KIND_BYTES, value
+        if len(data) < MIN_SIZE:
+            return value
+
+        if self.codec == 'zstd':
+            compressed = self._compressor.compress(data)
+            header = HEADER.pack(CODEC_ZSTD, kind, self.dict_id)
+            if self._samples is not None:
+                self._samples.append(data)
+                if len(self._samples) >= self.train_samples:
+                    self.train(self._samples)
+                    self._samples = None
+        else:
+            compressed = zlib.compress(data, self.level)
+            header = HEADER.pack(CODEC_ZLIB, kind, 0)
+
+        result = MAGIC + header + compressed
+        return result if len(result) < len(data) else value
+
+    def decompress(self, value):
+        """Returns the original value of a (maybe) compressed one"""
+        if not isinstance(value, bytes) or not value.startswith(MAGIC):
+            return value
+
+        codec, kind, dict_id = HEADER.unpack_from(value, len(MAGIC))
+        data = value[len(MAGIC) + HEADER.size:]
+        if codec == CODEC_ZLIB:
+            data = zlib.decompress(data)
+        elif codec == CODEC_ZSTD:
+            data = self._get_decompressor(dict_id).decompress(data)
+        else:
+            raise ValueError('Unknown compression codec {}'.format(codec))
+        return data.decode('utf-8') if kind == KIND_TEXT else data
+
+    def _get_decompressor(self, dict_id):
+        """Returns the decompressor for the given dictionary ID"""
+        decompressor = self._decompressors.get(dict_id)
+        if decompressor is None:
+            if not zstandard:
+                raise ValueError('The database is compressed with zstd, '
+                                 'which requires zstandard installed')
+            if dict_id:
+                data = self.conn.execute(
+                    "SELECT Data FROM CompressionDict WHERE ID = ?",
+                    (dict_id,)).fetchone()[0]
+                decompressor = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(data))
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            self._decompressors[dict_id] = decompressor
+        return decompressor
@@ -4,15 +4,23 @@ import itertools
 import logging
 import mimetypes
 import os
+import queue
+import struct
 import time
 from collections import deque, defaultdict
 
-from telethon import utils
-from telethon.errors import ChatAdminRequiredError
+from telethon import events, utils
+from telethon.errors import (
+    ChatAdminRequiredError, FileMigrateError, FloodWaitError
+)
 from telethon.extensions import BinaryReader
 from telethon.tl import types, functions
 import tqdm
 
+import utils as export_utils
+from metrics import REGISTRY
+from profiler import MEMORY_PROFILER, PROFILER
+
 __log__ = logging.getLogger(__name__)
 
 
@@ -22,18 +30,191 @@ VALID_TYPES = {
 BAR_FORMAT = "{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}/{remaining}, {rate_noinv_fmt}{postfix}]"
 
 
+def _request(client, request, clock=time):
+    """
+    Invokes the request with the client, counting it by type in the
+    metrics, and sleeps through flood waits (those too long for the
+    client to do it) on the given clock before trying again. If the
+    connection is lost (for longer than the client retries), it is
+    reconnected before trying again.
+    """
+    while True:
+        REGISTRY.inc('requests_total', type=type(request).__name__)
+        try:
+            with PROFILER.phase('network'):
+                return client(request)
+        except FloodWaitError as e:
+            __log__.warning('Flood wait of %ds for %s', e.seconds,
+                            type(request).__name__)
+            REGISTRY.inc('flood_wait_seconds_total', e.seconds)
+            _sleep(e.seconds, clock)
+        except ConnectionError:
+            __log__.warning('Connection lost during %s, reconnecting...',
+                            type(request).__name__)
+            _reconnect(client, clock)
+
+
+def _download(client, method, *args, clock=time, **kwargs):
+    """
+    Downloads a file with the given method of the client and counts its
+    size, handling flood waits and lost connections like ``_request``.
+    If the file is in another DC and the client didn't follow it there,
+    the download is retried once so that the client connects to that DC.
+    """
+    migrated = set()
+    while True:
+        try:
+            with PROFILER.phase('media'):
+                return _count_download(method(*args, **kwargs))
+        except FloodWaitError as e:
+            __log__.warning('Flood wait of %ds while downloading', e.seconds)
+            REGISTRY.inc('flood_wait_seconds_total', e.seconds)
+            _sleep(e.seconds, clock)
+        except ConnectionError:
+            __log__.warning('Connection lost while downloading, '
+                            'reconnecting...')
+            _reconnect(client, clock)
+        except FileMigrateError as e:
+            if e.new_dc in migrated:
+                raise
+            __log__.info('File stored in DC %d, downloading it from there',
+                         e.new_dc)
+            REGISTRY.inc('migrations_total')
+            migrated.add(e.new_dc)
+
+
+def _reconnect(client, clock=time):
+    """Connects the client again, waiting between failed attempts"""
+    REGISTRY.inc('reconnects_total')
+    while not client.connect():
+        _sleep(RECONNECT_DELAY, clock)
+
+
+def _sleep(seconds, clock=time):
+    """
+    Sleeps for the given seconds on the clock (anything with the time()
+    and sleep() of the time module), timing it as such if profiling
+    """
+    with PROFILER.phase('sleep'):
+        clock.sleep(seconds)
+
+
+def _count_request(name):
+    """Counts a request made by the client method with the given name"""
+    REGISTRY.inc('requests_total', type=name)
+
+
+def _count_participant_requests(target_in, participants):
+    """
+    Yields the participants from iter_participants, counting the
+    requests it makes: one per page for channels plus the empty one
+    which ends them, or a single one for small group chats.
+    """
+    if not isinstance(target_in, types.InputPeerChannel):
+        _count_request('GetFullChatRequest')
+        yield from participants
+        return
+
+    _count_request('GetParticipantsRequest')
+    for i, participant in enumerate(participants):
+        if i % PARTICIPANTS_PAGE_SIZE == 0:
+            _count_request('GetParticipantsRequest')
+        yield participant
+
+
+def _count_download(filename):
+    """Counts the size of the given downloaded file, and returns it"""
+    if isinstance(filename, str) and os.path.isfile(filename):
+        REGISTRY.inc('downloaded_bytes_total', os.path.getsize(filename))
+    return filename
+
+
+class _NullBar:
+    """A progress bar which shows nothing, used when progress is off"""
+    def __init__(self, *args, initial=0, total=None, **kwargs):
+        self.n = initial
+        self.total = total
+
+    def update(self, n=1):
+        """Increments the count (which is not shown)"""
+        self.n += n
+
+    def close(self):
+        """Does nothing, there is nothing to close"""
+
+
+# How many pending entities to keep in memory with --bounded-memory
+BOUNDED_PENDING_ENTITIES = 1000
+
+# Seconds to wait between failed attempts to reconnect
+RECONNECT_DELAY = 5
+
+# iter_dialogs fetches this many dialogs per request
+DIALOGS_PAGE_SIZE = 100
+
+# iter_participants fetches this many participants of channels per request
+PARTICIPANTS_PAGE_SIZE = 200
+
+# Follow mode dumps updates in batches of up to this many
+# messages or seconds, and catches up with missed ones this often
+FOLLOW_BATCH_SIZE = 100
+FOLLOW_BATCH_TIME = 1
+FOLLOW_CATCH_UP_INTERVAL = 60 * 60
+
+# The dialog cache starts with this magic, followed by one header
+# (peer ID, time cached, top message ID, size) plus entity per dialog
+DIALOG_CACHE_MAGIC = b'TGEXDLG1'
+DIALOG_CACHE_HEADER = struct.Struct('<qqiI')
+
+
+def _iter_dialog_cache(cache_file, read_entities=True):
+    """
+    Yields (peer ID, time cached, top message ID, serialized entity)
+    for every dialog in the cache file, newest first, or nothing if
+    it doesn't exist or is not valid. If read_entities is False, the
+    entities are skipped and None is yielded instead.
+    """
+    if not os.path.isfile(cache_file):
+        return
+    with open(cache_file, 'rb') as f:
+        if f.read(len(DIALOG_CACHE_MAGIC)) != DIALOG_CACHE_MAGIC:
+            return
+        while True:
+            header = f.read(DIALOG_CACHE_HEADER.size)
+            if len(header) < DIALOG_CACHE_HEADER.size:
+                return  # No more data left to read
+            peer_id, cached_at, top_message, size =\
+                DIALOG_CACHE_HEADER.unpack(header)
+            if read_entities:
+                data = f.read(size)
+                if len(data) < size:
+                    return  # Truncated file
+            else:
+                data = None
+                f.seek(size, os.SEEK_CUR)
+            yield peer_id, cached_at, top_message, data
+
+
 class _EntityDownloader:
     """
     Helper class to concisely keep track on which entities need to be
     dumped, which already have been dumped, and a function to dump them.
 
     If no photo_fmt is provided, entity photos will not be downloaded.
+
+    If max_pending is given, no more than that many pending entities are
+    kept in memory, and the rest are spilled to the database until the
+    queue has room for them again.
     """
-    def __init__(self, client, dumper, photo_fmt=None):
+    def __init__(self, client, dumper, photo_fmt=None, max_pending=0,
+                 clock=time):
         self.client = client
+        self.clock = clock
         self.dumper = dumper
         self.photo_fmt = photo_fmt
+        self.max_pending = max_pending
         self._pending = deque()
+        self._spilled = 0
         self._pending_ids = set()
         self._dumped_ids = set()
 
@@ -66,14 +247,23 @@ class _EntityDownloader:
             eid = utils.get_peer_id(entity)
             if eid not in self._dumped_ids and not eid in self._pending_ids:
                 self._pending_ids.add(eid)
-                self._pending.append(entity)
+                # Once spilling, keep doing so not to change the order
+                if self.max_pending and (
+                        self._spilled or len(self._pending) >= self.max_pending):
+                    self.dumper.spill_entity(id(self), entity)
+                    self._spilled += 1
+                else:
+                    self._pending.append(entity)
+        REGISTRY.set('queue_depth', len(self), queue='entities')
 
     def _dump_entity(self, entity):
         needed_sleep = 1
         eid = utils.get_peer_id(entity)
 
         if isinstance(entity, types.User):
-            full = self.client(functions.users.GetFullUserRequest(entity))
+            full = _request(self.client,
+                            functions.users.GetFullUserRequest(entity),
+                            self.clock)
             photo_id = self.dumper.dump_media(full.profile_photo)
             self.dumper.dump_user(full, photo_id=photo_id)
             self.download_profile_photo(full.profile_photo, entity)
@@ -85,7 +275,9 @@ class _EntityDownloader:
             self.download_profile_photo(entity.photo, entity)
 
         elif isinstance(entity, types.Channel):
-            full = self.client(functions.channels.GetFullChannelRequest(entity))
+            full = _request(self.client,
+                            functions.channels.GetFullChannelRequest(entity),
+                            self.clock)
             photo_id = self.dumper.dump_media(full.full_chat.chat_photo)
             if entity.megagroup:
                 self.dumper.dump_supergroup(full.full_chat, entity, photo_id)
@@ -149,23 +341,34 @@ class _EntityDownloader:
             filename += formatter['ext']
 
         os.makedirs(os.path.dirname(filename), exist_ok=True)
-        return self.client.download_file(types.InputFileLocation(
-            volume_id=location.volume_id,
-            local_id=location.local_id,
-            secret=location.secret
-        ), file=filename, part_size_kb=256)
+        _count_request('download_file')
+        return _download(
+            self.client, self.client.download_file,
+            types.InputFileLocation(
+                volume_id=location.volume_id,
+                local_id=location.local_id,
+                secret=location.secret
+            ), file=filename, part_size_kb=256, clock=self.clock
+        )
 
     def __bool__(self):
-        return bool(self._pending)
+        return bool(self._pending) or bool(self._spilled)
 
     def __len__(self):
-        return len(self._pending)
+        return len(self._pending) + self._spilled
 
-    def pop_pending(self, pbar):
+    def pop_pending(self, pbar=None):
         """Pops a pending entity off the queue and returns needed sleep."""
+        if not self._pending and self._spilled:
+            unspilled = self.dumper.unspill_entities(id(self), self.max_pending)
+            self._spilled -= len(unspilled)
+            self._pending.extend(unspilled)
+
         if self._pending:
             sleep = self._dump_entity(self._pending.popleft())
-            pbar.update(1)  # Increment bar
+            REGISTRY.set('queue_depth', len(self), queue='entities')
+            if pbar:
+                pbar.update(1)  # Increment bar
             return sleep
         return 0
 
@@ -174,10 +377,19 @@ class Downloader:
     """
     Download dialogs and their associated data, and dump them.
     Make Telegram API requests and sleep for the appropriate time.
+
+    The time is told and slept on the given clock, which can be any
+    object with the time() and sleep() of the time module.
     """
-    def __init__(self, client, config):
+    def __init__(self, client, config, progress=True, max_pending_entities=0,
+                 clock=time):
         self.client = client
+        self.clock = clock
+        self.max_pending_entities = max_pending_entities
+        self.progress_bar = tqdm.tqdm if progress else _NullBar
         self.max_size = config.getint('MaxSize')
+        self.dialog_cache_ttl = config.getint('DialogCacheTTL', 86400)
+        self.entity_cache_ttl = config.getint('EntityCacheTTL', 86400)
         self.types = {x.strip().lower()
                       for x in (config.get('MediaWhitelist') or '').split(',')
                       if x.strip()}
@@ -187,6 +399,16 @@ class Downloader:
         if self.types:
             self.types.add('unknown')  # Always allow "unknown" media types
 
+    def _make_entity_downloader(self, dumper):
+        """Makes an _EntityDownloader with the settings of this Downloader"""
+        return _EntityDownloader(
+            self.client,
+            dumper,
+            photo_fmt=self.media_fmt if 'chatphoto' in self.types else None,
+            max_pending=self.max_pending_entities,
+            clock=self.clock
+        )
+
     @staticmethod
     def _get_media_type(media):
         """
@@ -269,7 +491,66 @@ class Downloader:
             filename += formatter['ext']
 
         os.makedirs(os.path.dirname(filename), exist_ok=True)
-        return self.client.download_media(media, file=filename)
+        _count_request('download_media')
+        return _download(self.client, self.client.download_media, media,
+                         file=filename, clock=self.clock)
+
+    def get_entity(self, dumper, who):
+        """
+        Returns the User, Chat or Channel for 'who' (an entity, peer,
+        marked ID, username or phone), looking it up in the entity cache
+        of the dumper before asking Telegram, and caching the result.
+        """
+        if isinstance(who, (types.User, types.Chat, types.Channel)):
+            # We already have it, but it's fresh so keep it for later
+            dumper.cache_entity(who)
+            return who
+
+        key = export_utils.get_resolve_key(who)
+        entity = dumper.get_cached_entity(key, max_age=self.entity_cache_ttl)\
+            if key else None
+        if entity is None:
+            _count_request('get_entity')
+            with PROFILER.phase('network'):
+                entity = self.client.get_entity(who)
+            dumper.cache_entity(entity, key)
+        return entity
+
+    def _dump_messages(self, dumper, messages, target, entities,
+                       entity_downloader, edited=False):
+        """
+        Dumps the given messages from the target, and downloads their
+        media if needed. The entities dictionary must contain the target.
+        If the messages were edited, the forwards of those already dumped
+        are reused instead of dumped again.
+        """
+        target_id = utils.get_peer_id(target)
+        for m in messages:
+            if isinstance(m, types.Message):
+                if self.check_media(m.media):
+                    self.download_media(m, target_id, entities)
+
+                fwd_id = None
+                if edited and m.fwd_from:
+                    fwd_id = dumper.get_forward_id(target_id, m.id)
+                if fwd_id is None:
+                    fwd_id = dumper.dump_forward(m.fwd_from)
+                media_id = dumper.dump_media(m.media)
+                dumper.dump_message(m, target_id,
+                                    forward_id=fwd_id, media_id=media_id)
+
+            elif isinstance(m, types.MessageService):
+                if isinstance(m.action, types.MessageActionChatEditPhoto):
+                    media_id = dumper.dump_media(m.action.photo)
+                    entity_downloader.download_profile_photo(
+                        m.action.photo, target, known_id=m.id
+                    )
+                else:
+                    media_id = None
+                dumper.dump_message_service(m, target_id,
+                                            media_id=media_id)
+            else:
+                __log__.warning('Skipping message %s', m)
 
     def save_messages(self, dumper, target_id):
         """
@@ -277,8 +558,16 @@ class Downloader:
         config) from the target using the dumper, then dump remaining entities.
         """
         # TODO also actually save admin log
-        target_in = self.client.get_input_entity(target_id)
-        target = self.client.get_entity(target_in)
+        target = self.get_entity(dumper, target_id)
+        name = '{} ({})'.format(utils.get_display_name(target),
+                                utils.get_peer_id(target))
+        with PROFILER.dialog(name):
+            self._save_messages(dumper, target)
+        MEMORY_PROFILER.snapshot(name)
+
+    def _save_messages(self, dumper, target):
+        """Does the work of save_messages for the given entity"""
+        target_in = utils.get_input_peer(target)
         target_id = utils.get_peer_id(target)
         req = functions.messages.GetHistoryRequest(
             peer=target_in,
@@ -292,21 +581,21 @@ class Downloader:
         )
         chunks_left = dumper.max_chunks
 
-        entity_downloader = _EntityDownloader(
-            self.client,
-            dumper,
-            photo_fmt=self.media_fmt if 'chatphoto' in self.types else None
-        )
+        entity_downloader = self._make_entity_downloader(dumper)
         # Always download the dumping dialog
         entity_downloader.extend_pending((target,))
 
         if isinstance(target_in, (types.InputPeerChat, types.InputPeerChannel)):
             try:
                 __log__.info('Getting participants...')
-                participants = self.client.get_participants(target_in)
-                added, removed = dumper.dump_participants_delta(
-                    target_id, ids=[x.id for x in participants]
-                )
+                participants = _count_participant_requests(
+                    target_in, self.client.iter_participants(target_in))
+                # Only the IDs are needed, so don't keep the users around
+                with PROFILER.phase('network'):
+                    ids = [x.id for x in participants]
+                with PROFILER.phase('insert'):
+                    added, removed = dumper.dump_participants_delta(
+                        target_id, ids=ids)
                 __log__.info('Saved %d new members, %d left the chat.',
                              len(added), len(removed))
             except ChatAdminRequiredError:
@@ -317,13 +606,17 @@ class Downloader:
             __log__.info('Resuming at %s (%s)', req.offset_date, req.offset_id)
 
         found = dumper.get_message_count(target_id)
-        pbar = tqdm.tqdm(unit=' messages', desc=utils.get_display_name(target),
-                         initial=found, bar_format=BAR_FORMAT)
-        entbar = tqdm.tqdm(unit=' entities', bar_format=BAR_FORMAT,
-                           postfix={'chat':utils.get_display_name(target)})
+        # Only a fresh start (not resuming) sees the newest message first
+        date_active = None
+        find_date_active = not req.offset_id
+        name = utils.get_display_name(target)
+        pbar = self.progress_bar(unit=' messages', desc=name,
+                                 initial=found, bar_format=BAR_FORMAT)
+        entbar = self.progress_bar(unit=' entities', bar_format=BAR_FORMAT,
+                                   postfix={'chat': name})
         while True:
-            start = time.time()
-            history = self.client(req)
+            start = self.clock.time()
+            history = _request(self.client, req, self.clock)
 
             # Get media needs access to the entities from this batch
             entities = {utils.get_peer_id(x): x for x in
@@ -341,33 +634,14 @@ class Downloader:
             entity_downloader.pop_pending(entbar)
             entbar.update(1)
 
-            for m in history.messages:
-                if isinstance(m, types.Message):
-                    if self.check_media(m.media):
-                        self.download_media(m, target_id, entities)
-
-                    fwd_id = dumper.dump_forward(m.fwd_from)
-                    media_id = dumper.dump_media(m.media)
-                    dumper.dump_message(m, target_id,
-                                        forward_id=fwd_id, media_id=media_id)
-
-                elif isinstance(m, types.MessageService):
-                    if isinstance(m.action, types.MessageActionChatEditPhoto):
-                        media_id = dumper.dump_media(m.action.photo)
-                        entity_downloader.download_profile_photo(
-                            m.action.photo, target, known_id=m.id
-                        )
-                    else:
-                        media_id = None
-                    dumper.dump_message_service(m, target_id,
-                                                media_id=media_id)
-                else:
-                    __log__.warning('Skipping message %s', m)
-                    continue
+            self._dump_messages(dumper, history.messages, target, entities,
+                                entity_downloader)
 
             total_messages = getattr(history, 'count', len(history.messages))
             pbar.total = total_messages
             if history.messages:
+                if find_date_active and not date_active:
+                    date_active = max(m.date for m in history.messages)
                 # We may reinsert some we already have (so found > total)
                 found = min(found + len(history.messages), total_messages)
                 req.offset_id = min(m.id for m in history.messages)
@@ -405,9 +679,10 @@ class Downloader:
                 __log__.debug('Reached maximum amount of chunks, done.')
                 break
 
-            dumper.commit()
+            dumper.maybe_commit()
             # 30 request in 30 seconds (sleep a second *between* requests)
-            time.sleep(max(1 - (time.time() - start), 0))
+            _sleep(max(1 - (self.clock.time() - start), 0), self.clock)
+        dumper.dump_dialog(target, date_active=date_active)
         dumper.commit()
         pbar.n = pbar.total
         pbar.close()
@@ -418,21 +693,129 @@ class Downloader:
         )
         entbar.total = entity_downloader.total_count
         while entity_downloader:
-            start = time.time()
+            start = self.clock.time()
             needed_sleep = entity_downloader.pop_pending(entbar)
-            dumper.commit()
-            time.sleep(max(needed_sleep - (time.time() - start), 0))
+            dumper.maybe_commit()
+            _sleep(max(needed_sleep - (self.clock.time() - start), 0),
+                   self.clock)
+        dumper.commit()
 
         entbar.n = entbar.total
         entbar.close()
 
+    def catch_up(self, dumper, should_follow=None):
+        """
+        Saves the new messages of the dialogs that got any since they
+        were last dumped, stopping at the first (not pinned) dialog
+        without them, much like getDifference. If should_follow is
+        given, only the dialogs for which it returns True are saved.
+        """
+        for i, dialog in enumerate(self.client.iter_dialogs(limit=None)):
+            if i % DIALOGS_PAGE_SIZE == 0:
+                _count_request('GetDialogsRequest')
+            if should_follow and not should_follow(dialog.id):
+                continue
+
+            last_id = 0
+            if dumper.get_message_count(dialog.id):
+                last_id = dumper.get_message_id(dialog.id, 'MAX')
+
+            if dialog.dialog.top_message > last_id:
+                self.save_messages(dumper, dialog.entity)
+            elif not dialog.pinned:
+                break
+
+    def _dump_events(self, dumper, batch, should_follow, entity_downloader):
+        """Dumps a batch of events received while following"""
+        for event in batch:
+            if isinstance(event, events.MessageDeleted.Event):
+                # Those without a context only mark the dumped messages
+                if event.chat_id is None or not should_follow \
+                        or should_follow(event.chat_id):
+                    dumper.dump_deleted_messages(event.deleted_ids,
+                                                 context_id=event.chat_id)
+                continue
+
+            if isinstance(event, events.ChatAction.Event):
+                message = event.action_message
+                if not message:
+                    continue  # Only the actions with a message are kept
+            else:
+                message = event.message
+
+            context_id = event.chat_id
+            if should_follow and not should_follow(context_id):
+                continue
+
+            entities = dict(getattr(event, '_entities', None) or {})
+            entity_downloader.extend_pending(entities.values())
+            if context_id not in entities:
+                entities[context_id] = self.get_entity(dumper, context_id)
+            self._dump_messages(
+                dumper, (message,), entities[context_id], entities,
+                entity_downloader,
+                edited=isinstance(event, events.MessageEdited.Event))
+
+    def follow(self, dumper, should_follow=None,
+               batch_size=FOLLOW_BATCH_SIZE, batch_time=FOLLOW_BATCH_TIME):
+        """
+        Dumps new, edited and deleted messages and chat actions as they
+        happen, in batches of up to batch_size events or batch_time
+        seconds, until interrupted. If should_follow is given, only the
+        contexts for which it returns True are followed.
+
+        The events are only queued from the threads that receive them,
+        and dumped from this one. Messages missed while disconnected are
+        saved by catching up once the connection is back.
+        """
+        updates = queue.Queue()
+        for builder in (events.NewMessage, events.MessageEdited,
+                        events.MessageDeleted, events.ChatAction):
+            self.client.add_event_handler(updates.put, builder())
+
+        entity_downloader = self._make_entity_downloader(dumper)
+        connected = True
+        last_catch_up = self.clock.time()
+        __log__.info('Following new messages...')
+        while True:
+            batch = []
+            deadline = self.clock.time() + batch_time
+            while len(batch) < batch_size:
+                try:
+                    batch.append(updates.get(
+                        timeout=max(deadline - self.clock.time(), 0)))
+                except queue.Empty:
+                    break
+
+            REGISTRY.set('queue_depth', updates.qsize(), queue='updates')
+            if batch:
+                self._dump_events(dumper, batch, should_follow,
+                                  entity_downloader)
+                __log__.debug('Dumped %d events', len(batch))
+
+            # Only a few at a time, not to delay the next batch too much
+            entity_downloader.pop_pending()
+            dumper.maybe_commit()
+
+            if not self.client.is_connected():
+                if connected:
+                    __log__.warning('Disconnected, reconnecting...')
+                connected = False
+                self.client.connect()
+            elif not connected or self.clock.time() - last_catch_up \
+                    > FOLLOW_CATCH_UP_INTERVAL:
+                __log__.info('Catching up with missed messages...')
+                self.catch_up(dumper, should_follow)
+                connected = True
+                last_catch_up = self.clock.time()
+
     def save_admin_log(self, dumper, target_id):
         """
         Download and dumps the entire available admin log for the given
         channel. You must have permission to view the admin log for it.
         """
-        target_in = self.client.get_input_entity(target_id)
-        target = self.client.get_entity(target_in)
+        target = self.get_entity(dumper, target_id)
+        target_in = utils.get_input_peer(target)
         target_id = utils.get_peer_id(target)
         req = functions.channels.GetAdminLogRequest(
             target_in, q='', min_id=0, max_id=0, limit=100
@@ -444,15 +827,11 @@ class Downloader:
         # Rather silly considering logs only last up to two days and
         # there isn't much information in them (due to their short life).
         chunks_left = dumper.max_chunks
-        entity_downloader = _EntityDownloader(
-            self.client,
-            dumper,
-            photo_fmt=self.media_fmt if 'chatphoto' in self.types else None
-        )
-        entbar = tqdm.tqdm(entbar=tqdm.tqdm(unit='log events'))
+        entity_downloader = self._make_entity_downloader(dumper)
+        entbar = self.progress_bar(unit=' log events', bar_format=BAR_FORMAT)
         while True:
-            start = time.time()
-            result = self.client(req)
+            start = self.clock.time()
+            result = _request(self.client, req, self.clock)
             __log__.debug('Downloaded another chunk of the admin log.')
             entity_downloader.extend_pending(
                 itertools.chain(result.users, result.chats)
@@ -481,16 +860,18 @@ class Downloader:
                 entbar.update(1)
 
             req.max_id = min(e.id for e in result.events)
-            time.sleep(max(1 - (time.time() - start), 0))
+            _sleep(max(1 - (self.clock.time() - start), 0), self.clock)
             chunks_left -= 1
             if chunks_left <= 0:
                 break
 
         while entity_downloader:
-            start = time.time()
+            start = self.clock.time()
             needed_sleep = entity_downloader.pop_pending(entbar)
-            dumper.commit()
-            time.sleep(max(needed_sleep - (time.time() - start), 0))
+            dumper.maybe_commit()
+            _sleep(max(needed_sleep - (self.clock.time() - start), 0),
+                   self.clock)
+        dumper.commit()
 
         __log__.debug('Admin log from %s dumped',
                       utils.get_display_name(target))
@@ -504,11 +885,15 @@ class Downloader:
         will be *ignored* and not re-downloaded again.
         """
         # TODO Should this respect and download only allowed media? Or all?
-        target_in = self.client.get_input_entity(target_id)
-        target = self.client.get_entity(target_in)
+        target = self.get_entity(dumper, target_id)
+        target_in = utils.get_input_peer(target)
         target_id = utils.get_peer_id(target)
 
-        msg_cursor = dumper.conn.cursor()
+        conn = dumper.context_conn(target_id, create=False)
+        if conn is None:
+            return  # Nothing dumped for the target yet
+
+        msg_cursor = conn.cursor()
         msg_cursor.execute('SELECT ID, Date, FromID, MediaID FROM Message '
                            'WHERE ContextID = ? AND MediaID IS NOT NULL',
                            (target_id,))
@@ -568,45 +953,95 @@ class Downloader:
             else:
                 __log__.info('Downloading to %s', filename)
                 os.makedirs(os.path.dirname(filename), exist_ok=True)
+                _count_request('download_file')
                 if media_type == 'document':
-                    self.client.download_file(types.InputDocumentFileLocation(
+                    location = types.InputDocumentFileLocation(
                         id=media_row[0],
                         version=media_row[1],
                         access_hash=media_row[2]
-                    ), file=filename)
+                    )
                 else:
-                    self.client.download_file(types.InputFileLocation(
+                    location = types.InputFileLocation(
                         local_id=media_row[0],
                         volume_id=media_row[1],
                         secret=media_row[2]
-                    ), file=filename)
-                time.sleep(1)
+                    )
+                _download(self.client, self.client.download_file, location,
+                          file=filename, clock=self.clock)
+                _sleep(1, self.clock)
             msg_row = msg_cursor.fetchone()
 
     def fetch_dialogs(self, cache_file='dialogs.tl', force=False):
-        """Get a list of dialogs, and dump new data from them"""
-        # TODO What to do about cache invalidation?
-        if not force and os.path.isfile(cache_file):
-            with open(cache_file, 'rb') as f, BinaryReader(stream=f) as reader:
-                entities = []
-                while True:
-                    try:
-                        entities.append(reader.tgread_object())
-                    except BufferError:
-                        break  # No more data left to read
-                return entities
-        with open(cache_file, 'wb') as f:
-            entities = [d.entity for d in self.client.get_dialogs(limit=None)]
-            for entity in entities:
-                f.write(bytes(entity))
-
-        return entities
-
-    def load_entities_from_str(self, string):
-        """Helper function to load entities from the config file"""
+        """
+        Yields the entity of every dialog, from the most recently active,
+        keeping them in cache_file for the next time.
+
+        Only the dialogs with new messages since they were cached are
+        fetched, and the rest are read from the cache as they are needed.
+        All of them are fetched again if forced, or if any was cached
+        longer than the DialogCacheTTL ago.
+
+        The cache is only replaced after all dialogs have been yielded.
+        """
+        now = int(self.clock.time())
+        known = {}  # {peer ID: top message ID} of the cached dialogs
+        if not force:
+            for peer_id, cached_at, top_message, _ in _iter_dialog_cache(
+                    cache_file, read_entities=False):
+                if now - cached_at > self.dialog_cache_ttl:
+                    __log__.info('Dialog cache expired, fetching all dialogs')
+                    known.clear()
+                    break
+                known[peer_id] = top_message
+
+        tmp_file = cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(DIALOG_CACHE_MAGIC)
+                fetched = set()
+                # iter_dialogs requests dialogs in pages as they are
+                # needed, so stopping early saves the rest of requests
+                for i, dialog in enumerate(
+                        self.client.iter_dialogs(limit=None)):
+                    if i % DIALOGS_PAGE_SIZE == 0:
+                        _count_request('GetDialogsRequest')
+                    top_message = dialog.dialog.top_message
+                    # Pinned dialogs always come first, so they say
+                    # nothing about whether the rest are up to date
+                    if not dialog.pinned and \
+                            known.get(dialog.id) == top_message:
+                        break
+                    fetched.add(dialog.id)
+                    data = bytes(dialog.entity)
+                    f.write(DIALOG_CACHE_HEADER.pack(
+                        dialog.id, now, top_message, len(data)))
+                    f.write(data)
+                    yield dialog.entity
+
+                __log__.info('Fetched %d dialogs, reading the rest from %s',
+                             len(fetched), cache_file)
+                for peer_id, cached_at, top_message, data in \
+                        (_iter_dialog_cache(cache_file) if known else ()):
+                    if peer_id in fetched:
+                        continue
+                    f.write(DIALOG_CACHE_HEADER.pack(
+                        peer_id, cached_at, top_message, len(data)))
+                    f.write(data)
+                    yield BinaryReader(data).tgread_object()
+
+            os.replace(tmp_file, cache_file)
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    def load_entities_from_str(self, string, dumper):
+        """
+        Helper function to load entities from the config file,
+        through the entity cache of the dumper.
+        """
         for who in string.split(','):
-            who = who.strip().split(':', 1)[0]  # Ignore anything after ':'
+            who = who.strip().split(':', 1)[0].strip()  # Ignore after ':'
             if (not who.startswith('+') and who.isdigit()) or who.startswith('-'):
-                yield self.client.get_input_entity(int(who))
-            else:
-                yield self.client.get_input_entity(who)
+                yield self.get_entity(dumper, int(who))
+            elif who:
+                yield self.get_entity(dumper, who)
@@ -5,18 +5,61 @@ import logging
 import sqlite3
 import sys
 import time
-from base64 import b64encode
+from collections import namedtuple
 from datetime import datetime
 from enum import Enum
 import os.path
 
+import shards
 import utils
+from compression import ColumnCompressor
+from metrics import REGISTRY
+from profiler import PROFILER
+from shards import ShardPool
+from sqltrace import TRACER
+from telethon.extensions import BinaryReader
 from telethon.tl import types
-from telethon.utils import get_peer_id
+from telethon.utils import get_peer_id, get_display_name
 
 logger = logging.getLogger(__name__)
 
-DB_VERSION = 1  # database version
+DB_VERSION = 12  # database version
+
+# Most variables bound in a single query, below the 999 that older
+# versions of SQLite allow (one is left for the other parameters)
+MAX_QUERY_VARIABLES = 998
+
+# Contexts above this ID (users and small groups) share their message
+# IDs, unlike channels and supergroups which have their own
+SHARED_IDS_MIN_CONTEXT = -1000000000000
+
+# How the database trades durability for speed. Sizes are in bytes,
+# and commit_interval is how many seconds maybe_commit() waits between
+# commits by default (or 0 to commit every time).
+DurabilityProfile = namedtuple('DurabilityProfile', (
+    'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store',
+    'commit_interval'
+))
+
+DURABILITY_PROFILES = {
+    # Every chunk is committed and synced to disk before the next one.
+    # Nothing committed is lost, even if the computer loses power.
+    'safe': DurabilityProfile('DELETE', 'FULL', 2 * 2**20, 0,
+                              'DEFAULT', 0),
+    # Write-ahead log, synced to disk only on checkpoints, and commits
+    # every few seconds. Crashing loses at most the last commit_interval
+    # seconds of work, and power loss a few commits more, but never
+    # corrupts the database.
+    'balanced': DurabilityProfile('WAL', 'NORMAL', 64 * 2**20, 256 * 2**20,
+                                  'MEMORY', 2),
+    # Like balanced, but with bigger caches and rare commits. Crashing
+    # loses at most the last commit_interval seconds of work (which are
+    # dumped again by the next run), and power loss a few commits more,
+    # but never corrupts the database. Meant for the first export of big
+    # accounts. Syncing is not turned OFF, since that may corrupt it.
+    'bulk-import': DurabilityProfile('WAL', 'NORMAL', 256 * 2**20, 2**30,
+                                     'MEMORY', 30),
+}
 
 
 class InputFileType(Enum):
@@ -25,27 +68,6 @@ class InputFileType(Enum):
     DOCUMENT = 1
 
 
-def sanitize_dict(dictionary):
-    """
-    Sanitizes a dictionary, encoding all bytes as
-    Base64 so that it can be serialized as JSON.
-
-    Assumes that there are no containers with bytes inside,
-    and that the dictionary doesn't contain self-references.
-    """
-    for k, v in dictionary.items():
-        if isinstance(v, bytes):
-            dictionary[k] = str(b64encode(v), encoding='ascii')
-        elif isinstance(v, datetime):
-            dictionary[k] = v.timestamp()
-        elif isinstance(v, dict):
-            sanitize_dict(v)
-        elif isinstance(v, list):
-            for d in v:
-                if isinstance(d, dict):
-                    sanitize_dict(d)
-
-
 class Dumper:
     """Class to interface with the database for exports"""
 
@@ -54,21 +76,38 @@ class Dumper:
         `config` should be a dict-like object from the config file's Dumper section"
         """
         self.config = config
+        sharding = shards.parse_sharding(config.get('Sharding', 'none'))
         if 'DBFileName' in self.config:
             if self.config["DBFileName"] == ':memory:':
-                self.conn = sqlite3.connect(':memory:')
+                if sharding is not None:
+                    raise ValueError('In-memory databases cannot be sharded')
+                self.conn = TRACER.connect(':memory:')
             else:
                 filename = os.path.join(self.config['OutputDirectory'],
                                         self.config['DBFileName'])
-                self.conn = sqlite3.connect('{}.db'.format(filename))
+                self.conn = TRACER.connect('{}.db'.format(filename))
         else:
             logger.error("A database filename is required!")
             exit()
+        durability = config.get('Durability', 'safe')
+        if durability not in DURABILITY_PROFILES:
+            raise ValueError('Unknown durability {}, must be one of {}'.format(
+                durability, ', '.join(DURABILITY_PROFILES)))
+        self.durability = DURABILITY_PROFILES[durability]
+        self._apply_durability()
+        # Commits are grouped until either limit is reached
+        self.commit_interval = config.getfloat(
+            'CommitInterval', self.durability.commit_interval)
+        self.commit_rows = max(config.getint('CommitRows', 10000), 1)
+        self._last_commit = time.time()
+        self._uncommitted_rows = 0
         c = self.conn.cursor()
 
         self.chunk_size = max(int(config.get('ChunkSize', 100)), 1)
         self.max_chunks = max(int(config.get('MaxChunks', 0)), 0)
         self.invalidation_time = max(config.getint('InvalidationTime', 0), -1)
+        self.full_text_search = config.getboolean('FullTextSearch', False)
+        self.store_raw_tl = config.getboolean('StoreRawTL', False)
 
         c.execute("SELECT name FROM sqlite_master "
                   "WHERE type='table' AND name='Version'")
@@ -163,60 +202,453 @@ class Dumper:
                       "FOREIGN KEY (PictureID) REFERENCES Media(ID),"
                       "PRIMARY KEY (ID, DateUpdated)) WITHOUT ROWID")
 
-            c.execute("CREATE TABLE ChatParticipants("
-                      "ContextID INT NOT NULL,"
-                      "DateUpdated INT NOT NULL,"
-                      "Added TEXT NOT NULL,"
-                      "Removed TEXT NOT NULL,"
-                      "PRIMARY KEY (ContextID, DateUpdated)) WITHOUT ROWID")
+            if sharding is None:
+                self._create_context_tables(self.conn)
+            self._create_dialog_catalog()
+            self._create_entity_cache()
+            self._create_schedule()
+            self._create_compression_dicts()
+            self._create_shard_catalog()
+            self._create_merge_sources()
+            if sharding is not None:
+                c.execute("INSERT INTO Sharding VALUES (?)", (sharding,))
+            self.conn.commit()
 
-            c.execute("CREATE TABLE Message("
-                      "ID INT NOT NULL,"
-                      "ContextID INT NOT NULL,"
-                      "Date INT NOT NULL,"
-                      "FromID INT,"
-                      "Message TEXT,"
-                      "ReplyMessageID INT,"
-                      "ForwardID INT,"
-                      "PostAuthor TEXT,"
-                      "ViewCount INT,"
-                      "MediaID INT,"
-                      "Formatting TEXT,"  # e.g. bold, italic, etc.
-                      "ServiceAction TEXT,"  # friendly name of action if it is
-                      # a MessageService
-                      "FOREIGN KEY (ForwardID) REFERENCES Forward(ID),"
-                      "FOREIGN KEY (MediaID) REFERENCES Media(ID),"
-                      "PRIMARY KEY (ID, ContextID)) WITHOUT ROWID")
-
-            c.execute("CREATE TABLE AdminLog("
-                      "ID INT NOT NULL,"
-                      "ContextID INT NOT NULL,"
-                      "Date INT NOT NULL,"
-                      "UserID INT,"
-                      "MediaID1 INT,"  # e.g. new photo
-                      "MediaID2 INT,"  # e.g. old photo
-                      "Action TEXT,"  # Friendly name for the action
-                      "Data TEXT,"  # JSON data of the entire action
-                      "FOREIGN KEY (MediaID1) REFERENCES Media(ID),"
-                      "FOREIGN KEY (MediaID2) REFERENCES Media(ID),"
-                      "PRIMARY KEY (ID, ContextID)) WITHOUT ROWID")
-
-            c.execute("CREATE TABLE Resume("
-                      "ContextID INT NOT NULL,"
-                      "ID INT NOT NULL,"
-                      "Date INT NOT NULL,"
-                      "StopAt INT NOT NULL,"
-                      "PRIMARY KEY (ContextID)) WITHOUT ROWID")
+        # The layout is decided when the database is created
+        self.shard_buckets = shards.get_buckets(self.conn)
+        if sharding is not None and sharding != self.shard_buckets:
+            logger.warning('The database was created with a different '
+                           'sharding, which will be used instead')
+
+        if self.full_text_search and self.shard_buckets is None:
+            self._create_search_index()
             self.conn.commit()
+        if self.shard_buckets is None:
+            self.shard_pool = None
+        else:
+            self.shard_pool = ShardPool(
+                shards.get_directory(self.conn), self.shard_buckets,
+                self._open_shard, before_close=self._close_shard)
+            self._shard_contexts = {row[0] for row in self.conn.execute(
+                "SELECT ContextID FROM Shard")}
+
+        codec = config.get('ColumnCompression', 'none')
+        self.compressor = ColumnCompressor(
+            self.conn, None if codec == 'none' else codec,
+            level=config.getint('CompressionLevel', 3)
+        )
+
+        # Entities waiting to be dumped which didn't fit in memory.
+        # Temporary, because they're only meaningful during this run.
+        self.conn.execute("CREATE TEMP TABLE PendingEntity("
+                          "Seq INTEGER PRIMARY KEY,"
+                          "Owner INT NOT NULL,"
+                          "Entity BLOB NOT NULL)")
+
+    def _apply_durability(self, conn=None):
+        """Sets the pragmas of the durability profile on the connection"""
+        conn = conn or self.conn
+        profile = self.durability
+        conn.execute('PRAGMA journal_mode = {}'.format(profile.journal_mode))
+        conn.execute('PRAGMA synchronous = {}'.format(profile.synchronous))
+        # Negative sizes are in KiB instead of pages
+        conn.execute('PRAGMA cache_size = {}'
+                     .format(-(profile.cache_size // 1024)))
+        conn.execute('PRAGMA mmap_size = {}'.format(profile.mmap_size))
+        conn.execute('PRAGMA temp_store = {}'.format(profile.temp_store))
+
+    def _open_shard(self, filename):
+        """Opens (and creates, if needed) the shard with the filename"""
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        conn = TRACER.connect(filename)
+        self._apply_durability(conn)
+        if not conn.execute("SELECT name FROM sqlite_master "
+                            "WHERE type='table' AND name='Message'").fetchone():
+            self._create_context_tables(conn)
+            conn.commit()
+        if self.full_text_search:
+            self._create_search_index(conn)
+            conn.commit()
+        return conn
+
+    def _close_shard(self, conn):
+        """
+        Commits the changes of a shard about to be closed, if any. The
+        catalog is committed first, so the shard never refers to media
+        which is lost in a crash, but the other shards are left alone.
+        """
+        if conn.in_transaction:
+            self.conn.commit()
+            conn.commit()
+
+    def context_conn(self, context_id, create=True):
+        """
+        Returns the connection to the database with the messages (and
+        the other tables of single contexts) of the given context, which
+        is its shard if the database is sharded or the catalog otherwise.
+
+        If create is False, None is returned instead of creating the
+        shard of a context which has none yet (and so nothing to read).
+        """
+        if not self.shard_pool:
+            return self.conn
+        if context_id not in self._shard_contexts:
+            if not create:
+                return None
+            self._count_changes(self.conn.execute(
+                "INSERT OR IGNORE INTO Shard VALUES (?, ?)", (
+                    context_id,
+                    shards.shard_key(context_id, self.shard_buckets))))
+            self._shard_contexts.add(context_id)
+        return self.shard_pool.get(context_id)
+
+    def iter_context_conns(self, min_context_id=None):
+        """
+        Yields the connection to every database with the tables of single
+        contexts, which are all the shards if the database is sharded, or
+        only those with a context above min_context_id if it's given.
+        Only the last one yielded is guaranteed to remain open.
+        """
+        if not self.shard_pool:
+            yield self.conn
+            return
+        if min_context_id is None:
+            keys = self.conn.execute("SELECT DISTINCT Key FROM Shard")
+        else:
+            keys = self.conn.execute("SELECT DISTINCT Key FROM Shard "
+                                     "WHERE ContextID > ?", (min_context_id,))
+        for key, in keys.fetchall():
+            yield self.shard_pool.get_shard(key)
 
     def _upgrade_database(self, old):
         """
         This method knows how to migrate from old -> DB_VERSION.
 
-        Currently it performs no operation because this is the
-        first version of the tables, in the future it should alter
-        tables or somehow transfer the data between what canged.
+        Every step upgrades the tables from one version to the next,
+        so that any old version can be brought to the current one.
+        """
+        c = self.conn.cursor()
+        if old < 2:
+            c.execute("CREATE INDEX IF NOT EXISTS MessageContextDate "
+                      "ON Message(ContextID, Date, ID)")
+        if old < 3:
+            self._create_dialog_catalog()
+        if old < 4:
+            self._create_entity_cache()
+        if old < 5:
+            self._create_message_deletion()
+        if old < 6:
+            self._create_schedule()
+        if old < 7:
+            self._encode_formatting()
+        if old < 8:
+            self._create_compression_dicts()
+        if old < 9:
+            self._create_shard_catalog()
+        if old < 10:
+            self._create_merge_sources()
+        if old < 11:
+            c.execute("CREATE INDEX IF NOT EXISTS DialogTrigramDialog "
+                      "ON DialogTrigram(DialogID)")
+        if old < 12:
+            self._add_source_context_ids()
+
+        c.execute("UPDATE Version SET Version = ?", (DB_VERSION,))
+
+    def _create_context_tables(self, conn):
+        """
+        Creates the tables with the data of single contexts (messages,
+        admin log, participants, deletions and where to resume), which
+        are in each shard instead of the catalog if it's sharded.
+        """
+        c = conn.cursor()
+        c.execute("CREATE TABLE ChatParticipants("
+                  "ContextID INT NOT NULL,"
+                  "DateUpdated INT NOT NULL,"
+                  "Added TEXT NOT NULL,"
+                  "Removed TEXT NOT NULL,"
+                  "PRIMARY KEY (ContextID, DateUpdated)) WITHOUT ROWID")
+
+        c.execute("CREATE TABLE Message("
+                  "ID INT NOT NULL,"
+                  "ContextID INT NOT NULL,"
+                  "Date INT NOT NULL,"
+                  "FromID INT,"
+                  "Message TEXT,"
+                  "ReplyMessageID INT,"
+                  "ForwardID INT,"
+                  "PostAuthor TEXT,"
+                  "ViewCount INT,"
+                  "MediaID INT,"
+                  "Formatting TEXT,"  # e.g. bold, italic, etc.
+                  "ServiceAction TEXT,"  # friendly name of action if it is
+                  # a MessageService
+                  "FOREIGN KEY (ForwardID) REFERENCES Forward(ID),"
+                  "FOREIGN KEY (MediaID) REFERENCES Media(ID),"
+                  "PRIMARY KEY (ID, ContextID)) WITHOUT ROWID")
+
+        # Used to seek (and page) through the messages of a context
+        c.execute("CREATE INDEX MessageContextDate "
+                  "ON Message(ContextID, Date, ID)")
+
+        c.execute("CREATE TABLE AdminLog("
+                  "ID INT NOT NULL,"
+                  "ContextID INT NOT NULL,"
+                  "Date INT NOT NULL,"
+                  "UserID INT,"
+                  "MediaID1 INT,"  # e.g. new photo
+                  "MediaID2 INT,"  # e.g. old photo
+                  "Action TEXT,"  # Friendly name for the action
+                  "Data TEXT,"  # JSON data of the entire action
+                  "FOREIGN KEY (MediaID1) REFERENCES Media(ID),"
+                  "FOREIGN KEY (MediaID2) REFERENCES Media(ID),"
+                  "PRIMARY KEY (ID, ContextID)) WITHOUT ROWID")
+
+        c.execute("CREATE TABLE Resume("
+                  "ContextID INT NOT NULL,"
+                  "ID INT NOT NULL,"
+                  "Date INT NOT NULL,"
+                  "StopAt INT NOT NULL,"
+                  "PRIMARY KEY (ContextID)) WITHOUT ROWID")
+
+        self._create_message_deletion(conn)
+
+    def _create_dialog_catalog(self):
+        """
+        Creates the tables for the catalog of known dialogs, used to
+        search them offline, and its trigram index.
+        """
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS Dialog("
+                  "ID INT NOT NULL,"  # Marked ID
+                  "DateUpdated INT NOT NULL,"
+                  "DateActive INT NOT NULL,"  # Last known activity
+                  "Name TEXT,"
+                  "Username TEXT,"
+                  "Phone TEXT,"
+                  "PRIMARY KEY (ID)) WITHOUT ROWID")
+
+        c.execute("CREATE TABLE IF NOT EXISTS DialogTrigram("
+                  "Trigram TEXT NOT NULL,"
+                  "DialogID INT NOT NULL,"
+                  "PRIMARY KEY (Trigram, DialogID)) WITHOUT ROWID")
+
+        # Used to replace the trigrams of a dialog when it changes
+        c.execute("CREATE INDEX IF NOT EXISTS DialogTrigramDialog "
+                  "ON DialogTrigram(DialogID)")
+
+    def _create_entity_cache(self):
+        """
+        Creates the tables used to cache the entities resolved from their
+        marked IDs, usernames or phone numbers, so they need not be
+        fetched from Telegram on every run.
         """
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS EntityCache("
+                  "ID INT NOT NULL,"  # Marked ID
+                  "DateUpdated INT NOT NULL,"
+                  "Entity BLOB NOT NULL,"  # Serialized User, Chat or Channel
+                  "PRIMARY KEY (ID)) WITHOUT ROWID")
+
+        c.execute("CREATE TABLE IF NOT EXISTS ResolveCache("
+                  "Key TEXT NOT NULL,"  # See utils.get_resolve_key
+                  "ID INT NOT NULL,"
+                  "PRIMARY KEY (Key)) WITHOUT ROWID")
+
+    def _create_message_deletion(self, conn=None):
+        """
+        Creates the table to keep track of the messages known to have
+        been deleted, which are otherwise kept as they were.
+        """
+        (conn or self.conn).execute(
+            "CREATE TABLE IF NOT EXISTS MessageDeletion("
+            "ContextID INT NOT NULL,"
+            "ID INT NOT NULL,"
+            "DateDeleted INT NOT NULL,"
+            "PRIMARY KEY (ContextID, ID)) WITHOUT ROWID")
+
+    def _create_schedule(self):
+        """
+        Creates the table with the state of every dialog exported
+        continuously by the scheduler (see scheduler.py).
+        """
+        self.conn.execute("CREATE TABLE IF NOT EXISTS Schedule("
+                          "ContextID INT NOT NULL,"
+                          "NextCheck INT NOT NULL,"
+                          "LastCheck INT,"
+                          "Rate REAL NOT NULL,"  # Messages per second
+                          "PRIMARY KEY (ContextID)) WITHOUT ROWID")
+
+    def _create_compression_dicts(self):
+        """
+        Creates the table with the dictionaries used to compress the
+        large columns (see compression.py).
+        """
+        self.conn.execute("CREATE TABLE IF NOT EXISTS CompressionDict("
+                          "ID INTEGER PRIMARY KEY,"
+                          "DateCreated INT NOT NULL,"
+                          "Data BLOB NOT NULL)")
+
+    def _create_shard_catalog(self):
+        """
+        Creates the tables saying whether the database is the catalog of
+        a sharded database (and how), and the shard of every context.
+        """
+        self.conn.execute("CREATE TABLE IF NOT EXISTS Sharding("
+                          "Buckets INT NOT NULL)")  # 0 for one per context
+        self.conn.execute("CREATE TABLE IF NOT EXISTS Shard("
+                          "ContextID INT NOT NULL,"
+                          "Key INT NOT NULL,"
+                          "PRIMARY KEY (ContextID)) WITHOUT ROWID")
+
+    def _create_merge_sources(self):
+        """
+        Creates the tables recording the databases merged into this one
+        (see merge.py) and what came from each, and the index used to
+        find the media which is already in the database.
+        """
+        c = self.conn.cursor()
+        c.execute("CREATE INDEX IF NOT EXISTS MediaFile "
+                  "ON Media(LocalID, VolumeID, Secret)")
+
+        # The media and forwards of a source have their ID plus the
+        # offset, except for the media which was already here
+        c.execute("CREATE TABLE IF NOT EXISTS MergeSource("
+                  "ID INTEGER PRIMARY KEY,"
+                  "FileName TEXT NOT NULL,"
+                  "SelfID INT,"
+                  "DateMerged INT NOT NULL,"
+                  "MediaOffset INT NOT NULL,"
+                  "ForwardOffset INT NOT NULL)")
+
+        c.execute("CREATE TABLE IF NOT EXISTS MergedMedia("
+                  "SourceID INT NOT NULL,"
+                  "OldID INT NOT NULL,"
+                  "NewID INT NOT NULL,"
+                  "PRIMARY KEY (SourceID, OldID)) WITHOUT ROWID")
+
+        # The private contexts of other accounts have IDs of their own,
+        # so SourceContextID is the ID they had in the source
+        c.execute("CREATE TABLE IF NOT EXISTS MergedContext("
+                  "ContextID INT NOT NULL,"
+                  "SourceID INT NOT NULL,"
+                  "SourceContextID INT,"
+                  "PRIMARY KEY (ContextID, SourceID)) WITHOUT ROWID")
+
+    def _add_source_context_ids(self):
+        """
+        Adds the ID that the merged contexts had in their source, which
+        is the same as theirs for the contexts merged before it existed.
+        """
+        columns = {row[1] for row in self.conn.execute(
+            "PRAGMA table_info(MergedContext)")}
+        if 'SourceContextID' not in columns:
+            self.conn.execute("ALTER TABLE MergedContext "
+                              "ADD COLUMN SourceContextID INT")
+            self.conn.execute("UPDATE MergedContext "
+                              "SET SourceContextID = ContextID")
+
+    def _encode_formatting(self, batch_size=10000):
+        """
+        Converts the formatting of the messages from the old text
+        encoding to the binary one (see utils.encode_msg_entities).
+
+        The messages are converted in batches, seeking by their primary
+        key, so no batch needs to scan the messages converted before.
+        """
+        last = (float('-inf'), float('-inf'))
+        while True:
+            rows = self.conn.execute(
+                "SELECT ID, ContextID, Formatting FROM Message "
+                "WHERE (ID, ContextID) > (?, ?) "
+                "AND typeof(Formatting) = 'text' "
+                "ORDER BY ID, ContextID LIMIT ?", (*last, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            self.conn.executemany(
+                "UPDATE Message SET Formatting = ? "
+                "WHERE ID = ? AND ContextID = ?",
+                ((utils.encode_msg_entities(
+                    utils.decode_msg_entities(formatting)), id, context_id)
+                 for id, context_id, formatting in rows)
+            )
+            last = rows[-1][:2]
+
+    def _create_search_index(self, conn=None):
+        """
+        Creates the (optional) tables used for full-text search over the
+        text of the messages, if they don't exist yet.
+
+        FTS5 tables need a rowid but Message has none, so MessageSearchID
+        maps every (ContextID, ID) to the rowid used in MessageSearch.
+        """
+        c = (conn or self.conn).cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS MessageSearchID("
+                  "RowID INTEGER PRIMARY KEY,"
+                  "ContextID INT NOT NULL,"
+                  "ID INT NOT NULL,"
+                  "UNIQUE (ContextID, ID))")
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS MessageSearch "
+                  "USING fts5(Message)")
+
+    def rebuild_search_index(self):
+        """
+        (Re)builds the full-text search index from all the messages
+        already in the database, in bulk. The index will be kept
+        up to date afterwards if FullTextSearch is enabled.
+        """
+        count = 0
+        for conn in self.iter_context_conns():
+            self._create_search_index(conn)
+            c = conn.cursor()
+            c.execute("DELETE FROM MessageSearch")
+            c.execute("DELETE FROM MessageSearchID")
+            c.execute("INSERT INTO MessageSearchID (ContextID, ID) "
+                      "SELECT ContextID, ID FROM Message "
+                      "WHERE Message IS NOT NULL AND ServiceAction IS NULL")
+            c.execute("INSERT INTO MessageSearch (rowid, Message) "
+                      "SELECT s.RowID, m.Message FROM MessageSearchID s "
+                      "JOIN Message m "
+                      "ON m.ContextID = s.ContextID AND m.ID = s.ID")
+            c.execute("INSERT INTO MessageSearch (MessageSearch) "
+                      "VALUES ('optimize')")
+            conn.commit()
+            count += c.execute(
+                "SELECT COUNT(*) FROM MessageSearchID").fetchone()[0]
+        self.commit()
+        return count
+
+    def _index_message_text(self, context_id, msg_id, text):
+        """Adds or replaces the given message text in the search index"""
+        conn = self.context_conn(context_id)
+        c = self._count_changes(conn.execute(
+            "INSERT OR IGNORE INTO MessageSearchID (ContextID, ID) "
+            "VALUES (?, ?)", (context_id, msg_id)))
+        if c.rowcount:
+            rowid = c.lastrowid
+        else:
+            rowid = conn.execute(
+                "SELECT RowID FROM MessageSearchID "
+                "WHERE ContextID = ? AND ID = ?", (context_id, msg_id)
+            ).fetchone()[0]
+        self._count_changes(conn.execute(
+            "INSERT OR REPLACE INTO MessageSearch (rowid, Message) "
+            "VALUES (?, ?)", (rowid, text)))
+
+    def _unindex_message_text(self, context_id, msg_id):
+        """Removes the given message from the search index, if it's there"""
+        conn = self.context_conn(context_id, create=False)
+        if conn is None:
+            return
+        row = conn.execute("SELECT RowID FROM MessageSearchID "
+                           "WHERE ContextID = ? AND ID = ?",
+                           (context_id, msg_id)).fetchone()
+        if row:
+            self._count_changes(conn.execute(
+                "DELETE FROM MessageSearch WHERE rowid = ?", row))
+            self._count_changes(conn.execute(
+                "DELETE FROM MessageSearchID WHERE RowID = ?", row))
 
     def check_self_user(self, self_id):
         """
@@ -247,6 +679,14 @@ class Dumper:
         if not message.message and message.media:
             message.message = getattr(message.media, 'caption', '')
 
+        if self.full_text_search:
+            if message.message:
+                self._index_message_text(context_id, message.id,
+                                         message.message)
+            else:  # It may have had text before being edited
+                self._unindex_message_text(context_id, message.id)
+
+        REGISTRY.inc('messages_total')
         return self._insert('Message',
                             (message.id,
                              context_id,
@@ -259,8 +699,8 @@ class Dumper:
                              message.views,
                              media_id,
                              utils.encode_msg_entities(message.entities),
-                             None)  # No MessageAction
-                           )
+                             None),  # No MessageAction
+                            conn=self.context_conn(context_id))
 
     def dump_message_service(self, message, context_id, media_id):
         """Similar to self.dump_message, but for MessageAction's."""
@@ -268,10 +708,9 @@ class Dumper:
         if not name:
             return
 
-        extra = message.action.to_dict()
-        del extra['_']  # We don't need to store the type, already have name
-        sanitize_dict(extra)
-        extra = json.dumps(extra)
+        # We don't need to store the type, already have name
+        extra = self._serialize_tl(message.action, keep_type=False)
+        REGISTRY.inc('messages_total')
         return self._insert('Message',
                             (message.id,
                              context_id,
@@ -284,8 +723,8 @@ class Dumper:
                              None,  # No views
                              media_id,  # Might have e.g. a new chat Photo
                              None,  # No entities
-                             name)
-                           )
+                             name),
+                            conn=self.context_conn(context_id))
 
     def dump_admin_log_event(self, event, context_id, media_id1, media_id2):
         """Similar to self.dump_message_service but for channel actions."""
@@ -293,10 +732,8 @@ class Dumper:
         if not name:
             return
 
-        extra = event.action.to_dict()
-        del extra['_']  # We don't need to store the type, already have name
-        sanitize_dict(extra)
-        extra = json.dumps(extra)
+        # We don't need to store the type, already have name
+        extra = self._serialize_tl(event.action, keep_type=False)
         return self._insert('AdminLog',
                             (event.id,
                              context_id,
@@ -305,14 +742,15 @@ class Dumper:
                              media_id1,
                              media_id2,
                              name,
-                             extra)
-                           )
+                             extra),
+                            conn=self.context_conn(context_id))
 
     def dump_user(self, user_full, photo_id, timestamp=None):
         """Dump a UserFull into the User table
         Params: UserFull to dump, MediaID of the profile photo in the DB
         Returns -, or False if not added"""
         # Rationale for UserFull rather than User is to get bio
+        REGISTRY.inc('entities_total', type='user')
         values = (user_full.user.id,
                   timestamp or round(time.time()),
                   user_full.user.first_name,
@@ -331,6 +769,7 @@ class Dumper:
         Params: ChannelFull, Channel to dump, MediaID of the profile photo in the DB
         Returns -"""
         # Need to get the full object too for 'about' info
+        REGISTRY.inc('entities_total', type='channel')
         values = (get_peer_id(channel),
                   timestamp or round(time.time()),
                   channel_full.about,
@@ -346,6 +785,7 @@ class Dumper:
         Params: ChannelFull, Channel to dump, MediaID of the profile photo in the DB
         Returns -"""
         # Need to get the full object too for 'about' info
+        REGISTRY.inc('entities_total', type='supergroup')
         values = (get_peer_id(supergroup),
                   timestamp or round(time.time()),
                   supergroup_full.about if hasattr(supergroup_full, 'about') else '',
@@ -365,6 +805,7 @@ class Dumper:
         else:
             migrated_to_id = None
 
+        REGISTRY.inc('entities_total', type='chat')
         values = (get_peer_id(chat),
                   timestamp or round(time.time()),
                   chat.title,
@@ -379,7 +820,7 @@ class Dumper:
         and the current input user IDs.
         """
         ids = set(ids)
-        c = self.conn.cursor()
+        c = self.context_conn(context_id).cursor()
         c.execute('SELECT Added, Removed FROM ChatParticipants '
                   'WHERE ContextID = ? ORDER BY DateUpdated ASC',
                   (context_id,))
@@ -400,14 +841,32 @@ class Dumper:
             added = ids - last_ids
             removed = last_ids - ids
 
-        c.execute("INSERT INTO ChatParticipants VALUES (?, ?, ?, ?)", (
-            context_id,
-            round(time.time()),
-            ','.join(str(x) for x in added),
-            ','.join(str(x) for x in removed)
-        ))
+        self._count_changes(c.execute(
+            "INSERT INTO ChatParticipants VALUES (?, ?, ?, ?)", (
+                context_id,
+                round(time.time()),
+                ','.join(str(x) for x in added),
+                ','.join(str(x) for x in removed)
+            )))
         return added, removed
 
+    def _serialize_tl(self, obj, keep_type=True):
+        """
+        Serializes the TLObject for the Extra or Data columns, as its raw
+        bytes if StoreRawTL is enabled, or else as JSON (without the '_'
+        with the name of its type unless keep_type is set), compressed
+        if ColumnCompression is enabled. Either way, the formatters give
+        it back decompressed and utils.tl_data_to_dict returns its dict.
+        """
+        with PROFILER.phase('serialize'):
+            if self.store_raw_tl:
+                return self.compressor.compress(bytes(obj))
+            extra = obj.to_dict()
+            if not keep_type:
+                del extra['_']
+            utils.sanitize_dict(extra)
+            return self.compressor.compress(json.dumps(extra))
+
     def dump_media(self, media, media_type=None):
         """Dump a MessageMedia into the Media table
         Params: media Telethon object
@@ -420,9 +879,8 @@ class Dumper:
             'local_id', 'volume_id', 'secret'
         )}
         row['type'] = media_type
-        row['extra'] = media.to_dict()
-        sanitize_dict(row['extra'])
-        row['extra'] = json.dumps(row['extra'])
+        # Only serialized once we know the media isn't a duplicate
+        original = media
 
         if isinstance(media, types.MessageMediaContact):
             row['type'] = 'contact'
@@ -563,12 +1021,13 @@ class Dumper:
             if existing_row:
                 return existing_row[0]
 
+            REGISTRY.inc('media_total', type=row['type'])
             return self._insert('Media', (
                 None,
                 row['name'], row['mime_type'], row['size'],
                 row['thumbnail_id'], row['type'],
                 row['local_id'], row['volume_id'], row['secret'],
-                row['extra']
+                self._serialize_tl(original)
             ))
 
     def dump_forward(self, forward):
@@ -586,13 +1045,201 @@ class Dumper:
                              forward.channel_post,
                              forward.post_author))
 
+    def dump_dialog(self, entity, date_active=None, timestamp=None):
+        """
+        Adds or updates the given User, Chat or Channel in the catalog of
+        dialogs, updating its trigram index only if the name, username
+        or phone changed. date_active defaults to the previous one.
+        """
+        dialog_id = get_peer_id(entity)
+        values = (get_display_name(entity),
+                  getattr(entity, 'username', None),
+                  getattr(entity, 'phone', None))
+        if isinstance(date_active, datetime):
+            date_active = int(date_active.timestamp())
+
+        c = self.conn.cursor()
+        row = c.execute("SELECT Name, Username, Phone, DateActive "
+                        "FROM Dialog WHERE ID = ?", (dialog_id,)).fetchone()
+        timestamp = timestamp or round(time.time())
+        self._insert('Dialog', (dialog_id, timestamp,
+                                date_active or (row[3] if row else 0))
+                     + values)
+        if row and tuple(row[:3]) == values:
+            return
+
+        if row:
+            self._count_changes(c.execute(
+                "DELETE FROM DialogTrigram WHERE DialogID = ?", (dialog_id,)))
+        self._count_changes(c.executemany(
+            "INSERT INTO DialogTrigram VALUES (?, ?)", (
+                (trigram, dialog_id) for trigram in
+                set.union(*(utils.trigrams(value) for value in values))
+            )))
+
+    def get_dialog_candidates(self, query, limit=100):
+        """
+        Returns up to limit rows of (ID, Name, Username, Phone) from the
+        catalog of dialogs sharing the most trigrams with the query,
+        ordered from the least to the most recently active. Queries too
+        short to be selective return all the dialogs instead.
+        """
+        trigrams = list(utils.trigrams(query))
+        if len(query.strip()) < 3 or not trigrams:
+            return self.conn.execute(
+                "SELECT ID, Name, Username, Phone FROM Dialog "
+                "ORDER BY DateActive ASC").fetchall()
+
+        return self.conn.execute(
+            "SELECT d.ID, d.Name, d.Username, d.Phone FROM Dialog d JOIN ("
+            "  SELECT DialogID, COUNT(*) AS Hits FROM DialogTrigram "
+            "  WHERE Trigram IN ({}) GROUP BY DialogID "
+            "  ORDER BY Hits DESC LIMIT ?"
+            ") t ON t.DialogID = d.ID ORDER BY d.DateActive ASC"
+            .format(','.join('?' * len(trigrams))), trigrams + [limit]
+        ).fetchall()
+
+    def get_dialog_count(self):
+        """Gets the amount of dialogs in the catalog"""
+        return self.conn.execute("SELECT COUNT(*) FROM Dialog").fetchone()[0]
+
+    def cache_entity(self, entity, *keys, timestamp=None):
+        """
+        Saves the given User, Chat or Channel in the entity cache, which
+        can be looked up by its marked ID, username, phone number and
+        any other given keys (as returned by utils.get_resolve_key).
+        """
+        entity_id = get_peer_id(entity)
+        keys = set(keys)
+        keys.add(utils.get_resolve_key(entity_id))
+        if getattr(entity, 'username', None):
+            keys.add(utils.get_resolve_key('@' + entity.username))
+        if getattr(entity, 'phone', None):
+            keys.add(utils.get_resolve_key('+' + entity.phone))
+        keys.discard(None)
+
+        self._insert('EntityCache', (entity_id, timestamp or round(time.time()),
+                                     bytes(entity)))
+        self._count_changes(self.conn.executemany(
+            "INSERT OR REPLACE INTO ResolveCache VALUES (?, ?)",
+            ((key, entity_id) for key in keys)))
+
+    def get_cached_entity(self, key, max_age=None):
+        """
+        Returns the entity cached under the given key (as returned by
+        utils.get_resolve_key), or None if it's not cached or was cached
+        more than max_age seconds ago.
+        """
+        row = self.conn.execute(
+            "SELECT e.Entity, e.DateUpdated FROM ResolveCache r "
+            "JOIN EntityCache e ON e.ID = r.ID WHERE r.Key = ?", (key,)
+        ).fetchone()
+        if not row or (max_age is not None
+                       and time.time() - row[1] > max_age):
+            return None
+        return BinaryReader(row[0]).tgread_object()
+
+    def dump_deleted_messages(self, ids, context_id=None, timestamp=None):
+        """
+        Marks the given message IDs as deleted. If no context ID is
+        given (Telegram doesn't tell for those out of channels), the
+        contexts of the dumped messages with these IDs are used, and
+        messages never dumped are ignored.
+        """
+        timestamp = timestamp or round(time.time())
+        if context_id is not None:
+            self._count_changes(self.context_conn(context_id).executemany(
+                "INSERT OR IGNORE INTO MessageDeletion VALUES (?, ?, ?)",
+                ((context_id, msg_id, timestamp) for msg_id in ids)
+            ))
+            return
+
+        ids = list(ids)
+        # Only private chats and small groups share the same IDs, so the
+        # shards with nothing but channels don't need to be opened.
+        for conn in self.iter_context_conns(SHARED_IDS_MIN_CONTEXT):
+            # Queried in batches to stay below SQLite's variable limit
+            for start in range(0, len(ids), MAX_QUERY_VARIABLES):
+                batch = ids[start:start + MAX_QUERY_VARIABLES]
+                rows = conn.execute(
+                    "SELECT ContextID, ID FROM Message WHERE ID IN ({}) "
+                    "AND ContextID > ?".format(','.join('?' * len(batch))),
+                    batch + [SHARED_IDS_MIN_CONTEXT]
+                ).fetchall()
+                self._count_changes(conn.executemany(
+                    "INSERT OR IGNORE INTO MessageDeletion VALUES (?, ?, ?)",
+                    ((cid, msg_id, timestamp) for cid, msg_id in rows)
+                ))
+
+    def get_activity(self, context_id, since):
+        """
+        Returns (message count since the given timestamp, date of the
+        last message) for the given context. The date is None if there
+        are no messages.
+        """
+        conn = self.context_conn(context_id, create=False)
+        if conn is None:
+            return 0, None
+        count = conn.execute(
+            "SELECT COUNT(*) FROM Message WHERE ContextID = ? AND Date >= ?",
+            (context_id, since)
+        ).fetchone()[0]
+        last_date = conn.execute(
+            "SELECT MAX(Date) FROM Message WHERE ContextID = ?", (context_id,)
+        ).fetchone()[0]
+        return count, last_date
+
+    def get_schedule(self):
+        """
+        Returns rows of (ContextID, NextCheck, LastCheck, Rate, Name) of
+        the scheduled dialogs, with the ones due first.
+        """
+        return self.conn.execute(
+            "SELECT s.ContextID, s.NextCheck, s.LastCheck, s.Rate, d.Name "
+            "FROM Schedule s LEFT JOIN Dialog d ON d.ID = s.ContextID "
+            "ORDER BY s.NextCheck ASC"
+        ).fetchall()
+
+    def save_schedule(self, context_id, next_check, last_check, rate):
+        """Saves the scheduling state of the given context"""
+        self._insert('Schedule', (context_id, next_check, last_check, rate))
+
+    def delete_schedule(self, context_id):
+        """Stops scheduling the given context"""
+        self._count_changes(self.conn.execute(
+            "DELETE FROM Schedule WHERE ContextID = ?", (context_id,)))
+
+    def spill_entity(self, owner, entity):
+        """
+        Saves a pending entity of the given owner (any integer) to be
+        dumped later, to avoid keeping it in memory.
+        """
+        self.conn.execute("INSERT INTO PendingEntity (Owner, Entity) "
+                          "VALUES (?, ?)", (owner, bytes(entity)))
+
+    def unspill_entities(self, owner, limit):
+        """
+        Removes and returns up to limit of the oldest pending entities
+        saved with spill_entity by the given owner.
+        """
+        rows = self.conn.execute(
+            "SELECT Seq, Entity FROM PendingEntity WHERE Owner = ? "
+            "ORDER BY Seq LIMIT ?", (owner, limit)).fetchall()
+        if rows:
+            self.conn.execute("DELETE FROM PendingEntity WHERE Owner = ? "
+                              "AND Seq <= ?", (owner, rows[-1][0]))
+        return [BinaryReader(row[1]).tgread_object() for row in rows]
+
     def get_message_id(self, context_id, which):
         """Returns MAX or MIN message available for context_id.
         Used to determine at which point a backup should stop."""
         if which not in ('MIN', 'MAX'):
             raise ValueError('Parameter', which, 'must be MIN or MAX.')
 
-        return self.conn.execute(
+        conn = self.context_conn(context_id, create=False)
+        if conn is None:
+            return None
+        return conn.execute(
             """SELECT * FROM Message WHERE ID = (
                     SELECT {which}(ID) FROM Message
                     WHERE ContextID = ?
@@ -600,9 +1247,25 @@ class Dumper:
             """.format(which=which), (context_id,)).fetchone()[0]
         # May raise if nothing was retrieved
 
+    def get_forward_id(self, context_id, msg_id):
+        """
+        Returns the ID of the forward of the given dumped message, or
+        None if it was not dumped or isn't forwarded.
+        """
+        conn = self.context_conn(context_id, create=False)
+        if conn is None:
+            return None
+        row = conn.execute(
+            "SELECT ForwardID FROM Message WHERE ContextID = ? AND ID = ?",
+            (context_id, msg_id)).fetchone()
+        return row[0] if row else None
+
     def get_message_count(self, context_id):
         """Gets the message count for the given context"""
-        tuple_ = self.conn.execute(
+        conn = self.context_conn(context_id, create=False)
+        if conn is None:
+            return 0
+        tuple_ = conn.execute(
             "SELECT COUNT(*) FROM MESSAGE WHERE ContextID = ?", (context_id,)
         ).fetchone()
         return tuple_[0] if tuple_ else 0
@@ -627,8 +1290,12 @@ class Dumper:
         ID and offset date from which to continue, as well as at which ID
         to stop.
         """
-        c = self.conn.execute("SELECT ID, Date, StopAt FROM Resume WHERE "
-                              "ContextID = ?", (context_id,))
+        conn = self.context_conn(context_id, create=False)
+        if conn is None:
+            return 0, 0, 0
+        c = conn.execute(
+            "SELECT ID, Date, StopAt FROM Resume WHERE ContextID = ?",
+            (context_id,))
         return c.fetchone() or (0, 0, 0)
 
     def save_resume(self, context_id, msg=0, msg_date=0, stop_at=0):
@@ -638,7 +1305,8 @@ class Dumper:
         if isinstance(msg_date, datetime):
             msg_date = int(msg_date.timestamp())
 
-        return self._insert('Resume', (context_id, msg, msg_date, stop_at))
+        return self._insert('Resume', (context_id, msg, msg_date, stop_at),
+                            conn=self.context_conn(context_id))
 
     def _insert_if_valid_date(self, into, values, date_column, where):
         """
@@ -666,23 +1334,68 @@ class Dumper:
                 return False
         return self._insert(into, values)
 
-    def _insert(self, into, values):
+    def _insert(self, into, values, conn=None):
         """
-        Helper method to insert or replace the
-        given tuple of values into the given table.
+        Helper method to insert or replace the given tuple of values
+        into the given table, of the given connection or the catalog.
         """
+        conn = conn or self.conn
         try:
             fmt = ','.join('?' * len(values))
-            c = self.conn.execute("INSERT OR REPLACE INTO {} VALUES ({})"
-                                  .format(into, fmt), values)
+            with PROFILER.phase('insert'):
+                c = conn.execute("INSERT OR REPLACE INTO {} VALUES ({})"
+                                 .format(into, fmt), values)
+            self._uncommitted_rows += 1
             return c.lastrowid
         except sqlite3.IntegrityError as error:
-            self.conn.rollback()
+            conn.rollback()
             logger.error("Integrity error: %s", str(error))
             raise
 
+    def _count_changes(self, cursor):
+        """
+        Counts the rows changed by the statement ran on the given cursor
+        (other than by ``_insert``) as uncommitted, and returns it.
+        """
+        self._uncommitted_rows += max(cursor.rowcount, 0)
+        return cursor
+
     def commit(self):
         """
         Commits the changes made to the database to persist on disk.
         """
-        self.conn.commit()
+        start = time.time()
+        with PROFILER.phase('commit'):
+            self.conn.commit()
+            if self.shard_pool:
+                for conn in self.shard_pool.open_conns():
+                    conn.commit()
+        self._last_commit = time.time()
+        self._uncommitted_rows = 0
+        REGISTRY.observe('commit_seconds', self._last_commit - start)
+
+    def maybe_commit(self):
+        """
+        Commits the changes if commit_interval seconds have passed since
+        the last commit or at least commit_rows rows were written, and
+        returns whether it did. The changes are committed anyway by the
+        next commit().
+
+        Callers should only call this once everything needed to resume
+        (e.g. the Resume row for the messages dumped) has been saved, so
+        that the changes are only committed together.
+        """
+        if time.time() - self._last_commit < self.commit_interval and \
+                self._uncommitted_rows < self.commit_rows:
+            return False
+        self.commit()
+        return True
+
+    def close(self):
+        """
+        Closes the database (and its shards, if any). Anything not
+        committed yet is lost.
+        """
+        if self.shard_pool:
+            self.shard_pool.close()
+        self.conn.close()
@@ -4,6 +4,8 @@ Formatter's to take exported database data and display in a variety of formats.
 from .baseformatter import BaseFormatter
 from .textformatter import TextFormatter
 from .htmlformatter import HtmlFormatter
+from .jsonformatter import JsonFormatter
+from .columnarformatter import ColumnarFormatter
 
 
 # Create a map between the name of available formatter and their classes
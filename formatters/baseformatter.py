@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 """Utility to extract data from a telegram-export database"""
+import base64
 import datetime
+import gzip
+import io
+import json
 import math
 import sqlite3
 import sys
@@ -13,6 +17,40 @@ import os
 from telethon import utils
 from telethon.tl import types
 
+import shards
+from compression import ColumnCompressor
+from shards import ShardPool
+from sqltrace import TRACER
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Size of the buffer used for the output files, in bytes
+BUFFER_SIZE = 1024 * 1024
+
+# Amount of rendered messages joined together for every write call
+RENDER_BATCH_SIZE = 1000
+
+# Amount of messages fetched at once when iterating over a whole context
+ITER_PAGE_SIZE = 500
+
+# Pragmas for the read-only connections opened by the formatters, like
+# those of the 'balanced' durability of the Dumper: a big page cache,
+# memory-mapped reads and temporary tables (e.g. to sort) in memory
+READ_PRAGMAS = (
+    ('cache_size', -64 * 1024),  # In KiB
+    ('mmap_size', 256 * 2**20),
+    ('temp_store', 'MEMORY'),
+)
+
+COMPRESSION_TO_EXTENSION = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
 Message = namedtuple('Message', (
     'id', 'context_id', 'date', 'from_id', 'text', 'reply_message_id',
     'forward_id', 'post_author', 'view_count', 'media_id', 'formatting', 'out',
@@ -47,15 +85,36 @@ Media = namedtuple('Media', (
     'volume_id', 'secret', 'extra'
 ))
 
+Forward = namedtuple('Forward', (
+    'id', 'original_date', 'from_id', 'channel_post', 'post_author'
+))
+
+SearchResult = namedtuple('SearchResult', (
+    'context_id', 'id', 'date', 'from_id', 'snippet', 'rank'
+))
+
 
 class BaseFormatter:
     """
     A class to extract data from a given telegram-export database in the form
     of named tuples.
+
+    Files opened by ``format`` are written through a large buffer of
+    buffer_size bytes, and compressed if a compression ('gzip' or 'zstd')
+    is given. Subclasses may set ``extension`` for the files they output.
     """
-    def __init__(self, db):
+    extension = ''
+
+    def __init__(self, db, compression=None, buffer_size=BUFFER_SIZE):
+        if compression not in COMPRESSION_TO_EXTENSION:
+            raise ValueError('Unknown compression {}'.format(compression))
+        if compression == 'zstd' and not zstandard:
+            raise ValueError('zstd compression requires zstandard installed')
+        self.compression = compression
+        self.buffer_size = buffer_size
+
         if isinstance(db, str):
-            self.dbconn = sqlite3.connect('file:{}?mode=ro'.format(db), uri=True)
+            self.dbconn = self._connect_read_only(db)
         elif isinstance(db, sqlite3.Connection):
             self.dbconn = db
         else:
@@ -63,6 +122,55 @@ class BaseFormatter:
 
         self.our_userid = self.dbconn.execute(
             "SELECT UserID FROM SelfInformation").fetchone()[0]
+        # Only used to decompress the values of compressed columns
+        self.compressor = ColumnCompressor(self.dbconn)
+
+        # The messages of sharded databases are read from their shards
+        self.shard_buckets = shards.get_buckets(self.dbconn)
+        if self.shard_buckets is None:
+            self.shard_pool = None
+        else:
+            self.shard_pool = ShardPool(shards.get_directory(self.dbconn),
+                                        self.shard_buckets, self._connect_shard)
+
+    @staticmethod
+    def _connect_read_only(filename):
+        """Opens the given database file to be read, tuned for reading"""
+        conn = TRACER.connect('file:{}?mode=ro'.format(filename), uri=True)
+        for pragma, value in READ_PRAGMAS:
+            conn.execute('PRAGMA {} = {}'.format(pragma, value))
+        return conn
+
+    def _connect_shard(self, filename):
+        """Opens the given shard, or returns None if it doesn't exist"""
+        if not os.path.isfile(filename):
+            return None
+        return self._connect_read_only(filename)
+
+    def context_conn(self, context_id):
+        """
+        Returns the connection to read the messages of the given context
+        from, which is its shard if the database is sharded. Contexts
+        without a shard are read from the catalog, which has no messages.
+        """
+        if not self.shard_pool:
+            return self.dbconn
+        return self.shard_pool.get(context_id) or self.dbconn
+
+    def iter_context_conns(self):
+        """
+        Yields the connection to every database with messages, which are
+        all the shards if the database is sharded. Only the last one
+        yielded is guaranteed to remain open.
+        """
+        if not self.shard_pool:
+            yield self.dbconn
+            return
+        for key, in self.dbconn.execute(
+                "SELECT DISTINCT Key FROM Shard").fetchall():
+            conn = self.shard_pool.get_shard(key)
+            if conn is not None:
+                yield conn
 
     @staticmethod
     @abstractmethod
@@ -186,8 +294,11 @@ class BaseFormatter:
             file = sys.stdout
         elif isinstance(file, (str, Path)):
             if os.path.isdir(file):
-                file = os.path.join(file, str(target))
-            file = open(file, 'w')
+                file = os.path.join(file, '{}{}{}'.format(
+                    getattr(target, 'id', target), self.extension,
+                    COMPRESSION_TO_EXTENSION[self.compression]
+                ))
+            file = self.open_output(file)
         elif not isinstance(file, TextIOWrapper):  # Is there a better way?
             raise TypeError(
                 "Supplied file {} could not be interpreted as a file"
@@ -202,13 +313,57 @@ class BaseFormatter:
 
         raise TypeError("target should be a context ID or context namedtuple")
 
+    def open_output(self, filename, newline=None):
+        """
+        Opens the given filename for writing text through a buffer of
+        self.buffer_size bytes, compressing it with self.compression.
+        Line endings are translated as open() does with newline.
+        """
+        if self.compression == 'gzip':
+            raw = gzip.GzipFile(filename, 'wb')
+        elif self.compression == 'zstd':
+            raw = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+        else:
+            return open(filename, 'w', encoding='utf-8',
+                        buffering=self.buffer_size, newline=newline)
+
+        return TextIOWrapper(io.BufferedWriter(raw, self.buffer_size),
+                             encoding='utf-8', newline=newline)
+
+    @staticmethod
+    def write_lines(file, lines, batch_size=RENDER_BATCH_SIZE):
+        """
+        Writes the given iterable of lines to file, joining up to
+        batch_size of them with newlines for every write call.
+        """
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                batch.append('')
+                file.write('\n'.join(batch))
+                batch.clear()
+        if batch:
+            batch.append('')
+            file.write('\n'.join(batch))
+
+    def format_all(self, directory):
+        """
+        Formats every available context into the given directory. The
+        default implementation writes one file per context named after
+        its ID, but formatters producing more than a single file per
+        context (such as a website) may override it.
+        """
+        for context_id in self.iter_context_ids():
+            self.format(context_id, directory)
+
     @abstractmethod
     def _format(self, context_id, file, *args, **kwargs):
         """
         An abstract method that should be implemented by formatters
         Context ID will always be a Bot API style ID. File will always be
         something like a file object or sys.stdout, suitable for usage with
-        print(file=file).
+        print(file=file), although ``write_lines`` should be preferred.
         """
         # TODO provide a way to format many targets into one directory with one
         # method, and a format syntax to specify the name scheme of the output files.
@@ -225,29 +380,139 @@ class BaseFormatter:
         *must* be in the Bot API format where Channel/Supergroup IDs start with
         -100 and old-style Chat IDs start with -.
         """
-        start_date, end_date = self.get_timestamp(start_date), self.get_timestamp(end_date)
+        cursor = None
+        while True:
+            messages, cursor = self.get_messages_page(
+                context_id, limit=ITER_PAGE_SIZE, cursor=cursor, order=order,
+                start_date=start_date, end_date=end_date,
+                from_user_id=from_user_id, include_service=include_service
+            )
+            yield from messages
+            if not cursor:
+                return
+
+    @staticmethod
+    def _encode_cursor(order, date, msg_id):
+        """Encodes the position after (date, msg_id) as an opaque token"""
+        return base64.urlsafe_b64encode(json.dumps(
+            [order, date, msg_id]).encode('ascii')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """Reverses ``_encode_cursor``, raising ValueError if invalid"""
+        try:
+            order, date, msg_id = json.loads(
+                base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii'))
+        except (TypeError, ValueError, UnicodeError) as e:
+            raise ValueError('Invalid cursor {!r}'.format(cursor)) from e
+        return order, date, msg_id
+
+    def get_messages_page(self, context_id, limit=50, cursor=None,
+                          offset_date=None, offset_id=None, order='ASC',
+                          start_date=None, end_date=None, from_user_id=None,
+                          include_service=True):
+        """
+        Return a tuple consisting of a list with up to limit Messages from
+        a context, and an opaque cursor to fetch the next page (or ``None``
+        if there are no more messages).
+
+        The page starts right after the given cursor or, if there is none,
+        after (offset_date, offset_id), which can be used to seek anywhere
+        in the context. If offset_id is given but offset_date is not, the
+        page starts at the message with that ID (inclusive). Order should
+        be ASC or DESC, and the other arguments filter the messages like
+        they do in ``get_messages_from_context``.
+
+        Pages are fetched by seeking the (ContextID, Date, ID) index, so
+        it takes the same time to fetch any page regardless of its offset.
+        """
+        order = order.upper()
+        if order not in ('ASC', 'DESC'):
+            raise ValueError('Order must be ASC or DESC, not {}'.format(order))
+        if limit < 1:
+            raise ValueError('The limit must be at least 1')
+
+        inclusive = False
+        if cursor:
+            cursor_order, offset_date, offset_id = self._decode_cursor(cursor)
+            if cursor_order != order:
+                raise ValueError('The cursor was made for {} order, not {}'
+                                 .format(cursor_order, order))
+        elif offset_id is not None and offset_date is None:
+            row = self.context_conn(context_id).execute(
+                "SELECT Date FROM Message WHERE ContextID = ? AND ID = ?",
+                (context_id, offset_id)
+            ).fetchone()
+            if not row:
+                return [], None
+            offset_date = row[0]
+            inclusive = True
+        else:
+            offset_date = self.get_timestamp(offset_date)
+
+        start_date = self.get_timestamp(start_date)
+        end_date = self.get_timestamp(end_date)
         where, params = self._build_query(
             ('ContextID = ?', context_id),
             ('Date > ?', start_date),
             ('Date < ?', end_date),
             ('FromID = ?', from_user_id)
         )
-
-        cur = self.dbconn.cursor()
-        exclude_service = '' if include_service else ' AND ServiceAction is null'
+        if not include_service:
+            where += ' AND ServiceAction IS NULL'
+        if offset_date is not None:
+            if offset_id is None:
+                # Only a date was given, so start at that date (inclusive)
+                offset_id = -1 if order == 'ASC' else 2 ** 63 - 1
+            where += ' AND (Date, ID) {}{} (?, ?)'.format(
+                '>' if order == 'ASC' else '<', '=' if inclusive else '')
+            params += (offset_date, offset_id)
+
+        cur = self.context_conn(context_id).cursor()
         cur.execute(
             "SELECT ID, ContextID, Date, FromID, Message, ReplyMessageID, "
             "ForwardID, PostAuthor, ViewCount, MediaID, Formatting, ServiceAction"
-            " FROM Message {}{} ORDER BY Date {}".format(where, exclude_service,
-                                                         order.upper()),
-            params
+            " FROM Message {} ORDER BY Date {order}, ID {order} LIMIT ?"
+            .format(where, order=order), params + (limit + 1,)
         )
-        row = cur.fetchone()
-        while row:
-            yield self._message_from_row(row)
-            row = cur.fetchone()
-            if not row:
-                return
+        rows = cur.fetchmany(limit + 1)
+        if len(rows) > limit:
+            rows.pop()
+            cursor = self._encode_cursor(order, rows[-1][2], rows[-1][0])
+        else:
+            cursor = None
+
+        return [self._message_from_row(row) for row in rows], cursor
+
+    def get_messages_around(self, context_id, msg_id, limit=50):
+        """
+        Return a tuple consisting of a list with up to limit Messages
+        around the one with the given ID (included) in chronological
+        order, and cursors to fetch the page before (in DESC order)
+        and after it (in ASC order), which may be ``None``.
+        """
+        row = self.context_conn(context_id).execute(
+            "SELECT Date FROM Message WHERE ContextID = ? AND ID = ?",
+            (context_id, msg_id)
+        ).fetchone()
+        if not row:
+            return [], None, None
+
+        # The page before starts at (and includes) the message itself
+        before, before_cursor = self.get_messages_page(
+            context_id, limit=max(limit // 2, 1), offset_id=msg_id,
+            order='DESC'
+        )
+        if limit > len(before):
+            after, after_cursor = self.get_messages_page(
+                context_id, limit=limit - len(before), offset_date=row[0],
+                offset_id=msg_id, order='ASC'
+            )
+        else:
+            after, after_cursor = [], self._encode_cursor('ASC', row[0], msg_id)
+
+        before.reverse()
+        return before + after, before_cursor, after_cursor
 
     def _message_from_row(self, row):
         """
@@ -275,7 +540,7 @@ class BaseFormatter:
                        row[1], # ContextID
                        date,
                        row[3],  # FromID
-                       row[4],  # Text
+                       self.compressor.decompress(row[4]),  # Text
                        row[5],  # ReplyMessageID
                        row[6],  # ForwardID
                        row[7],  # PostAuthor
@@ -298,7 +563,7 @@ class BaseFormatter:
             ('ContextID = ?', context_id),
             ('ID = ?', msg_id)
         )
-        cur = self.dbconn.cursor()
+        cur = self.context_conn(context_id).cursor()
         cur.execute(
             "SELECT ID, ContextID, Date, FromID, Message, ReplyMessageID, "
             "ForwardID, PostAuthor, ViewCount, MediaID, Formatting, "
@@ -308,17 +573,62 @@ class BaseFormatter:
         if row:
             return self._message_from_row(row)
 
+    def get_message_count(self, context_id):
+        """Returns the amount of messages dumped from the given context"""
+        return self.context_conn(context_id).execute(
+            "SELECT COUNT(*) FROM Message WHERE ContextID = ?", (context_id,)
+        ).fetchone()[0]
+
+    def search_messages(self, query, context_id=None, from_user_id=None,
+                        start_date=None, end_date=None, limit=50):
+        """
+        Return a list of up to limit SearchResults for the messages matching
+        the given full-text query (in SQLite's FTS5 syntax), best matches
+        first. The results can be filtered like in get_messages_from_context.
+
+        The search index must have been built (see the FullTextSearch
+        option and ``Dumper.rebuild_search_index``), otherwise
+        sqlite3.OperationalError will be raised. Without a context, every
+        shard of sharded databases is searched, and their results merged
+        by their rank (which is only comparable between shards roughly).
+        """
+        start_date, end_date = self.get_timestamp(start_date), self.get_timestamp(end_date)
+        where, params = self._build_query(
+            ('MessageSearch MATCH ?', query),
+            ('m.ContextID = ?', context_id),
+            ('m.Date > ?', start_date),
+            ('m.Date < ?', end_date),
+            ('m.FromID = ?', from_user_id)
+        )
+        if context_id is None:
+            conns = self.iter_context_conns()
+        else:
+            conns = (self.context_conn(context_id),)
+
+        rows = []
+        for conn in conns:
+            rows.extend(conn.execute(
+                "SELECT m.ContextID, m.ID, m.Date, m.FromID, "
+                "snippet(MessageSearch, 0, '[', ']', '...', 12), rank "
+                "FROM MessageSearch "
+                "JOIN MessageSearchID s ON s.RowID = MessageSearch.rowid "
+                "JOIN Message m ON m.ContextID = s.ContextID AND m.ID = s.ID"
+                "{} ORDER BY rank LIMIT ?".format(where), params + (limit,)
+            ).fetchmany(limit))
+        rows.sort(key=lambda row: row[-1])
+        return [SearchResult(row[0], row[1],
+                             datetime.datetime.fromtimestamp(row[2]),
+                             *row[3:]) for row in rows[:limit]]
+
     def iter_context_ids(self):
         """
         Iterates over all the context IDs available. This method should
         be useful if one desires to format all the available conversations.
         """
-        cur = self.dbconn.cursor()
-        cur.execute('SELECT DISTINCT ContextID FROM Message')
-        row = cur.fetchone()
-        while row:
-            yield row[0]
-            row = cur.fetchone()
+        for conn in self.iter_context_conns():
+            # Fetched at once, since formatting may close the connection
+            yield from (row[0] for row in conn.execute(
+                'SELECT DISTINCT ContextID FROM Message').fetchall())
 
     def get_entity(self, context_id, at_date=None):
         """
@@ -425,7 +735,19 @@ class BaseFormatter:
         row = cur.fetchone()
         if not row:
             return None
-        return Media(*row)
+        return Media(*row[:-1], self.compressor.decompress(row[-1]))
+
+    def get_forward(self, fid):
+        """Return the Forward with given ID or return None."""
+        cur = self.dbconn.cursor()
+        cur.execute("SELECT ID, OriginalDate, FromID, ChannelPost, PostAuthor "
+                    "FROM Forward WHERE ID = ?", (fid,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        forward = Forward(*row)
+        return forward._replace(original_date=datetime.datetime.fromtimestamp(
+            forward.original_date))
 
 # if __name__ == '__main__':
     # main()
@@ -0,0 +1,280 @@
+"""
+A Formatter class to output columnar tables (Parquet, or CSV if
+pyarrow is not installed) of messages, users, media and forwards.
+"""
+import csv
+import json
+import os
+
+import utils
+from formatters import BaseFormatter
+from formatters.baseformatter import COMPRESSION_TO_EXTENSION
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+BATCH_SIZE = 65536
+
+# (column, type) for every table, in the same order as they are selected.
+# Dates are stored (and exported) as integer Unix timestamps
+MESSAGE_COLUMNS = (
+    ('ID', 'int64'), ('ContextID', 'int64'), ('Date', 'int64'),
+    ('FromID', 'int64'), ('Message', 'string'), ('ReplyMessageID', 'int64'),
+    ('ForwardID', 'int64'), ('PostAuthor', 'string'), ('ViewCount', 'int64'),
+    ('MediaID', 'int64'), ('Formatting', 'string'), ('ServiceAction', 'string')
+)
+USER_COLUMNS = (
+    ('ID', 'int64'), ('DateUpdated', 'int64'), ('FirstName', 'string'),
+    ('LastName', 'string'), ('Username', 'string'), ('Phone', 'string'),
+    ('Bio', 'string'), ('Bot', 'int64'), ('CommonChatsCount', 'int64'),
+    ('PictureID', 'int64')
+)
+MEDIA_COLUMNS = (
+    ('ID', 'int64'), ('Name', 'string'), ('MimeType', 'string'),
+    ('Size', 'int64'), ('ThumbnailID', 'int64'), ('Type', 'string'),
+    ('LocalID', 'int64'), ('VolumeID', 'int64'), ('Secret', 'int64'),
+    ('Extra', 'string')
+)
+FORWARD_COLUMNS = (
+    ('ID', 'int64'), ('OriginalDate', 'int64'), ('FromID', 'int64'),
+    ('ChannelPost', 'int64'), ('PostAuthor', 'string')
+)
+
+# Index of the (binary) Formatting column, exported as readable text,
+# and of the columns which may hold raw TL objects, exported as JSON
+FORMATTING_INDEX = 10
+MESSAGE_TEXT_INDEX = 4
+MEDIA_EXTRA_INDEX = 9
+
+
+def _tl_data_to_json(data, keep_type=True):
+    """Returns the JSON for raw TL objects, or data as-is otherwise"""
+    if isinstance(data, bytes):
+        return json.dumps(utils.tl_data_to_dict(data, keep_type))
+    return data
+
+
+def _decode_messages(rows, decompress):
+    """
+    Returns the message rows with their formatting as readable text,
+    and the (decompressed) actions of service messages as JSON.
+    """
+    # Many messages share the same formatting, decode it only once
+    texts = {}
+    for row in rows:
+        data = row[FORMATTING_INDEX]
+        if data and data not in texts:
+            texts[data] = utils.msg_entities_to_text(
+                utils.decode_msg_entities(data))
+    return [
+        row[:MESSAGE_TEXT_INDEX]
+        + (_tl_data_to_json(decompress(row[MESSAGE_TEXT_INDEX]),
+                            keep_type=False),)
+        + row[MESSAGE_TEXT_INDEX + 1:FORMATTING_INDEX]
+        + (texts.get(row[FORMATTING_INDEX]),)
+        + row[FORMATTING_INDEX + 1:] for row in rows
+    ]
+
+
+def _decode_media(rows, decompress):
+    """Returns the media rows with their (decompressed) Extra as JSON"""
+    return [
+        row[:MEDIA_EXTRA_INDEX]
+        + (_tl_data_to_json(decompress(row[MEDIA_EXTRA_INDEX])),)
+        + row[MEDIA_EXTRA_INDEX + 1:] for row in rows
+    ]
+
+
+class _CsvWriter:
+    """Writes batches of columns as rows of a CSV file"""
+    extension = '.csv'
+
+    def __init__(self, file, columns):
+        self._file = file
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(name for name, _ in columns)
+
+    def write(self, rows, columns):
+        """Writes the given rows (the columns are ignored)"""
+        self._writer.writerows(rows)
+
+    def close(self):
+        """Closes the underlying file"""
+        self._file.close()
+
+
+class _ParquetWriter:
+    """Writes batches of columns as row groups of a Parquet file"""
+    extension = '.parquet'
+
+    def __init__(self, filename, columns, compression=None):
+        self._schema = pyarrow.schema([
+            (name, getattr(pyarrow, kind)()) for name, kind in columns
+        ])
+        # Without a compression, pyarrow's default (snappy) is used
+        kwargs = {'compression': compression} if compression else {}
+        self._writer = pyarrow.parquet.ParquetWriter(
+            filename, self._schema, **kwargs)
+
+    def write(self, rows, columns):
+        """Writes the given columns (the rows are ignored)"""
+        self._writer.write_table(pyarrow.Table.from_arrays([
+            pyarrow.array(column, type=field.type)
+            for column, field in zip(columns, self._schema)
+        ], schema=self._schema))
+
+    def close(self):
+        """Finishes writing the file"""
+        self._writer.close()
+
+
+class ColumnarFormatter(BaseFormatter):
+    """
+    A Formatter class to export the Message, User, Media and Forward
+    tables in a columnar format suitable for analytics.
+
+    Rows are read in large batches with ``fetchmany`` and transposed into
+    columns, which are written as Parquet row groups when pyarrow is
+    available or as CSV otherwise. Messages are partitioned by context
+    and month (Hive-style, e.g. ``context_id=123/month=2018-01``).
+
+    The compression ('gzip' or 'zstd') is used for the pages of Parquet
+    files, or to compress the whole file for CSV.
+    """
+    extension = '.csv'
+
+    def __init__(self, db, batch_size=BATCH_SIZE, parquet=None, **kwargs):
+        super().__init__(db, **kwargs)
+        if parquet is None:
+            parquet = pyarrow is not None
+        elif parquet and not pyarrow:
+            raise ValueError('Parquet output requires pyarrow installed')
+        self.writer_cls = _ParquetWriter if parquet else _CsvWriter
+        self.batch_size = max(batch_size, 1)
+
+    @staticmethod
+    def name():
+        return 'columnar'
+
+    def open_output(self, filename, newline=''):
+        """
+        Opens the given filename like BaseFormatter.open_output, but
+        without translating line endings by default, as csv requires.
+        """
+        return super().open_output(filename, newline=newline)
+
+    def _open_writer(self, filename, columns):
+        """
+        Opens the right writer for the given filename (without extension),
+        compressed with self.compression, if any.
+        """
+        if self.writer_cls is _ParquetWriter:
+            return _ParquetWriter(filename + _ParquetWriter.extension,
+                                  columns, self.compression)
+        return _CsvWriter(self.open_output('{}{}{}'.format(
+            filename, _CsvWriter.extension,
+            COMPRESSION_TO_EXTENSION[self.compression]
+        )), columns)
+
+    def _fetch_batches(self, query, params=(), conn=None):
+        """
+        Yields lists of up to self.batch_size rows for the query, ran
+        on the given connection or the catalog.
+        """
+        cur = (conn or self.dbconn).cursor()
+        cur.execute(query, params)
+        rows = cur.fetchmany(self.batch_size)
+        while rows:
+            yield rows
+            rows = cur.fetchmany(self.batch_size)
+
+    def _export_table(self, filename, columns, query, convert=None):
+        """
+        Exports the results of query into a single file, after passing
+        every batch of rows (and the decompress function) through convert
+        if given.
+        """
+        writer = self._open_writer(filename, columns)
+        try:
+            for rows in self._fetch_batches(query):
+                if convert:
+                    rows = convert(rows, self.compressor.decompress)
+                writer.write(rows, list(zip(*rows)))
+        finally:
+            writer.close()
+
+    def export_messages(self, directory):
+        """
+        Exports all the messages partitioned by context and month under
+        the given directory. Rows are sorted by SQLite (which will spill
+        to disk if needed) so every partition is written only once, even
+        if they come from different shards (which have whole contexts).
+        """
+        select = ', '.join(name for name, _ in MESSAGE_COLUMNS)
+        query = ("SELECT {}, strftime('%Y-%m', Date, 'unixepoch') FROM Message "
+                 "ORDER BY ContextID, Date".format(select))
+        key = None
+        writer = None
+        try:
+            for rows in (batch for conn in self.iter_context_conns()
+                         for batch in self._fetch_batches(query, conn=conn)):
+                rows = _decode_messages(rows, self.compressor.decompress)
+                start = 0
+                for end in range(1, len(rows) + 1):
+                    if end != len(rows) and \
+                            rows[end][1] == rows[start][1] and \
+                            rows[end][-1] == rows[start][-1]:
+                        continue
+
+                    if key != (rows[start][1], rows[start][-1]):
+                        if writer:
+                            writer.close()
+                        key = (rows[start][1], rows[start][-1])
+                        partition = os.path.join(
+                            directory, 'context_id={}'.format(key[0]),
+                            'month={}'.format(key[1])
+                        )
+                        os.makedirs(partition, exist_ok=True)
+                        writer = self._open_writer(os.path.join(
+                            partition, 'part-0'), MESSAGE_COLUMNS)
+
+                    # Drop the month, it is only used to partition
+                    chunk = [row[:-1] for row in rows[start:end]]
+                    writer.write(chunk, list(zip(*chunk)))
+                    start = end
+        finally:
+            if writer:
+                writer.close()
+
+    def format_all(self, directory):
+        """
+        Export the tables under a 'columnar' folder inside directory,
+        with the messages partitioned in the 'messages' folder.
+        """
+        directory = os.path.join(directory, self.name())
+        os.makedirs(directory, exist_ok=True)
+        for table, columns, convert in (
+                ('User', USER_COLUMNS, None),
+                ('Media', MEDIA_COLUMNS, _decode_media),
+                ('Forward', FORWARD_COLUMNS, None)):
+            self._export_table(
+                os.path.join(directory, table.lower()), columns,
+                'SELECT {} FROM {}'.format(
+                    ', '.join(name for name, _ in columns), table),
+                convert
+            )
+        self.export_messages(os.path.join(directory, 'messages'))
+
+    def _format(self, context_id, file, *args, **kwargs):
+        """Format the messages of the given context as CSV to 'file'"""
+        writer = csv.writer(file)
+        writer.writerow(name for name, _ in MESSAGE_COLUMNS)
+        query = 'SELECT {} FROM Message WHERE ContextID = ? ORDER BY Date'\
+            .format(', '.join(name for name, _ in MESSAGE_COLUMNS))
+        for rows in self._fetch_batches(query, (context_id,),
+                                        self.context_conn(context_id)):
+            writer.writerows(
+                _decode_messages(rows, self.compressor.decompress))
@@ -1,35 +1,401 @@
 """
-Formatter to display paginated(?) HTML of a context.
-Very much unfinished and needs a web designer to work on it.
+Formatter to generate a static, paginated HTML site of the dumped contexts.
 """
+import html
+import math
+import os
+from base64 import b64decode
+from urllib.parse import urlsplit
+
+from telethon.extensions.markdown import _add_surrogate, _del_surrogate
+from telethon.tl import types
+
+import utils
 from formatters import BaseFormatter
 
+MESSAGES_PER_PAGE = 500
+UNKNOWN_USER_TEXT = '(???)'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+STYLESHEET = """\
+body { font-family: sans-serif; max-width: 50em; margin: auto; padding: 1em; }
+nav { margin: 1em 0; }
+nav a { margin-right: 1em; }
+table { border-collapse: collapse; width: 100%; }
+td, th { text-align: left; padding: 0.2em 0.5em; border-bottom: 1px solid #ddd; }
+.message { margin: 0.5em 0; padding: 0.5em; border-left: 3px solid #ddd; }
+.message.out { border-left-color: #8ac; }
+.message.service { color: #777; font-style: italic; }
+.meta { color: #555; font-size: 0.9em; }
+.sender { font-weight: bold; }
+.reply { color: #666; border-left: 2px solid #ccc; padding-left: 0.5em; }
+.forward, .views, .media { color: #666; font-size: 0.9em; }
+.text { white-space: pre-wrap; }
+img.thumb { max-width: 10em; display: block; }
+"""
+
+# (opening tag, closing tag) for the entities which map to a fixed tag
+ENTITY_TO_TAGS = {
+    types.MessageEntityBold: ('<b>', '</b>'),
+    types.MessageEntityItalic: ('<i>', '</i>'),
+    types.MessageEntityCode: ('<code>', '</code>'),
+    types.MessageEntityPre: ('<pre>', '</pre>'),
+}
+
+# Schemes that links may use, others (like javascript:) are not linked
+URL_SCHEMES = {'http', 'https', 'tg', 'mailto'}
+
+
+def _entity_tags(entity):
+    """Returns the (opening, closing) HTML tags for the given entity"""
+    if type(entity) in ENTITY_TO_TAGS:
+        return ENTITY_TO_TAGS[type(entity)]
+    if isinstance(entity, types.MessageEntityTextUrl):
+        if urlsplit(entity.url.strip()).scheme.lower() not in URL_SCHEMES:
+            return None, None
+        return '<a href="{}">'.format(html.escape(entity.url)), '</a>'
+    if isinstance(entity, types.MessageEntityMentionName):
+        return '<span class="mention" data-user="{}">'.format(
+            entity.user_id), '</span>'
+    return None, None
+
+
+def _find_inline_thumbnail(extra):
+    """
+    Walks the (sanitized) dictionary of a Media's Extra column and returns
+    the bytes of the first PhotoCachedSize found, or ``None`` if there are
+    none. These are small enough that Telegram sends them inline.
+    """
+    if isinstance(extra, dict):
+        if extra.get('_') == 'PhotoCachedSize' and extra.get('bytes'):
+            return b64decode(extra['bytes'])
+        values = extra.values()
+    elif isinstance(extra, list):
+        values = extra
+    else:
+        return None
+
+    for value in values:
+        found = _find_inline_thumbnail(value)
+        if found:
+            return found
+
 
 class HtmlFormatter(BaseFormatter):
-    """A Formatter class to generate HTML"""
+    """
+    A Formatter class to generate HTML.
+
+    Formatting a single context outputs a single page, while
+    ``format_all`` generates a static site with a fixed amount of
+    messages per page, an index of pages per context and a global
+    index of contexts. Pages are written as messages are read, so
+    the memory used does not grow with the size of the context.
+    """
+    extension = '.html'
+
+    def __init__(self, db, messages_per_page=MESSAGES_PER_PAGE, **kwargs):
+        super().__init__(db, **kwargs)
+        self.messages_per_page = max(messages_per_page, 1)
+        self._written_thumbs = set()
+
     @staticmethod
     def name():
         return 'html'
 
-    def output_header(self, file, context):
-        """Output the header of the page. Context should be a namedtuple"""
-        # TODO HTML
-        print(self.get_display_name(context), file=file)
+    def output_header(self, file, context, root='', nav=''):
+        """
+        Output the header of the page. Context should be a namedtuple.
+        Root is the relative path to the root of the site, if any.
+        """
+        title = html.escape(self.get_display_name(context) or 'unnamed')
+        file.write(
+            '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<title>{title}</title>\n'
+            '<link rel="stylesheet" href="{root}style.css">\n'
+            '</head>\n<body>\n<h1>{title}</h1>\n{nav}\n'
+            .format(title=title, root=root, nav=nav)
+        )
+
+    @staticmethod
+    def output_footer(file, nav=''):
+        """Output the footer of the page, closing any open tags"""
+        file.write('{}\n</body>\n</html>\n'.format(nav))
+
+    @staticmethod
+    def format_text(text, formatting):
+        """
+        Return the given text as HTML with its formatting (as stored
+        in the database, see ``utils.encode_msg_entities``) applied.
+        """
+        if not text:
+            return ''
+        entities = utils.decode_msg_entities(formatting)
+        if not entities:
+            return html.escape(text)
+
+        # Entities may overlap, so tags are kept on a stack and those
+        # inside an entity which ends are closed with it, then reopened.
+        # Longer entities are opened first so that they contain the rest.
+        # Empty entities would produce empty tags, so they are left out.
+        spans = []
+        for i, entity in enumerate(entities):
+            open_tag, close_tag = _entity_tags(entity)
+            if open_tag and entity.length > 0:
+                spans.append((entity.offset, entity.offset + entity.length,
+                              i, open_tag, close_tag))
+        spans.sort(key=lambda span: (span[0], -span[1], span[2]))
 
-    def generate_message_html(self, message):
+        text = _add_surrogate(text)
+        result = []
+        stack = []
+        last = 0
+        opening = 0
+        for pos in sorted({p for span in spans for p in span[:2]}):
+            result.append(html.escape(_del_surrogate(text[last:pos])))
+            last = pos
+
+            reopen = []
+            while any(span[1] == pos for span in stack):
+                span = stack.pop()
+                result.append(span[4])
+                if span[1] != pos:
+                    reopen.append(span)
+            for span in reversed(reopen):
+                result.append(span[3])
+                stack.append(span)
+
+            while opening < len(spans) and spans[opening][0] == pos:
+                result.append(spans[opening][3])
+                stack.append(spans[opening])
+                opening += 1
+
+        result.append(html.escape(_del_surrogate(text[last:])))
+        result.extend(span[4] for span in reversed(stack))
+        return ''.join(result)
+
+    def write_thumbnail(self, media, directory):
+        """
+        Writes the inline thumbnail of the given Media namedtuple under
+        the given directory, only once per media, and returns its
+        filename or ``None`` if the media has no inline thumbnail.
+        """
+        filename = '{}.jpg'.format(media.id)
+        if media.id in self._written_thumbs:
+            return filename
+
+        path = os.path.join(directory, filename)
+        if not os.path.isfile(path):
+            try:
+                data = _find_inline_thumbnail(
+                    utils.tl_data_to_dict(media.extra))
+            except ValueError:
+                data = None
+            if not data:
+                return None
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        self._written_thumbs.add(media.id)
+        return filename
+
+    def generate_media_html(self, media_id, thumbs_dir=None, root=''):
+        """
+        Return HTML describing the given media, including its
+        thumbnail if a directory to write thumbnails is given.
+        """
+        media = self.get_media(media_id)
+        if not media:
+            return ''
+
+        result = ['<div class="media">[{}]'.format(
+            html.escape(media.type or 'unknown'))]
+        if media.name:
+            result.append(' {}'.format(html.escape(media.name)))
+        if thumbs_dir:
+            thumb = self.write_thumbnail(media, thumbs_dir)
+            if not thumb and media.thumbnail_id:
+                thumb_media = self.get_media(media.thumbnail_id)
+                if thumb_media:
+                    thumb = self.write_thumbnail(thumb_media, thumbs_dir)
+            if thumb:
+                result.append('<img class="thumb" src="{}thumbs/{}">'
+                              .format(root, thumb))
+        result.append('</div>')
+        return ''.join(result)
+
+    def generate_message_html(self, message, thumbs_dir=None, root=''):
         """
         Return HTML for a message, showing reply message, forward headers,
         view count, post author, and media (if applicable).
         """
-        # TODO HTML
-        from_name = self.get_display_name(message.from_id) or "(???)"
-        return "{}: {}".format(from_name, message.text)
+        when = message.date.strftime(DATE_FORMAT)
+        if message.service_action:
+            return (
+                '<div class="message service" id="m{}">'
+                '<span class="date">{}</span> Service action {}</div>'
+                .format(message.id, when, html.escape(message.service_action))
+            )
+
+        from_name = html.escape(self.get_display_name(
+            message.from_user) or message.post_author or UNKNOWN_USER_TEXT)
+        result = ['<div class="message{}" id="m{}">'.format(
+            ' out' if message.out else '', message.id)]
+        result.append('<div class="meta"><span class="sender">{}</span> '
+                      '<span class="date">{}</span></div>'
+                      .format(from_name, when))
+
+        if message.reply_message is not None:
+            if message.reply_message == ():  # Unlikely, message not dumped
+                reply_sender, reply_text = UNKNOWN_USER_TEXT, '???'
+            else:
+                reply_sender = self.get_display_name(
+                    message.reply_message.from_user) or UNKNOWN_USER_TEXT
+                reply_text = message.reply_message.text or ''
+            result.append('<div class="reply">In reply to {}: {}</div>'.format(
+                html.escape(reply_sender), html.escape(reply_text)))
+
+        if message.forward_id:
+            result.append('<div class="forward">Forwarded message</div>')
+
+        result.append('<div class="text">{}</div>'.format(
+            self.format_text(message.text, message.formatting)))
+
+        if message.media_id:
+            result.append(self.generate_media_html(
+                message.media_id, thumbs_dir=thumbs_dir, root=root))
+
+        if message.view_count:
+            result.append('<div class="views">{} views</div>'
+                          .format(message.view_count))
+
+        result.append('</div>')
+        return ''.join(result)
 
     def _format(self, context_id, file, *args, **kwargs):
-        """Format the given context as HTML and output to 'file'"""
+        """Format the given context as a single HTML page to 'file'"""
         entity = self.get_entity(context_id)
 
         self.output_header(file, entity)
-        for message in self.get_messages_from_context(context_id,
-                                                      order='ASC'):
-            print(self.generate_message_html(message), file=file)
+        self.write_lines(file, (
+            self.generate_message_html(message) for message in
+            self.get_messages_from_context(context_id, order='ASC')
+        ))
+        self.output_footer(file)
+
+    def format_all(self, directory):
+        """
+        Generate a static site under an 'html' folder inside the given
+        directory, with one folder per context containing its pages.
+        The pages are meant to be browsed, so they can't be compressed.
+        """
+        if self.compression:
+            raise ValueError('The HTML site can\'t be compressed, '
+                             'only single contexts can')
+        directory = os.path.join(directory, self.name())
+        thumbs_dir = os.path.join(directory, 'thumbs')
+        os.makedirs(thumbs_dir, exist_ok=True)
+        with self._open_page(os.path.join(directory, 'style.css')) as f:
+            f.write(STYLESHEET)
+
+        contexts = []
+        for context_id in self.iter_context_ids():
+            pages = self.format_context_pages(context_id, directory,
+                                              thumbs_dir=thumbs_dir)
+            if pages:
+                contexts.append((context_id, pages))
+
+        with self._open_page(os.path.join(directory, 'index.html')) as f:
+            f.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+                    '<title>Exported contexts</title>\n'
+                    '<link rel="stylesheet" href="style.css">\n</head>\n'
+                    '<body>\n<h1>Exported contexts</h1>\n<table>\n'
+                    '<tr><th>Name</th><th>Messages</th>'
+                    '<th>First</th><th>Last</th></tr>\n')
+            for context_id, pages in contexts:
+                f.write('<tr><td><a href="{}/index.html">{}</a></td>'
+                        '<td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
+                            context_id,
+                            html.escape(self.get_display_name(context_id)
+                                        or str(context_id)),
+                            sum(page[1] for page in pages),
+                            pages[0][2].strftime(DATE_FORMAT),
+                            pages[-1][3].strftime(DATE_FORMAT)
+                        ))
+            f.write('</table>\n</body>\n</html>\n')
+
+    def format_context_pages(self, context_id, directory, thumbs_dir=None):
+        """
+        Write the pages of the given context under a folder named after
+        it inside directory, plus an index of its pages by date. Returns
+        a list of (page number, message count, first date, last date).
+        """
+        context_dir = os.path.join(directory, str(context_id))
+        os.makedirs(context_dir, exist_ok=True)
+        entity = self.get_entity(context_id)
+        # Known beforehand so that the header can link to the next page
+        page_count = math.ceil(self.get_message_count(context_id)
+                               / self.messages_per_page)
+
+        pages = []
+        file = None
+        try:
+            for message in self.get_messages_from_context(context_id,
+                                                          order='ASC'):
+                if not file or pages[-1][1] >= self.messages_per_page:
+                    number = len(pages) + 1
+                    if file:
+                        self.output_footer(file, self._page_nav(
+                            number - 1, has_next=True))
+                        file.close()
+                    file = self._open_page(os.path.join(
+                        context_dir, '{}.html'.format(number)))
+                    self.output_header(file, entity, root='../',
+                                       nav=self._page_nav(
+                                           number, number < page_count))
+                    pages.append([number, 0, message.date, message.date])
+
+                # Buffered by the file, which is flushed in big blocks
+                file.write(self.generate_message_html(
+                    message, thumbs_dir=thumbs_dir, root='../'))
+                file.write('\n')
+                pages[-1][1] += 1
+                pages[-1][3] = message.date
+
+            if file:
+                self.output_footer(file, self._page_nav(len(pages)))
+        finally:
+            if file:
+                file.close()
+
+        with self._open_page(os.path.join(context_dir, 'index.html')) as f:
+            self.output_header(f, entity, root='../',
+                               nav='<nav><a href="../index.html">All</a></nav>')
+            f.write('<table>\n<tr><th>Page</th><th>Messages</th>'
+                    '<th>From</th><th>To</th></tr>\n')
+            for number, count, first, last in pages:
+                f.write('<tr><td><a href="{0}.html">{0}</a></td><td>{1}</td>'
+                        '<td>{2}</td><td>{3}</td></tr>\n'.format(
+                            number, count, first.strftime(DATE_FORMAT),
+                            last.strftime(DATE_FORMAT)))
+            f.write('</table>\n')
+            self.output_footer(f)
+
+        return pages
+
+    def _open_page(self, filename):
+        """
+        Opens a file of the site for writing. These are never compressed
+        so that they can be browsed, but they are still buffered.
+        """
+        return open(filename, 'w', encoding='utf-8', buffering=self.buffer_size)
+
+    @staticmethod
+    def _page_nav(number, has_next=False):
+        """Returns the navigation links for the given page number"""
+        links = ['<a href="../index.html">All</a>',
+                 '<a href="index.html">Pages</a>']
+        if number > 1:
+            links.append('<a href="{}.html">Previous</a>'.format(number - 1))
+        if has_next:
+            links.append('<a href="{}.html">Next</a>'.format(number + 1))
+        return '<nav>{}</nav>'.format(' '.join(links))
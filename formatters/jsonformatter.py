@@ -0,0 +1,98 @@
+"""A Formatter class to output newline-delimited JSON"""
+import json
+
+import utils
+from formatters import BaseFormatter
+
+
+def _timestamp(date):
+    """Returns the integer timestamp of a datetime, or None"""
+    return int(date.timestamp()) if date else None
+
+
+class JsonFormatter(BaseFormatter):
+    """
+    A Formatter class to output one JSON object per message, one per line.
+
+    Messages are written as they are read from the database, so memory
+    usage is constant regardless of the size of the context.
+    """
+    extension = '.jsonl'
+
+    @staticmethod
+    def name():
+        return 'json'
+
+    @staticmethod
+    def entity_to_dict(entity):
+        """Returns a dictionary for a User, Chat, Channel or Supergroup"""
+        if not entity:
+            return None
+        result = entity._asdict()
+        result['date_updated'] = _timestamp(result['date_updated'])
+        return result
+
+    def media_to_dict(self, media_id):
+        """Returns a dictionary with the metadata of the given media ID"""
+        media = self.get_media(media_id)
+        if not media:
+            return None
+        result = media._asdict()
+        if media.extra:
+            result['extra'] = utils.tl_data_to_dict(media.extra)
+        return result
+
+    def forward_to_dict(self, forward_id):
+        """Returns a dictionary with the forward header of the given ID"""
+        forward = self.get_forward(forward_id)
+        if not forward:
+            return None
+        result = forward._asdict()
+        result['original_date'] = _timestamp(forward.original_date)
+        return result
+
+    def message_to_dict(self, message):
+        """Returns a JSON-serializable dictionary for a Message namedtuple"""
+        result = {
+            'id': message.id,
+            'context_id': message.context_id,
+            'date': _timestamp(message.date),
+            'from_id': message.from_id,
+            'from': self.entity_to_dict(message.from_user),
+            'out': message.out,
+            'reply_message_id': message.reply_message_id,
+            'post_author': message.post_author,
+            'view_count': message.view_count,
+            'service_action': message.service_action,
+        }
+        if message.service_action:
+            # Service messages store the action as JSON instead of the text
+            result['text'] = None
+            result['action'] = utils.tl_data_to_dict(
+                message.text, keep_type=False) or {}
+        else:
+            result['text'] = message.text
+
+        entities = utils.decode_msg_entities(message.formatting)
+        result['entities'] = [e.to_dict() for e in entities or ()]
+        result['forward'] = self.forward_to_dict(message.forward_id)
+        result['media'] = self.media_to_dict(message.media_id)
+        return result
+
+    def iter_message_dicts(self, context_id, *args, **kwargs):
+        """
+        Yields a dictionary per message of the given context, in
+        chronological order unless stated otherwise. Any other arguments
+        are passed to ``get_messages_from_context``.
+        """
+        kwargs.setdefault('order', 'ASC')
+        for message in self.get_messages_from_context(context_id,
+                                                      *args, **kwargs):
+            yield self.message_to_dict(message)
+
+    def _format(self, context_id, file, *args, **kwargs):
+        """Format the given context as JSON lines and output to 'file'"""
+        self.write_lines(file, (
+            json.dumps(message, ensure_ascii=False)
+            for message in self.iter_message_dicts(context_id)
+        ))
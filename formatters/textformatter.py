@@ -37,7 +37,8 @@ class TextFormatter(BaseFormatter):
         entity = self.get_entity(context_id)
         name = self.get_display_name(entity) or 'unnamed'
 
-        print('== Conversation with "{}" =='.format(name), file=file)
-        for message in self.get_messages_from_context(context_id,
-                                                      order='ASC'):
-            print(self.generate_message(message))
+        file.write('== Conversation with "{}" ==\n'.format(name))
+        self.write_lines(file, (
+            self.generate_message(message) for message in
+            self.get_messages_from_context(context_id, order='ASC')
+        ))
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+"""
+Merges export databases (e.g. made from different machines or accounts)
+into one, remapping the IDs of their media and forwards and skipping what
+is already there, with a few bulk statements per table instead of going
+through every row in Python.
+"""
+import argparse
+import configparser
+import os
+import sqlite3
+import struct
+import sys
+import time
+from collections import OrderedDict, namedtuple
+
+import compression
+import shards
+from dumper import (
+    DB_VERSION, DURABILITY_PROFILES, SHARED_IDS_MIN_CONTEXT, Dumper
+)
+
+# Oldest version of the databases which can be merged as they are
+MIN_SOURCE_VERSION = 9
+
+# Tables with every version of the entities, kept by (ID, DateUpdated)
+ENTITY_TABLES = ('User', 'Channel', 'Supergroup', 'Chat')
+
+# The private contexts of accounts other than the database's own get
+# IDs from this one downwards, below those of any real context
+OTHER_ACCOUNT_CONTEXT_ID = -2 ** 62
+
+# The ID of a context in the destination, for the context of the source
+# row ``s``, from the map made for the contexts being merged
+_CONTEXT_SQL = ('(SELECT NewID FROM temp.MergeContext '
+                'WHERE ContextID = s.ContextID)')
+
+# Compressed values start with the magic and (codec, kind, dictionary ID)
+# header, and only zstd values have a dictionary to remap. The offsets
+# are 1-based, as used by SQLite's substr.
+_ZSTD_PREFIX = compression.MAGIC + bytes((compression.CODEC_ZSTD,))
+_DICT_START = len(compression.MAGIC) + 3
+_DATA_START = len(compression.MAGIC) + compression.HEADER.size + 1
+_DICT_ID = struct.Struct('<I')
+
+MergeReport = namedtuple('MergeReport', (
+    'filename', 'media', 'duplicate_media', 'forwards', 'entities',
+    'contexts', 'messages', 'conflicts', 'admin_log', 'seconds'
+))
+
+
+def _open_read_only(filename):
+    """Opens the database with the given filename without writing to it"""
+    return sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+
+
+def _has_table(conn, table):
+    """Returns whether the main database of the connection has the table"""
+    return conn.execute("SELECT name FROM sqlite_master WHERE "
+                        "type='table' AND name=?", (table,)).fetchone() \
+        is not None
+
+
+def _copy(conn, table, remap=None, where=None, params=()):
+    """
+    Copies the rows of the attached source's table into the table of the
+    connection, ignoring the rows which are already there, and returns
+    how many were copied. Columns in remap are replaced by the given SQL
+    expressions, where the source's row is ``s``.
+    """
+    remap = remap or {}
+    columns = [row[1] for row in conn.execute(
+        'PRAGMA main.table_info({})'.format(table))]
+    return conn.execute(
+        'INSERT OR IGNORE INTO main.{table} ({columns}) '
+        'SELECT {values} FROM src.{table} s{where}'.format(
+            table=table, columns=', '.join(columns),
+            values=', '.join(remap.get(c, 's.' + c) for c in columns),
+            where=' WHERE ' + where if where else ''
+        ), params).rowcount
+
+
+def _media_sql(column):
+    """
+    Returns the SQL for the ID in the destination of the media referenced
+    by the column, which is either that of the media that was already
+    there or the old ID plus the offset.
+    """
+    return ('COALESCE((SELECT NewID FROM temp.MediaMap WHERE OldID = s.{0}),'
+            ' s.{0} + :media_offset)'.format(column))
+
+
+def _dict_sql(column, dict_map):
+    """
+    Returns the SQL for the compressed value of the column with its
+    dictionary ID replaced by the ID of the dictionary in the destination.
+    """
+    if not dict_map:
+        return 's.' + column
+    # Concatenating blobs gives text, which has the same bytes
+    return ("CASE WHEN substr(s.{c}, 1, {n}) = X'{prefix}' THEN "
+            "CAST(substr(s.{c}, 1, {start} - 1) || "
+            "COALESCE((SELECT New FROM temp.DictMap "
+            "WHERE Old = substr(s.{c}, {start}, {size})), "
+            "substr(s.{c}, {start}, {size})) || substr(s.{c}, {data}) "
+            "AS BLOB) ELSE s.{c} END".format(
+                c=column, n=len(_ZSTD_PREFIX), prefix=_ZSTD_PREFIX.hex(),
+                start=_DICT_START, size=_DICT_ID.size, data=_DATA_START))
+
+
+def _context_files(conn, filename):
+    """
+    Returns the files with the tables of single contexts of the source
+    database with the given connection and filename, which are all its
+    shards if it's sharded.
+    """
+    if shards.get_buckets(conn) is None:
+        return [filename]
+    directory = shards.get_directory(conn)
+    return [shards.shard_filename(directory, key) for key, in conn.execute(
+        'SELECT DISTINCT Key FROM Shard')]
+
+
+def _list_contexts(filename):
+    """Returns the IDs of the contexts with data in the given file"""
+    conn = _open_read_only(filename)
+    try:
+        return [row[0] for row in conn.execute(
+            'SELECT ContextID FROM Message '
+            'UNION SELECT ContextID FROM AdminLog '
+            'UNION SELECT ContextID FROM ChatParticipants '
+            'UNION SELECT ContextID FROM MessageDeletion')]
+    finally:
+        conn.close()
+
+
+def _copy_dicts(conn, dicts):
+    """
+    Copies the given (ID, DateCreated, Data) compression dictionaries
+    unless they're already in the destination, and returns the map of
+    the IDs which changed, packed as in the header of the values.
+    """
+    dict_map = {}
+    for dict_id, date_created, data in dicts:
+        row = conn.execute('SELECT ID FROM CompressionDict WHERE Data = ?',
+                           (data,)).fetchone()
+        new_id = row[0] if row else conn.execute(
+            'INSERT INTO CompressionDict (DateCreated, Data) VALUES (?, ?)',
+            (date_created, data)).lastrowid
+        if new_id != dict_id:
+            dict_map[_DICT_ID.pack(dict_id)] = _DICT_ID.pack(new_id)
+    return dict_map
+
+
+def _create_media_map(conn, schema, source_id):
+    """
+    Creates the temporary map of the media of the source which was
+    already in the destination, from the MergedMedia table of the
+    given attached schema.
+
+    This doesn't start a transaction, so the schema can be detached
+    afterwards without keeping it locked.
+    """
+    conn.execute('DROP TABLE IF EXISTS temp.MediaMap')
+    conn.execute('CREATE TEMP TABLE MediaMap AS SELECT OldID, NewID '
+                 'FROM {}.MergedMedia WHERE SourceID = {:d}'
+                 .format(schema, source_id))
+    conn.execute('CREATE UNIQUE INDEX temp.MediaMapOldID ON MediaMap(OldID)')
+
+
+def _create_dict_map(conn, dict_map):
+    """Creates the temporary map of the dictionary IDs which changed"""
+    conn.execute('DROP TABLE IF EXISTS temp.DictMap')
+    conn.execute('CREATE TEMP TABLE DictMap('
+                 'Old BLOB PRIMARY KEY, New BLOB NOT NULL)')
+    conn.executemany('INSERT INTO temp.DictMap VALUES (?, ?)',
+                     dict_map.items())
+
+
+def _merge_dialogs(conn):
+    """
+    Keeps the most recent version of every dialog in the catalog (along
+    with its trigrams) and the latest known activity.
+    """
+    conn.execute('DROP TABLE IF EXISTS temp.NewerDialog')
+    conn.execute('CREATE TEMP TABLE NewerDialog AS SELECT s.ID AS ID '
+                 'FROM src.Dialog s LEFT JOIN main.Dialog d ON d.ID = s.ID '
+                 'WHERE d.ID IS NULL OR s.DateUpdated > d.DateUpdated')
+    conn.execute('UPDATE main.Dialog SET DateActive = ('
+                 'SELECT s.DateActive FROM src.Dialog s '
+                 'WHERE s.ID = Dialog.ID) WHERE DateActive < ('
+                 'SELECT s.DateActive FROM src.Dialog s '
+                 'WHERE s.ID = Dialog.ID)')
+    conn.execute('INSERT OR REPLACE INTO main.Dialog '
+                 '(ID, DateUpdated, DateActive, Name, Username, Phone) '
+                 'SELECT s.ID, s.DateUpdated, '
+                 'MAX(s.DateActive, COALESCE(d.DateActive, 0)), '
+                 's.Name, s.Username, s.Phone FROM src.Dialog s '
+                 'LEFT JOIN main.Dialog d ON d.ID = s.ID '
+                 'WHERE s.ID IN (SELECT ID FROM temp.NewerDialog)')
+    conn.execute('DELETE FROM main.DialogTrigram '
+                 'WHERE DialogID IN (SELECT ID FROM temp.NewerDialog)')
+    conn.execute('INSERT OR IGNORE INTO main.DialogTrigram '
+                 '(Trigram, DialogID) SELECT Trigram, DialogID '
+                 'FROM src.DialogTrigram '
+                 'WHERE DialogID IN (SELECT ID FROM temp.NewerDialog)')
+
+
+def _merge_catalog(dumper, source_id, dict_map, params):
+    """
+    Merges the catalog of the source into the dumper's catalog (which
+    must have the source attached as src) and returns the amount of
+    (media, duplicate media, forwards, entity versions) merged.
+    """
+    conn = dumper.conn
+    # Media which is already here is found by the file it points to,
+    # like Dumper.dump_media does (so NULLs are never duplicates)
+    duplicates = conn.execute(
+        'INSERT INTO MergedMedia (SourceID, OldID, NewID) '
+        'SELECT :source, s.ID, MIN(d.ID) FROM src.Media s '
+        'JOIN main.Media d ON d.LocalID = s.LocalID '
+        'AND d.VolumeID = s.VolumeID AND d.Secret = s.Secret '
+        'GROUP BY s.ID', params).rowcount
+    _create_media_map(conn, 'main', source_id)
+    _create_dict_map(conn, dict_map)
+
+    media = _copy(conn, 'Media', {
+        'ID': 's.ID + :media_offset',
+        'ThumbnailID': _media_sql('ThumbnailID'),
+        'Extra': _dict_sql('Extra', dict_map)
+    }, where='s.ID NOT IN (SELECT OldID FROM temp.MediaMap)', params=params)
+    forwards = _copy(conn, 'Forward', {'ID': 's.ID + :forward_offset'},
+                     params=params)
+    entities = sum(_copy(conn, table, {'PictureID': _media_sql('PictureID')},
+                         params=params) for table in ENTITY_TABLES)
+    _merge_dialogs(conn)
+    return media, duplicates, forwards, entities
+
+
+def _map_contexts(conn, source_id, self_id, context_ids, other_account):
+    """
+    Records the given contexts of the source in MergedContext and returns
+    {ID in the source: ID in the destination} for them.
+
+    Private chats and small groups have different message IDs for every
+    account, so if the source is from another account, they're given
+    IDs of their own (the same for every source of that account).
+    """
+    context_map = {}
+    for context_id in context_ids:
+        new_id = context_id
+        if other_account and context_id > SHARED_IDS_MIN_CONTEXT:
+            row = conn.execute(
+                'SELECT c.ContextID FROM MergedContext c '
+                'JOIN MergeSource s ON s.ID = c.SourceID '
+                'WHERE s.SelfID IS ? AND c.SourceContextID = ? '
+                'AND c.ContextID <= ?',
+                (self_id, context_id, OTHER_ACCOUNT_CONTEXT_ID)).fetchone()
+            new_id = row[0] if row else conn.execute(
+                'SELECT MIN(COALESCE(MIN(ContextID), 0), ?) - 1 '
+                'FROM MergedContext', (OTHER_ACCOUNT_CONTEXT_ID + 1,)
+            ).fetchone()[0]
+        conn.execute('INSERT OR IGNORE INTO MergedContext '
+                     '(ContextID, SourceID, SourceContextID) '
+                     'VALUES (?, ?, ?)', (new_id, source_id, context_id))
+        context_map[context_id] = new_id
+    return context_map
+
+
+def _merge_contexts(conn, context_map, dict_map, params):
+    """
+    Merges the tables of the contexts of the source (attached to the
+    connection as src) in the given {ID in the source: ID in the
+    destination} map, and returns the amount of (messages, message
+    conflicts, admin log events) merged.
+    """
+    conn.execute('DROP TABLE IF EXISTS temp.MergeContext')
+    conn.execute('CREATE TEMP TABLE MergeContext('
+                 'ContextID INTEGER PRIMARY KEY, NewID INT NOT NULL)')
+    conn.executemany('INSERT INTO temp.MergeContext VALUES (?, ?)',
+                     context_map.items())
+    where = 's.ContextID IN (SELECT ContextID FROM temp.MergeContext)'
+
+    # Messages of the same account with the same ID but a different
+    # date are not the same, and only the ones already here are kept
+    conflicts = conn.execute(
+        'SELECT COUNT(*) FROM src.Message s JOIN main.Message d '
+        'ON d.ID = s.ID AND d.ContextID = ' + _CONTEXT_SQL + ' '
+        'WHERE d.Date != s.Date AND ' + where).fetchone()[0]
+    messages = _copy(conn, 'Message', {
+        'ContextID': _CONTEXT_SQL,
+        'MediaID': _media_sql('MediaID'),
+        'ForwardID': 's.ForwardID + :forward_offset',
+        'Message': 'CASE WHEN s.ServiceAction IS NULL THEN s.Message '
+                   'ELSE {} END'.format(_dict_sql('Message', dict_map))
+    }, where=where, params=params)
+    admin_log = _copy(conn, 'AdminLog', {
+        'ContextID': _CONTEXT_SQL,
+        'MediaID1': _media_sql('MediaID1'),
+        'MediaID2': _media_sql('MediaID2'),
+        'Data': _dict_sql('Data', dict_map)
+    }, where=where, params=params)
+    _copy(conn, 'ChatParticipants', {'ContextID': _CONTEXT_SQL},
+          where=where)
+    _copy(conn, 'MessageDeletion', {'ContextID': _CONTEXT_SQL},
+          where=where)
+
+    if _has_table(conn, 'MessageSearchID'):
+        last = conn.execute(
+            'SELECT COALESCE(MAX(RowID), 0) FROM MessageSearchID'
+        ).fetchone()[0]
+        conn.execute('INSERT OR IGNORE INTO MessageSearchID (ContextID, ID) '
+                     'SELECT ' + _CONTEXT_SQL + ', s.ID FROM src.Message s '
+                     'WHERE s.Message IS NOT NULL '
+                     'AND s.ServiceAction IS NULL AND ' + where)
+        conn.execute('INSERT INTO MessageSearch (rowid, Message) '
+                     'SELECT s.RowID, m.Message FROM MessageSearchID s '
+                     'JOIN Message m ON m.ContextID = s.ContextID '
+                     'AND m.ID = s.ID WHERE s.RowID > ?', (last,))
+
+    return messages, conflicts, admin_log
+
+
+def merge(dumper, filename, force=False):
+    """
+    Merges the export database with the given filename (and its shards,
+    if any) into the dumper's database, and returns a MergeReport.
+
+    The media and forwards of the source get new IDs, except for the
+    media which was already in the database, and everything else which
+    is already there is kept as it was. The source and its user are
+    saved in MergeSource, along with the contexts it had in MergedContext,
+    and the database keeps its own user (or that of the first source).
+    The private chats and small groups of sources from other accounts
+    get new context IDs (see _map_contexts), recorded in MergedContext.
+    Merging the same source twice raises ValueError unless forced.
+
+    The catalog is merged in a single transaction, and then the tables
+    of the contexts in a transaction per file of the destination.
+    """
+    start = time.time()
+    filename = os.path.abspath(filename)
+    catalog = next(f for _, name, f in dumper.conn.execute(
+        'PRAGMA database_list') if name == 'main')
+    if os.path.abspath(catalog) == filename:
+        raise ValueError('Cannot merge a database into itself')
+
+    source = _open_read_only(filename)
+    try:
+        if not _has_table(source, 'Version'):
+            raise ValueError('{} is not an export database'.format(filename))
+        version = source.execute('SELECT Version FROM Version').fetchone()[0]
+        if not MIN_SOURCE_VERSION <= version <= DB_VERSION:
+            raise ValueError('{} has version {}, open it with this version '
+                             'of telegram-export first to upgrade it'
+                             .format(filename, version))
+        self_id = (source.execute(
+            'SELECT UserID FROM SelfInformation').fetchone() or (None,))[0]
+        files = _context_files(source, filename)
+        dicts = source.execute(
+            'SELECT ID, DateCreated, Data FROM CompressionDict').fetchall()
+    finally:
+        source.close()
+
+    if not force and dumper.conn.execute(
+            'SELECT ID FROM MergeSource WHERE FileName = ? AND SelfID IS ?',
+            (filename, self_id)).fetchone():
+        raise ValueError('{} was already merged'.format(filename))
+
+    contexts = OrderedDict((f, _list_contexts(f)) for f in files)
+
+    # The catalog first, since every context may reference it
+    dumper.commit()
+    conn = dumper.conn
+    conn.execute('ATTACH DATABASE ? AS src', (filename,))
+    try:
+        media_offset, = conn.execute(
+            'SELECT COALESCE(MAX(ID), 0) FROM Media').fetchone()
+        forward_offset, = conn.execute(
+            'SELECT COALESCE(MAX(ID), 0) FROM Forward').fetchone()
+        source_id = conn.execute(
+            'INSERT INTO MergeSource (FileName, SelfID, DateMerged, '
+            'MediaOffset, ForwardOffset) VALUES (?, ?, ?, ?, ?)',
+            (filename, self_id, round(time.time()),
+             media_offset, forward_offset)).lastrowid
+        own_id = conn.execute(
+            'SELECT UserID FROM main.SelfInformation').fetchone()
+        context_map = _map_contexts(
+            conn, source_id, self_id,
+            [c for context_ids in contexts.values() for c in context_ids],
+            other_account=own_id is not None and own_id[0] != self_id)
+        # The database belongs to its user, or the first one merged
+        conn.execute('INSERT INTO SelfInformation (UserID) '
+                     'SELECT UserID FROM src.SelfInformation WHERE NOT '
+                     'EXISTS (SELECT 1 FROM main.SelfInformation)')
+        params = {'source': source_id, 'media_offset': media_offset,
+                  'forward_offset': forward_offset}
+        dict_map = _copy_dicts(conn, dicts)
+        media, duplicates, forwards, entities = _merge_catalog(
+            dumper, source_id, dict_map, params)
+        dumper.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute('DETACH DATABASE src')
+
+    messages = conflicts = admin_log = 0
+    for context_file, context_ids in contexts.items():
+        groups = OrderedDict()
+        for context_id in context_ids:
+            new_id = context_map[context_id]
+            key = shards.shard_key(new_id, dumper.shard_buckets) \
+                if dumper.shard_pool else None
+            groups.setdefault(key, {})[context_id] = new_id
+
+        for group in groups.values():
+            for new_id in group.values():
+                conn = dumper.context_conn(new_id)
+            dumper.commit()
+            if conn is dumper.conn:
+                _create_media_map(conn, 'main', source_id)
+            else:
+                # Shards read the map saved to the (committed) catalog
+                conn.execute('ATTACH DATABASE ? AS catalog', (catalog,))
+                try:
+                    _create_media_map(conn, 'catalog', source_id)
+                finally:
+                    conn.execute('DETACH DATABASE catalog')
+
+            conn.execute('ATTACH DATABASE ? AS src', (context_file,))
+            try:
+                _create_dict_map(conn, dict_map)
+                counts = _merge_contexts(conn, group, dict_map, params)
+                dumper.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute('DETACH DATABASE src')
+            messages += counts[0]
+            conflicts += counts[1]
+            admin_log += counts[2]
+
+    return MergeReport(
+        filename, media, duplicates, forwards, entities,
+        sum(len(c) for c in contexts.values()), messages, conflicts,
+        admin_log, time.time() - start
+    )
+
+
+def format_reports(reports):
+    """Returns a human-readable table for the given MergeReports"""
+    lines = ['{:<24} {:>9} {:>9} {:>9} {:>9} {:>8} {:>10} {:>9} {:>9} {:>7}'
+             .format('source', 'media', 'dup.', 'forwards', 'entities',
+                     'contexts', 'messages', 'conflicts', 'admin log',
+                     'seconds')]
+    for r in reports:
+        name = os.path.basename(r.filename)
+        lines.append(
+            '{:<24} {:>9} {:>9} {:>9} {:>9} {:>8} {:>10} {:>9} {:>9} {:>7.1f}'
+            .format(name if len(name) <= 24 else '...' + name[-21:],
+                    r.media, r.duplicate_media, r.forwards, r.entities,
+                    r.contexts, r.messages, r.conflicts, r.admin_log,
+                    r.seconds))
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Merge export databases into one, remapping the IDs '
+                    'of their media and forwards')
+    parser.add_argument('database',
+                        help='the export database to merge into, which is '
+                             'created if it does not exist')
+    parser.add_argument('sources', nargs='+',
+                        help='the export databases to merge into it')
+    parser.add_argument('--durability', choices=tuple(DURABILITY_PROFILES),
+                        default='safe',
+                        help='durability of the merged database while '
+                             'merging (see config.ini.example)')
+    parser.add_argument('--sharding', default='none',
+                        help='how to shard the database if it is created '
+                             '(see config.ini.example)')
+    parser.add_argument('--force', action='store_true',
+                        help='merge sources even if they were merged before')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    directory, filename = os.path.split(os.path.abspath(args.database))
+    name, ext = os.path.splitext(filename)
+    if ext != '.db':
+        print('The database file name must end in .db', file=sys.stderr)
+        return 1
+
+    config = configparser.ConfigParser()
+    config['Dumper'] = {'OutputDirectory': directory, 'DBFileName': name,
+                        'Durability': args.durability,
+                        'Sharding': args.sharding}
+    dumper = Dumper(config['Dumper'])
+    # New shards need a search index if the existing ones have it
+    dumper.full_text_search = any(
+        _has_table(conn, 'MessageSearchID')
+        for conn in dumper.iter_context_conns())
+
+    reports = []
+    try:
+        for source in args.sources:
+            try:
+                reports.append(merge(dumper, source, force=args.force))
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 1
+    finally:
+        dumper.close()
+        if reports:
+            print(format_reports(reports))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Counters and gauges describing an export run, which can be served in
+the Prometheus text format over HTTP or saved periodically as JSON lines.
+"""
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+__log__ = logging.getLogger(__name__)
+
+PREFIX = 'telegram_export_'
+
+# name: (type, help) of every metric that may be reported
+METRIC_TYPES = {
+    'requests_total': ('counter', 'Requests made to Telegram by type'),
+    'flood_wait_seconds_total': ('counter', 'Seconds spent in flood waits'),
+    'reconnects_total': ('counter', 'Reconnections after losing the '
+                                    'connection'),
+    'migrations_total': ('counter', 'Downloads retried in another DC'),
+    'messages_total': ('counter', 'Messages dumped'),
+    'entities_total': ('counter', 'Users, chats and channels dumped'),
+    'media_total': ('counter', 'Media dumped'),
+    'downloaded_bytes_total': ('counter', 'Bytes of media downloaded'),
+    'commit_seconds': ('summary', 'Time taken by database commits'),
+    'queue_depth': ('gauge', 'Items waiting in a queue by queue name'),
+}
+
+
+def _format_labels(labels):
+    """Formats a tuple of (label, value) pairs as {label="value",...}"""
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ))
+
+
+class Metrics:
+    """
+    A thread-safe collection of metrics, each being a number for every
+    combination of labels. Summaries keep the count and sum of all the
+    values observed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # {(name, labels): value}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """Increments the given counter by value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets the given gauge to value"""
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """Adds an observation to the given summary"""
+        self.inc(name + '_count', 1, **labels)
+        self.inc(name + '_sum', value, **labels)
+
+    def snapshot(self):
+        """
+        Returns a JSON-serializable dictionary with the time and the
+        value of every metric, named as in Prometheus (with labels).
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        result = {'time': time.time(), 'uptime': time.time() - self.started}
+        for (name, labels), value in values:
+            result[name + _format_labels(labels)] = value
+        return result
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = []
+        for name, (kind, description) in METRIC_TYPES.items():
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+            for (key, labels), value in values:
+                if key == name or (kind == 'summary' and key in (
+                        name + '_count', name + '_sum')):
+                    lines.append('{}{}{} {}'.format(
+                        PREFIX, key, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves the metrics over HTTP (on any path) from a daemon thread,
+        and returns the server so it can be shut down.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                __log__.debug(fmt, *args)
+
+        server = HTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        __log__.info('Serving metrics on http://%s:%d/metrics', host, port)
+        return server
+
+    def write_snapshots(self, filename, interval=60):
+        """
+        Appends a snapshot as a JSON line to filename every interval
+        seconds from a daemon thread. Returns a function to stop it,
+        which writes one last snapshot.
+        """
+        stop = threading.Event()
+
+        def write():
+            with open(filename, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+
+        def loop():
+            while not stop.wait(interval):
+                write()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+        def finish():
+            stop.set()
+            write()
+        return finish
+
+
+# The metrics of the current run, updated by the Downloader and Dumper
+REGISTRY = Metrics()
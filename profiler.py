@@ -0,0 +1,224 @@
+"""
+Low-overhead timers for the phases of an export (network, serialization,
+inserts, commits, media and sleeps), reported per dialog and overall,
+and tracemalloc snapshots to find where memory is allocated.
+"""
+import json
+import os
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+# The phases timed, in the order they are reported
+PHASES = ('network', 'serialize', 'insert', 'commit', 'media', 'sleep')
+
+# Time spent outside of any dialog is reported under this name
+NO_DIALOG = '<no dialog>'
+
+
+class _NullPhase:
+    """Times nothing, used while the profiler is disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    """Times a phase for the profiler when used as a context manager"""
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, self.start, perf_counter())
+        return False
+
+
+class Profiler:
+    """
+    Accumulates the time spent in every phase, per dialog. Timing is
+    disabled until enable() is called, so the phases cost almost
+    nothing during normal runs. If trace is enabled, every timed phase
+    is also kept to be saved as Chrome trace events.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.current_dialog = NO_DIALOG
+        self.started = perf_counter()
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: [0, 0.0])  # {(dialog, phase)}
+        self._events = []  # (phase, dialog, start, end, thread ID)
+
+    def enable(self, trace=False):
+        """Starts timing the phases, keeping every one if trace is set"""
+        self.enabled = True
+        self.trace = trace
+        self.started = perf_counter()
+
+    def phase(self, name):
+        """Returns a context manager timing the given phase"""
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def add(self, name, start, end):
+        """Adds a timed phase, between the given perf_counter values"""
+        with self._lock:
+            totals = self._totals[(self.current_dialog, name)]
+            totals[0] += 1
+            totals[1] += end - start
+            if self.trace:
+                self._events.append((name, self.current_dialog, start, end,
+                                     threading.get_ident()))
+
+    @contextmanager
+    def dialog(self, name):
+        """Attributes the phases timed inside to the given dialog"""
+        previous = self.current_dialog
+        self.current_dialog = name
+        try:
+            yield
+        finally:
+            self.current_dialog = previous
+
+    def report(self):
+        """
+        Returns a human-readable breakdown of the time spent in every
+        phase, per dialog (slowest first) and overall.
+        """
+        with self._lock:
+            totals = dict(self._totals)
+        wall = perf_counter() - self.started
+
+        dialogs = defaultdict(dict)
+        overall = defaultdict(lambda: [0, 0.0])
+        for (dialog, name), (count, seconds) in totals.items():
+            dialogs[dialog][name] = (count, seconds)
+            overall[name][0] += count
+            overall[name][1] += seconds
+
+        def fmt_table(title, phases, total):
+            lines = ['{} ({:.2f}s)'.format(title, total)]
+            for name in PHASES:
+                if name in phases:
+                    count, seconds = phases[name]
+                    lines.append('  {:<10} {:>10.3f}s {:>6.1%} {:>9} calls'
+                                 .format(name, seconds,
+                                         seconds / total if total else 0,
+                                         count))
+            return lines
+
+        lines = []
+        for dialog, phases in sorted(
+                dialogs.items(),
+                key=lambda t: sum(s for _, s in t[1].values()),
+                reverse=True):
+            lines.extend(fmt_table(dialog, phases,
+                                   sum(s for _, s in phases.values())))
+
+        lines.extend(fmt_table('Overall', overall, wall))
+        untimed = wall - sum(s for _, s in overall.values())
+        lines.append('  {:<10} {:>10.3f}s {:>6.1%}'.format(
+            'other', untimed, untimed / wall if wall else 0))
+        return '\n'.join(lines)
+
+    def save_trace(self, filename):
+        """
+        Saves the timed phases as a Chrome trace-event JSON file, which
+        can be opened in chrome://tracing or Perfetto.
+        """
+        with self._lock:
+            events = list(self._events)
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': [{
+                'name': name,
+                'cat': dialog,
+                'ph': 'X',
+                'ts': (start - self.started) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': thread,
+                'args': {'dialog': dialog}
+            } for name, dialog, start, end, thread in events]}, f)
+
+
+class MemoryProfiler:
+    """
+    Takes a tracemalloc snapshot after every phase (e.g. every dialog)
+    to report how much memory grew during it, and the top lines of code
+    where that memory was allocated.
+    """
+    def __init__(self, top=10):
+        self.enabled = False
+        self.top = top
+        self._previous = None
+        self._reports = []
+
+    def enable(self):
+        """Starts tracing memory allocations"""
+        tracemalloc.start()
+        self.enabled = True
+        self._previous = self._take_snapshot()
+
+    @staticmethod
+    def _take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+    def snapshot(self, phase):
+        """
+        Records the memory allocated since the last phase, and the peak
+        during it (or since the start, before Python 3.9).
+        """
+        if not self.enabled:
+            return
+
+        snapshot = self._take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        resets_peak = hasattr(tracemalloc, 'reset_peak')  # Python 3.9+
+        lines = ['{}: {:.1f} MiB allocated, {:.1f} MiB peak{}'.format(
+            phase, current / 2**20, peak / 2**20,
+            '' if resets_peak else ' since start')]
+        lines.extend('  {}'.format(stat) for stat in
+                     snapshot.compare_to(self._previous, 'lineno')[:self.top])
+        self._reports.append('\n'.join(lines))
+        # Only the last snapshot is kept, or we would be the problem
+        self._previous = snapshot
+        if resets_peak:
+            tracemalloc.reset_peak()
+
+    def report(self):
+        """
+        Returns the growth of every phase, followed by the top lines of
+        code by the memory they have allocated and is still alive.
+        """
+        if not self.enabled:
+            return ''
+        lines = list(self._reports)
+        lines.append('Top allocations overall:')
+        lines.extend('  {}'.format(stat) for stat in
+                     self._take_snapshot().statistics('lineno')[:self.top])
+        return '\n'.join(lines)
+
+
+# The profilers of the current run, used by the Downloader and Dumper
+PROFILER = Profiler()
+MEMORY_PROFILER = MemoryProfiler()
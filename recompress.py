@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+(Re)compresses the large columns of an existing export database with a
+dictionary trained on all of it, or decompresses them, and reports the
+size and CPU time traded.
+"""
+import argparse
+import configparser
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+import compression
+from compression import ColumnCompressor
+from dumper import Dumper
+
+# (table, column, primary key, condition) of every compressed column
+COLUMNS = (
+    ('Media', 'Extra', ('ID',), None),
+    ('AdminLog', 'Data', ('ID', 'ContextID'), None),
+    ('Message', 'Message', ('ID', 'ContextID'), 'ServiceAction IS NOT NULL'),
+)
+
+# Rows rewritten per batch, and values used to train the dictionary
+BATCH_SIZE = 10000
+TRAIN_SAMPLES = 10000
+
+ColumnReport = namedtuple('ColumnReport', (
+    'table', 'column', 'rows', 'size_plain', 'size_before', 'size_after',
+    'compress_seconds', 'decompress_seconds'
+))
+
+
+def _iter_values(conn, table, column, key, condition):
+    """Yields lists of up to BATCH_SIZE (key..., value) rows, seeking by key"""
+    where = '{} IS NOT NULL'.format(column)
+    if condition:
+        where += ' AND ' + condition
+    query = ('SELECT {key}, {column} FROM {table} WHERE {where} '
+             'AND ({key}) > ({marks}) ORDER BY {key} LIMIT ?'.format(
+                 key=', '.join(key), column=column, table=table,
+                 where=where, marks=', '.join('?' * len(key))))
+    last = (float('-inf'),) * len(key)
+    while True:
+        rows = conn.execute(query, last + (BATCH_SIZE,)).fetchall()
+        if not rows:
+            break
+        yield rows
+        last = rows[-1][:len(key)]
+
+
+def _column_size(conn, table, column, condition):
+    """Returns the bytes used by the values of the column"""
+    return conn.execute('SELECT TOTAL(LENGTH(CAST({} AS BLOB))) FROM {}{}'
+                        .format(column, table,
+                                ' WHERE ' + condition if condition else '')
+                        ).fetchone()[0]
+
+
+def _column_conns(dumper, table):
+    """
+    Yields the connections with the given table, which are the shards
+    for the tables of single contexts if the database is sharded.
+    """
+    if table == 'Media':
+        return iter((dumper.conn,))
+    return dumper.iter_context_conns()
+
+
+def _sample(dumper, compressor, count):
+    """Returns up to count decompressed values (as bytes) to train with"""
+    samples = []
+    for table, column, _, condition in COLUMNS:
+        where = '{} IS NOT NULL'.format(column)
+        if condition:
+            where += ' AND ' + condition
+        for conn in _column_conns(dumper, table):
+            for value, in conn.execute(
+                    'SELECT {} FROM {} WHERE {} ORDER BY random() LIMIT ?'
+                    .format(column, table, where), (count,)):
+                value = compressor.decompress(value)
+                samples.append(value.encode('utf-8')
+                               if isinstance(value, str) else value)
+    random.shuffle(samples)
+    return samples[:count]
+
+
+def recompress(dumper, codec, level=3, dict_size=compression.DICT_SIZE,
+               samples=TRAIN_SAMPLES):
+    """
+    Rewrites the compressed columns of the dumper's database (and its
+    shards) with the given codec ('zstd', 'zlib' or None to decompress
+    them), training a new dictionary for zstd first, and returns a
+    ColumnReport for each.
+    """
+    old = ColumnCompressor(dumper.conn)
+    new = ColumnCompressor(dumper.conn, codec, level=level,
+                           dict_size=dict_size)
+    if new.codec == 'zstd':
+        new.train(_sample(dumper, old, samples))
+
+    reports = []
+    for table, column, key, condition in COLUMNS:
+        rows = size_plain = size_before = size_after = 0
+        compress_seconds = decompress_seconds = 0
+        for conn in _column_conns(dumper, table):
+            size_before += _column_size(conn, table, column, condition)
+            for batch in _iter_values(conn, table, column, key, condition):
+                values = [old.decompress(row[-1]) for row in batch]
+                size_plain += sum(len(value.encode('utf-8'))
+                                  if isinstance(value, str) else len(value)
+                                  for value in values)
+                start = time.process_time()
+                values = [new.compress(value) for value in values]
+                compress_seconds += time.process_time() - start
+                conn.executemany(
+                    'UPDATE {} SET {} = ? WHERE {}'.format(
+                        table, column,
+                        ' AND '.join(k + ' = ?' for k in key)),
+                    ((value,) + row[:-1] for value, row in zip(values, batch))
+                )
+                rows += len(batch)
+
+            for batch in _iter_values(conn, table, column, key, condition):
+                start = time.process_time()
+                for row in batch:
+                    new.decompress(row[-1])
+                decompress_seconds += time.process_time() - start
+            size_after += _column_size(conn, table, column, condition)
+
+        reports.append(ColumnReport(
+            table, column, rows, size_plain, size_before, size_after,
+            compress_seconds, decompress_seconds
+        ))
+
+    # Every value was rewritten, so only the new dictionary is in use
+    dumper.conn.execute('DELETE FROM CompressionDict WHERE ID != ?',
+                        (new.dict_id,))
+    dumper.commit()
+    return reports
+
+
+def format_reports(reports):
+    """Returns a human-readable table for the given ColumnReports"""
+    lines = ['{:<16} {:>9} {:>10} {:>10} {:>6} {:>10} {:>10}'.format(
+        'column', 'rows', 'before', 'after', 'ratio',
+        'comp. MB/s', 'dec. MB/s')]
+    for r in reports:
+        # Speeds are in terms of the uncompressed data
+        plain = r.size_plain / 2**20
+        lines.append(
+            '{:<16} {:>9} {:>9.1f}M {:>9.1f}M {:>6.2f} {:>10} {:>10}'.format(
+                '{}.{}'.format(r.table, r.column), r.rows,
+                r.size_before / 2**20, r.size_after / 2**20,
+                r.size_before / r.size_after if r.size_after else 0,
+                '{:.1f}'.format(plain / r.compress_seconds)
+                if r.compress_seconds else '-',
+                '{:.1f}'.format(plain / r.decompress_seconds)
+                if r.decompress_seconds else '-'
+            ))
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compress (or decompress) the large columns of an '
+                    'existing export database and report the savings')
+    parser.add_argument('database', help='the export database file')
+    parser.add_argument('--codec', choices=('zstd', 'zlib', 'none'),
+                        default='zstd', help='how to compress the columns, '
+                                             'or none to decompress them')
+    parser.add_argument('--level', type=int, default=3,
+                        help='the compression level')
+    parser.add_argument('--dict-size', type=int,
+                        default=compression.DICT_SIZE,
+                        help='size in bytes of the zstd dictionary')
+    parser.add_argument('--samples', type=int, default=TRAIN_SAMPLES,
+                        help='values to train the zstd dictionary with')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='vacuum the database after, to shrink the file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    directory, filename = os.path.split(os.path.abspath(args.database))
+    name, ext = os.path.splitext(filename)
+    if ext != '.db':
+        print('The database file name must end in .db', file=sys.stderr)
+        return 1
+
+    config = configparser.ConfigParser()
+    config['Dumper'] = {'OutputDirectory': directory, 'DBFileName': name,
+                        'Durability': 'safe'}
+    dumper = Dumper(config['Dumper'])
+    file_before = os.path.getsize(args.database)
+
+    reports = recompress(
+        dumper, None if args.codec == 'none' else args.codec,
+        level=args.level, dict_size=args.dict_size, samples=args.samples
+    )
+    if args.vacuum:
+        dumper.conn.execute('VACUUM')
+        if dumper.shard_pool:
+            for conn in dumper.iter_context_conns():
+                conn.execute('VACUUM')
+    dumper.close()
+
+    print(format_reports(reports))
+    print('Database file: {:.1f}M -> {:.1f}M{}'.format(
+        file_before / 2**20, os.path.getsize(args.database) / 2**20,
+        '' if args.vacuum else ' (use --vacuum to shrink it)'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
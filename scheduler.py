@@ -0,0 +1,203 @@
+"""
+A scheduler to export dialogs continuously, checking every dialog more
+or less often depending on how many messages it usually gets.
+"""
+import logging
+import math
+import time
+from collections import deque, namedtuple
+
+from telethon import utils
+
+__log__ = logging.getLogger(__name__)
+
+# The recent activity of a dialog is measured over this many seconds
+RATE_WINDOW = 30 * 24 * 60 * 60
+
+# No dialog is checked more often or less often than this (in seconds)
+MIN_INTERVAL = 5 * 60
+MAX_INTERVAL = 7 * 24 * 60 * 60
+
+# How often the list of dialogs to export is fetched again (in seconds)
+DIALOGS_INTERVAL = 24 * 60 * 60
+
+# Requests every check makes besides those to get the history
+CHECK_OVERHEAD = 2
+
+# Messages assumed to be waiting in a dialog never checked nor dumped,
+# whose backlog can't be estimated from its rate of messages
+UNKNOWN_BACKLOG = 5000
+
+# Dialogs which fail to export are checked again after this many seconds,
+# doubled after every consecutive failure (up to MAX_INTERVAL)
+FAILURE_BACKOFF = MIN_INTERVAL
+
+ScheduleEntry = namedtuple(
+    'ScheduleEntry', 'context_id name next_check last_check rate backlog'
+)
+
+
+class Scheduler:
+    """
+    Decides when every dialog should be exported next, and exports
+    them when they are due with the given Downloader and Dumper.
+
+    Every dialog is checked once it is expected to have about a chunk
+    of new messages, based on its rate of messages, so busy dialogs are
+    checked often and quiet ones seldom. No more than requests_per_hour
+    requests (as estimated from the expected backlog) are spent per hour.
+    Dialogs which fail to export are retried later, backing off.
+    """
+    def __init__(self, dumper, downloader, requests_per_hour=1200):
+        self.dumper = dumper
+        self.downloader = downloader
+        self.requests_per_hour = max(requests_per_hour, 1)
+        self._spent = deque()  # (timestamp, requests)
+        self._failures = {}  # {context_id: consecutive failures}
+
+    def get_rate(self, context_id, now=None):
+        """
+        Returns the estimated amount of messages per second the given
+        context gets, from the messages dumped during the last
+        RATE_WINDOW. Contexts without recent messages get a rate as
+        small as the time passed since their last message.
+        """
+        now = now or time.time()
+        count, last_date = self.dumper.get_activity(context_id,
+                                                    now - RATE_WINDOW)
+        if not last_date:
+            return 1 / MAX_INTERVAL
+        return max(count / RATE_WINDOW, 1 / max(now - last_date, 1))
+
+    def get_interval(self, rate):
+        """Returns after how many seconds a context should be checked"""
+        interval = self.dumper.chunk_size / rate if rate else MAX_INTERVAL
+        return min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+    def get_cost(self, backlog):
+        """Returns how many requests checking the given backlog takes"""
+        return CHECK_OVERHEAD + math.ceil(backlog / self.dumper.chunk_size)
+
+    def estimate_backlog(self, context_id, now=None):
+        """
+        Returns the expected backlog of a context which was never
+        checked: the messages since the last one dumped, if any, or
+        UNKNOWN_BACKLOG otherwise (its whole history has to be saved).
+        """
+        now = now or time.time()
+        _, last_date = self.dumper.get_activity(context_id, now)
+        if not last_date:
+            return UNKNOWN_BACKLOG
+        return self.get_rate(context_id, now) * max(now - last_date, 0)
+
+    def add(self, context_ids):
+        """Schedules the given contexts (if new) to be checked now"""
+        known = {row[0] for row in self.dumper.get_schedule()}
+        now = round(time.time())
+        for context_id in context_ids:
+            if context_id not in known:
+                self.dumper.save_schedule(context_id, now, None,
+                                          self.get_rate(context_id, now))
+        self.dumper.commit()
+
+    def reschedule(self, context_id, now=None):
+        """Schedules the next check of a context that was just checked"""
+        now = round(now or time.time())
+        rate = self.get_rate(context_id, now)
+        self.dumper.save_schedule(
+            context_id, round(now + self.get_interval(rate)), now, rate)
+
+    def backoff(self, entry, now=None):
+        """
+        Schedules the next check of the given ScheduleEntry, whose
+        context failed to export, after FAILURE_BACKOFF seconds doubled
+        for every consecutive failure, and returns that delay.
+        """
+        now = round(now or time.time())
+        failures = self._failures.get(entry.context_id, 0) + 1
+        self._failures[entry.context_id] = failures
+        delay = min(FAILURE_BACKOFF * 2 ** (failures - 1), MAX_INTERVAL)
+        self.dumper.save_schedule(entry.context_id, now + delay,
+                                  entry.last_check, entry.rate)
+        return delay
+
+    def status(self, now=None):
+        """
+        Returns a list of ScheduleEntry with every scheduled context
+        and its expected backlog (messages since it was last checked),
+        with the ones due first.
+        """
+        now = now or time.time()
+        return [
+            ScheduleEntry(context_id, name, next_check, last_check, rate,
+                          rate * (now - last_check) if last_check else None)
+            for context_id, next_check, last_check, rate, name
+            in self.dumper.get_schedule()
+        ]
+
+    def _wait_for_budget(self, requests, now):
+        """
+        Returns how many seconds to wait before the given amount of
+        requests can be spent, or 0 if they can be right now.
+        """
+        while self._spent and self._spent[0][0] <= now - 3600:
+            self._spent.popleft()
+
+        spent = sum(count for _, count in self._spent)
+        if not self._spent or spent + requests <= self.requests_per_hour:
+            return 0
+        return self._spent[0][0] + 3600 - now
+
+    def run(self, get_entities):
+        """
+        Exports the due dialogs forever (until interrupted). The dialogs
+        to export are those returned by get_entities(), which is called
+        again every DIALOGS_INTERVAL, and those no longer returned stop
+        being scheduled.
+        """
+        entities = {}
+        last_refresh = 0
+        while True:
+            now = time.time()
+            if now - last_refresh > DIALOGS_INTERVAL:
+                entities = {utils.get_peer_id(e): e for e in get_entities()}
+                self.add(entities)
+                last_refresh = now
+
+            entry = next(iter(self.status(now)), None)
+            if entry is None:
+                time.sleep(max(last_refresh + DIALOGS_INTERVAL - now, 1))
+                continue
+            if entry.context_id not in entities:
+                self.dumper.delete_schedule(entry.context_id)
+                self.dumper.commit()
+                continue
+            if entry.next_check > now:
+                time.sleep(min(entry.next_check,
+                               last_refresh + DIALOGS_INTERVAL) - now)
+                continue
+
+            backlog = entry.backlog
+            if backlog is None:
+                backlog = self.estimate_backlog(entry.context_id, now)
+            cost = self.get_cost(backlog)
+            wait = self._wait_for_budget(cost, now)
+            if wait:
+                __log__.info('Request budget spent, waiting %ds', wait)
+                time.sleep(wait)
+                continue
+
+            # Failed checks still count, since they may have made requests
+            self._spent.append((now, cost))
+            __log__.info('Checking %s (%s)', entry.name, entry.context_id)
+            try:
+                self.downloader.save_messages(self.dumper,
+                                              entities[entry.context_id])
+            except Exception:
+                delay = self.backoff(entry)
+                __log__.exception('Failed to export %s (%s), retrying in '
+                                  '%ds', entry.name, entry.context_id, delay)
+            else:
+                self._failures.pop(entry.context_id, None)
+                self.reschedule(entry.context_id)
+            self.dumper.commit()
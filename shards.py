@@ -0,0 +1,116 @@
+"""
+Layout of sharded export databases, where the messages (and everything
+else belonging to a single context, like its admin log or where to
+resume) of every context or hash bucket of contexts are stored in their
+own database file, next to a catalog database with the rest.
+
+Different contexts can then be exported by different processes, which
+only share the (much less busy) catalog.
+"""
+import os
+from collections import OrderedDict
+
+# Appended to the catalog's name (without .db) for the shards directory
+SHARDS_SUFFIX = '.shards'
+
+# Shard connections kept open at once, the least recently used first
+MAX_OPEN_SHARDS = 32
+
+
+def parse_sharding(value):
+    """
+    Parses the Sharding option ('none', 'context' or a number of hash
+    buckets) into the buckets stored in the catalog: None if not
+    sharded, 0 for a shard per context, or the number of buckets.
+    """
+    value = (value or 'none').strip().lower()
+    if value == 'none':
+        return None
+    if value == 'context':
+        return 0
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise ValueError('Unknown sharding {}, must be none, context or '
+                     'a number of buckets'.format(value))
+
+
+def shard_key(context_id, buckets):
+    """Returns the key of the shard the given context belongs to"""
+    return context_id % buckets if buckets else context_id
+
+
+def get_buckets(conn):
+    """
+    Returns the buckets of the catalog with the given connection, as
+    returned by parse_sharding, or None if it's not sharded.
+    """
+    if not conn.execute("SELECT name FROM sqlite_master "
+                        "WHERE type='table' AND name='Sharding'").fetchone():
+        return None
+    row = conn.execute("SELECT Buckets FROM Sharding").fetchone()
+    return row[0] if row else None
+
+
+def get_directory(conn):
+    """Returns the shards directory of the catalog with the given connection"""
+    for _, name, filename in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return os.path.splitext(filename)[0] + SHARDS_SUFFIX
+
+
+def shard_filename(directory, key):
+    """Returns the filename of the shard with the given key"""
+    return os.path.join(directory, 'shard{}.db'.format(key))
+
+
+class ShardPool:
+    """
+    Connections to the shards in a directory, opened on first use by
+    connect(filename), which may return None if the shard shouldn't be
+    opened (e.g. because it doesn't exist). Only up to max_open stay
+    open; before_close(conn) is called before closing the least
+    recently used, which commits its changes by default.
+    """
+    def __init__(self, directory, buckets, connect,
+                 max_open=MAX_OPEN_SHARDS, before_close=None):
+        self.directory = directory
+        self.buckets = buckets
+        self._connect = connect
+        self._before_close = before_close or (lambda conn: conn.commit())
+        self.max_open = max(max_open, 1)
+        self._conns = OrderedDict()
+
+    def filename(self, key):
+        """Returns the filename of the shard with the given key"""
+        return shard_filename(self.directory, key)
+
+    def get(self, context_id):
+        """Returns the connection to the shard of the given context"""
+        return self.get_shard(shard_key(context_id, self.buckets))
+
+    def get_shard(self, key):
+        """Returns the connection to the shard with the given key"""
+        conn = self._conns.get(key)
+        if conn is not None:
+            self._conns.move_to_end(key)
+            return conn
+
+        conn = self._connect(self.filename(key))
+        if conn is not None:
+            self._conns[key] = conn
+            if len(self._conns) > self.max_open:
+                old = next(iter(self._conns.values()))
+                self._before_close(old)
+                self._conns.popitem(last=False)
+                old.close()
+        return conn
+
+    def open_conns(self):
+        """Returns the connections which are currently open"""
+        return list(self._conns.values())
+
+    def close(self):
+        """Closes all the open connections, without committing them"""
+        while self._conns:
+            _, conn = self._conns.popitem()
+            conn.close()
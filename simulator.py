@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+A simulated Telegram backend, serving synthetic dialogs to the Downloader
+so that whole exports can be run offline and deterministically, and an
+end-to-end benchmark running them under different network profiles.
+
+The simulated time is kept by a VirtualClock, which the Downloader also
+sleeps on, so that latency, flood waits and reconnections cost nothing
+but are still accounted for in the reported throughput.
+"""
+import argparse
+import configparser
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from telethon import utils
+from telethon.errors import FileMigrateError, FloodWaitError
+from telethon.tl import functions, types
+
+from bench import SELF_ID, make_entities, make_media
+from downloader import Downloader
+from dumper import Dumper
+
+# The DC the simulated account lives in, and those files may be stored in
+HOME_DC = 2
+DCS = (1, 2, 3, 4, 5)
+
+# How the simulated network behaves. Times are in seconds.
+#   latency, jitter: every request takes latency plus up to jitter
+#   flood_wait_rate, flood_wait: chance of a flood wait, and its length
+#   disconnect_rate, reconnect_time: chance of losing the connection
+#       before a request, and how long reconnecting takes
+#   migrate_time: time to connect to another DC the first time a file
+#       stored there is downloaded
+#   bandwidth: bytes per second downloaded, or None if unlimited
+Profile = namedtuple('Profile', (
+    'latency', 'jitter', 'flood_wait_rate', 'flood_wait',
+    'disconnect_rate', 'reconnect_time', 'migrate_time', 'bandwidth'
+))
+
+PROFILES = {
+    'ideal': Profile(0, 0, 0, 0, 0, 0, 0, None),
+    'typical': Profile(0.15, 0.05, 0, 0, 0, 0, 1, 2**20),
+    'flood': Profile(0.15, 0.05, 0.05, 30, 0, 0, 1, 2**20),
+    'flaky': Profile(0.3, 0.2, 0, 0, 0.05, 5, 1, 256 * 1024),
+    'migrate': Profile(0.15, 0.05, 0, 0, 0, 0, 5, 2**20),
+}
+
+# The requests which the Downloader invokes itself
+SIMULATED_REQUESTS = (
+    'GetHistoryRequest', 'GetAdminLogRequest', 'GetFullUserRequest',
+    'GetFullChannelRequest'
+)
+
+# What iter_dialogs yields, with only what the Downloader uses
+SimulatedDialog = namedtuple('SimulatedDialog', 'id entity dialog pinned')
+_DialogInfo = namedtuple('_DialogInfo', 'top_message')
+
+
+class VirtualClock:
+    """A clock whose time only advances when sleeping on it"""
+    def __init__(self, now=None):
+        self.now = time.time() if now is None else now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class SimulatedClient:
+    """
+    Implements the parts of TelegramClient used by the Downloader over
+    synthetic dialogs: users, small groups and megagroups with the given
+    amount of messages and participants each.
+
+    Every request takes time on the clock as given by the profile, and
+    may fail with a FloodWaitError or a ConnectionError, after which
+    connect() must be called. Downloading a file from a DC for the first
+    time fails with a FileMigrateError, and the next attempt connects to
+    that DC. The same seed always results in the same dialogs and failures.
+    """
+    def __init__(self, profile=PROFILES['ideal'], dialogs=10, messages=1000,
+                 participants=50, admin_log_events=20, media_size=16 * 1024,
+                 clock=None, seed=0):
+        self.profile = profile
+        self.messages = messages
+        self.admin_log_events = admin_log_events
+        self.media_size = media_size
+        self.clock = clock or VirtualClock()
+        self.seed = seed
+        self.stats = Counter()
+        self._rng = random.Random(seed)
+        self._connected = True
+        self._dcs = {HOME_DC}  # Connected to
+        self._known_dcs = {HOME_DC}  # Told to migrate to
+
+        self.users = {
+            i: types.User(id=i, access_hash=i * 7, first_name='User',
+                          last_name=str(i), username='user{}'.format(i))
+            for i in range(1000, 1000 + max(participants, 1) * 2)
+        }
+        self.dialogs = []  # [(entity, participants)]
+        user_ids = list(self.users)
+        for i in range(dialogs):
+            members = self._rng.sample(user_ids, max(participants, 1))
+            if i % 4 == 2:
+                entity = types.Chat(id=100 + i, title='Chat {}'.format(i),
+                                    photo=types.ChatPhotoEmpty(),
+                                    participants_count=len(members),
+                                    date=datetime(2017, 1, 1), version=1)
+            elif i % 4 == 3:
+                entity = types.Channel(id=200 + i, title='Group {}'.format(i),
+                                       photo=types.ChatPhotoEmpty(),
+                                       date=datetime(2017, 1, 1), version=1,
+                                       megagroup=True, access_hash=i * 13)
+            else:
+                entity = self.users[members[0]]
+                members = [SELF_ID, entity.id]
+            self.dialogs.append((entity, members))
+        self._by_id = {utils.get_peer_id(e): (e, m) for e, m in self.dialogs}
+
+    def _invoke(self, name, raise_errors=True):
+        """
+        Accounts for a request to Telegram, which may lose the connection
+        or fail with a flood wait, raising ConnectionError or FloodWaitError
+        unless raise_errors is False.
+
+        The Downloader only handles the errors of the requests it makes
+        itself and of downloads, so those of the other client methods
+        (iterating dialogs or participants) are waited as if the library
+        reconnected or slept through them.
+        """
+        if not self._connected:
+            raise ConnectionError('Not connected, call connect() first')
+
+        self.stats['requests'] += 1
+        self.stats[name] += 1
+        profile = self.profile
+        if self._rng.random() < profile.disconnect_rate:
+            self.stats['disconnects'] += 1
+            if raise_errors:
+                self._connected = False
+                raise ConnectionError('Simulated disconnection')
+            self.clock.sleep(profile.reconnect_time)
+
+        self.clock.sleep(profile.latency + self._rng.random() * profile.jitter)
+        if self._rng.random() < profile.flood_wait_rate:
+            self.stats['flood_waits'] += 1
+            if raise_errors:
+                raise FloodWaitError(capture=profile.flood_wait)
+            self.clock.sleep(profile.flood_wait)
+
+    def _connect_dc(self, dc_id):
+        """
+        Raises FileMigrateError the first time a file is in another DC,
+        and connects to it the next time.
+        """
+        if dc_id in self._dcs:
+            return
+        if dc_id not in self._known_dcs:
+            self._known_dcs.add(dc_id)
+            raise FileMigrateError(capture=dc_id)
+        self._dcs.add(dc_id)
+        self.stats['migrations'] += 1
+        self.clock.sleep(self.profile.migrate_time)
+
+    def _make_message(self, entity, members, msg_id):
+        """Makes the given message of a dialog, always the same one"""
+        context_id = utils.get_peer_id(entity)
+        if isinstance(entity, types.User):
+            peer = types.PeerUser(entity.id)
+        elif isinstance(entity, types.Chat):
+            peer = types.PeerChat(entity.id)
+        else:
+            peer = types.PeerChannel(entity.id)
+        rng = random.Random('{}:{}:{}'.format(self.seed, context_id, msg_id))
+        text = 'message {} '.format(msg_id) * rng.randrange(1, 10)
+        return types.Message(
+            id=msg_id,
+            to_id=peer,
+            date=datetime(2017, 1, 1) + timedelta(minutes=msg_id),
+            message=text,
+            from_id=rng.choice(members),
+            reply_to_msg_id=rng.randrange(1, msg_id + 1)
+            if rng.random() < 0.1 else None,
+            media=make_media(rng, context_id * 1000003 + msg_id)
+            if rng.random() < 0.1 else None,
+            entities=make_entities(rng, len(text))
+        )
+
+    def __call__(self, request):
+        """Invokes one of the SIMULATED_REQUESTS, or raises ValueError"""
+        name = type(request).__name__
+        if name not in SIMULATED_REQUESTS:
+            raise ValueError('{} is not simulated, only the requests made '
+                             'by the Downloader are ({})'.format(
+                                 name, ', '.join(SIMULATED_REQUESTS)))
+        self._invoke(name)
+        if isinstance(request, functions.messages.GetHistoryRequest):
+            context_id = utils.get_peer_id(request.peer)
+            entity, members = self._by_id[context_id]
+            top = request.offset_id - 1 if request.offset_id else self.messages
+            top = min(top, self.messages)
+            messages = [self._make_message(entity, members, i) for i in
+                        range(top, max(top - request.limit, 0), -1)]
+            senders = {m.from_id for m in messages}
+            return types.messages.MessagesSlice(
+                count=self.messages, messages=messages,
+                chats=[] if isinstance(entity, types.User) else [entity],
+                users=[self.users[i] for i in senders if i in self.users]
+            )
+
+        if isinstance(request, functions.channels.GetAdminLogRequest):
+            top = request.max_id - 1 if request.max_id else \
+                self.admin_log_events
+            return types.channels.AdminLogResults(events=[
+                types.ChannelAdminLogEvent(
+                    id=i, date=datetime(2017, 1, 1) + timedelta(minutes=i),
+                    user_id=SELF_ID,
+                    action=types.ChannelAdminLogEventActionChangeTitle(
+                        'Title {}'.format(i - 1), 'Title {}'.format(i))
+                ) for i in range(top, max(top - request.limit, 0), -1)
+            ], chats=[], users=[])
+
+        if isinstance(request, functions.users.GetFullUserRequest):
+            user = self.users[utils.get_peer_id(request.id)]
+            return types.UserFull(
+                user=user, link=types.contacts.Link(
+                    types.ContactLinkNone(), types.ContactLinkNone(), user),
+                notify_settings=types.PeerNotifySettings(0, 'default'),
+                common_chats_count=1, about='About {}'.format(user.id)
+            )
+
+        if isinstance(request, functions.channels.GetFullChannelRequest):
+            channel, members = self._by_id[utils.get_peer_id(request.channel)]
+            return types.messages.ChatFull(
+                full_chat=types.ChannelFull(
+                    id=channel.id, about='About {}'.format(channel.id),
+                    read_inbox_max_id=0, read_outbox_max_id=0,
+                    unread_count=0, chat_photo=types.PhotoEmpty(0),
+                    notify_settings=types.PeerNotifySettings(0, 'default'),
+                    exported_invite=types.ChatInviteEmpty(), bot_info=[],
+                    participants_count=len(members)
+                ), chats=[channel], users=[]
+            )
+
+    def iter_dialogs(self, limit=None):
+        """Yields the dialogs, the most recently active first"""
+        for i, (entity, _) in enumerate(self.dialogs[:limit]):
+            if i % 100 == 0:
+                self._invoke('GetDialogsRequest', raise_errors=False)
+            yield SimulatedDialog(id=utils.get_peer_id(entity), entity=entity,
+                                  dialog=_DialogInfo(self.messages),
+                                  pinned=False)
+
+    def iter_participants(self, entity):
+        """Yields the users in the given chat or megagroup"""
+        _, members = self._by_id[utils.get_peer_id(entity)]
+        for i, user_id in enumerate(members):
+            if i % 200 == 0:
+                self._invoke('GetParticipantsRequest', raise_errors=False)
+            yield self.users[user_id]
+
+    def get_entity(self, who):
+        """Gets a dialog entity by marked ID or username"""
+        self._invoke('get_entity', raise_errors=False)
+        if isinstance(who, str):
+            who = who.lstrip('@').lower()
+            for user in self.users.values():
+                if user.username == who:
+                    return user
+            raise ValueError('No user has "{}" as username'.format(who))
+        return self._by_id[utils.get_peer_id(who)][0]
+
+    def download_file(self, location, file, dc_id=HOME_DC):
+        """Downloads a file of media_size bytes from the given DC"""
+        self._invoke('GetFileRequest')
+        self._connect_dc(dc_id)
+        if self.profile.bandwidth:
+            self.clock.sleep(self.media_size / self.profile.bandwidth)
+        self.stats['downloaded_bytes'] += self.media_size
+        with open(file, 'wb') as f:
+            f.write(bytes(self.media_size))
+        return file
+
+    def download_media(self, media, file):
+        """Downloads the photo or document of the given media"""
+        if isinstance(media, types.MessageMediaPhoto):
+            dc_id = DCS[media.photo.id % len(DCS)]
+        else:
+            dc_id = DCS[media.document.id % len(DCS)]
+        return self.download_file(None, file, dc_id=dc_id)
+
+    def add_event_handler(self, callback, event=None):
+        """No updates are simulated, so the handlers are never called"""
+
+    def is_connected(self):
+        return self._connected
+
+    def connect(self):
+        """Connects again after losing the connection"""
+        if not self._connected:
+            self.clock.sleep(self.profile.reconnect_time)
+            self._connected = True
+        return True
+
+
+def run_profile(profile, dialogs=10, messages=1000, participants=50,
+                media=True, realtime=False, seed=0):
+    """
+    Exports every simulated dialog under the given profile (a name or a
+    Profile) into a new database, and returns a dictionary with the
+    messages dumped, simulated and real seconds taken and throughput.
+
+    Unless realtime is set, the time spent waiting for the network is
+    only simulated, so the real seconds are those spent on the CPU.
+    """
+    name = profile if isinstance(profile, str) else 'custom'
+    if isinstance(profile, str):
+        profile = PROFILES[profile]
+
+    work_dir = tempfile.mkdtemp(prefix='telegram-export-sim-')
+    config = configparser.ConfigParser()
+    config['Dumper'] = {
+        'OutputDirectory': work_dir,
+        'DBFileName': 'export',
+        'MediaWhitelist': 'photo, document',
+        'MaxSize': str(2**20 if media else 0),
+        'MediaFilenameFmt': 'usermedia/{context_id}/{type}-{id}{ext}',
+        'InvalidationTime': '7200',
+        'ChunkSize': '100',
+        'MaxChunks': '0',
+        'DialogCacheTTL': '86400',
+        'EntityCacheTTL': '86400'
+    }
+    clock = time if realtime else VirtualClock()
+    client = SimulatedClient(profile, dialogs=dialogs, messages=messages,
+                             participants=participants, clock=clock,
+                             seed=seed)
+    dumper = Dumper(config['Dumper'])
+    dumper.check_self_user(SELF_ID)
+    downloader = Downloader(client, config['Dumper'], progress=False,
+                            clock=clock)
+    try:
+        started, cpu_started = clock.time(), perf_counter()
+        for entity in downloader.fetch_dialogs(
+                os.path.join(work_dir, 'dialogs.tl')):
+            downloader.save_messages(dumper, entity)
+        seconds = clock.time() - started
+        cpu_seconds = perf_counter() - cpu_started
+
+        dumped = dumper.conn.execute('SELECT COUNT(*) FROM Message')\
+            .fetchone()[0]
+    finally:
+        dumper.conn.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'profile': name,
+        'messages': dumped,
+        'seconds': seconds,
+        'cpu_seconds': cpu_seconds,
+        'messages_per_second': dumped / seconds if seconds else None,
+        'requests': client.stats['requests'],
+        'flood_waits': client.stats['flood_waits'],
+        'disconnects': client.stats['disconnects'],
+        'migrations': client.stats['migrations'],
+        'downloaded_bytes': client.stats['downloaded_bytes']
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run whole exports against a simulated Telegram')
+    parser.add_argument('profiles', nargs='*', choices=[[]] + list(PROFILES),
+                        help='network profiles to run (default all of them)')
+    parser.add_argument('--dialogs', type=int, default=10,
+                        help='amount of dialogs to export')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='amount of messages in every dialog')
+    parser.add_argument('--participants', type=int, default=50,
+                        help='amount of participants in every group')
+    parser.add_argument('--no-media', action='store_true',
+                        help='do not download any media')
+    parser.add_argument('--realtime', action='store_true',
+                        help='really wait for the simulated network instead '
+                             'of only accounting for the time it would take')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to generate the dialogs and failures')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='save the results as JSON to FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    print('{:<10} {:>9} {:>10} {:>9} {:>9} {:>7} {:>7} {:>7} {:>8}'.format(
+        'profile', 'messages', 'wall s', 'msg/s', 'requests', 'floods',
+        'discon', 'migr', 'cpu s'))
+    for profile in args.profiles or PROFILES:
+        result = run_profile(profile, dialogs=args.dialogs,
+                             messages=args.messages,
+                             participants=args.participants,
+                             media=not args.no_media,
+                             realtime=args.realtime, seed=args.seed)
+        results.append(result)
+        print('{profile:<10} {messages:>9} {seconds:>10.1f} '
+              '{messages_per_second:>9.1f} {requests:>9} {flood_waits:>7} '
+              '{disconnects:>7} {migrations:>7} {cpu_seconds:>8.2f}'
+              .format(**result))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
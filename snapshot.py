@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Consistent snapshots of an export database, safe to take while an
+export is running, and deltas with only the pages changed since the
+previous snapshot to keep incremental backups small.
+
+Sharded databases are not supported, since their shards can't be copied
+at the same point as the catalog without blocking the export.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import time
+from pathlib import Path
+
+import shards
+
+__log__ = logging.getLogger(__name__)
+
+# Pages copied per step, and seconds slept between steps. With the
+# default page size, a step takes about a millisecond, which is all
+# the time the export may have to wait for it.
+SNAPSHOT_PAGES = 256
+SNAPSHOT_SLEEP = 0.01
+
+# Every commit made by the export while copying starts the copy again.
+# After every restart, the copy waits twice as long as the last time
+# (up to MAX_BACKOFF seconds) for the export to finish writing, and it
+# gives up after this many restarts, never blocking the export instead.
+MAX_RESTARTS = 10
+MAX_BACKOFF = 5
+
+# A delta starts with the magic and (page size, page count) header,
+# followed by the (page number) header plus contents of every page
+DELTA_MAGIC = b'TGEXDLT1'
+DELTA_HEADER = struct.Struct('<II')
+DELTA_PAGE = struct.Struct('<I')
+
+
+class SnapshotError(Exception):
+    """Raised when the database changes too often to be copied in steps"""
+
+
+def _read_only_uri(filename):
+    """Returns the URI to open the given database file read-only"""
+    return '{}?mode=ro'.format(Path(filename).resolve().as_uri())
+
+
+def snapshot(source, destination, pages=SNAPSHOT_PAGES, sleep=SNAPSHOT_SLEEP,
+             max_restarts=MAX_RESTARTS):
+    """
+    Copies the source database file into destination using SQLite's
+    online backup API, so the copy is consistent even if the source is
+    being written, and returns how many times the copy had to restart.
+
+    Databases in WAL mode are copied in a single step, because readers
+    don't block the writer there. Otherwise, a shared lock is only held
+    while copying each step of the given amount of pages, backing off
+    after every restart, and SnapshotError is raised after max_restarts.
+    The snapshot is written to a temporary file and renamed once it's
+    complete.
+
+    Sharded databases raise ValueError, because copying the catalog
+    alone would leave every message out of the snapshot.
+    """
+    tmp_file = destination + '.tmp'
+    if os.path.isfile(tmp_file):
+        os.remove(tmp_file)
+
+    src = sqlite3.connect(_read_only_uri(source), uri=True)
+    if shards.get_buckets(src) is not None:
+        src.close()
+        raise ValueError('{} is sharded, and snapshots of sharded '
+                         'databases are not supported'.format(source))
+
+    dst = sqlite3.connect(tmp_file)
+    try:
+        if src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            pages = -1
+
+        restarts = 0
+        last_remaining = None
+
+        def progress(status, remaining, total):
+            nonlocal restarts, last_remaining
+            wait = sleep
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1
+                if restarts > max_restarts:
+                    raise SnapshotError(
+                        'The database was modified too often while copying '
+                        'it, try again later or use a durability with WAL '
+                        'mode (such as balanced) to avoid this')
+                wait = min(sleep * 2 ** restarts, MAX_BACKOFF)
+            last_remaining = remaining
+            if remaining:
+                # The backup only sleeps when busy, so give the export
+                # a chance to write between steps
+                time.sleep(wait)
+
+        src.backup(dst, pages=pages, progress=progress)
+    finally:
+        src.close()
+        dst.close()
+
+    os.replace(tmp_file, destination)
+    return restarts
+
+
+def _page_size(filename):
+    """Returns the page size of the given database file"""
+    conn = sqlite3.connect(_read_only_uri(filename), uri=True)
+    try:
+        return conn.execute('PRAGMA page_size').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def write_delta(base, current, delta):
+    """
+    Writes the pages of the current snapshot which differ from those
+    of the base snapshot to the delta file, and returns their count.
+    Both snapshots must be made with snapshot() (or not be in use).
+    """
+    page_size = _page_size(current)
+    if _page_size(base) != page_size:
+        raise ValueError('The snapshots have different page sizes')
+
+    page_count = os.path.getsize(current) // page_size
+    changed = 0
+    with open(base, 'rb') as old, open(current, 'rb') as new, \
+            open(delta, 'wb') as out:
+        out.write(DELTA_MAGIC)
+        out.write(DELTA_HEADER.pack(page_size, page_count))
+        for number in range(page_count):
+            page = new.read(page_size)
+            if old.read(page_size) != page:
+                out.write(DELTA_PAGE.pack(number))
+                out.write(page)
+                changed += 1
+    return changed
+
+
+def apply_delta(base, delta, output):
+    """
+    Writes the snapshot resulting from applying delta (as written by
+    write_delta) on top of the base snapshot to output.
+    """
+    tmp_file = output + '.tmp'
+    shutil.copyfile(base, tmp_file)
+    try:
+        with open(delta, 'rb') as f, open(tmp_file, 'r+b') as out:
+            if f.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+                raise ValueError('{} is not a snapshot delta'.format(delta))
+            page_size, page_count = DELTA_HEADER.unpack(
+                f.read(DELTA_HEADER.size))
+            out.truncate(page_size * page_count)
+            while True:
+                header = f.read(DELTA_PAGE.size)
+                if not header:
+                    break
+                number, = DELTA_PAGE.unpack(header)
+                page = f.read(page_size)
+                if len(page) != page_size:
+                    raise ValueError('{} is truncated'.format(delta))
+                out.seek(number * page_size)
+                out.write(page)
+        os.replace(tmp_file, output)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Take a consistent snapshot of an export database, '
+                    'even while an export is running')
+    parser.add_argument('source', help='the database to snapshot, or the '
+                                       'base snapshot with --apply-delta')
+    parser.add_argument('destination', help='the file to write the '
+                                            'snapshot to')
+    parser.add_argument('--pages', type=int, default=SNAPSHOT_PAGES,
+                        help='pages to copy per step, during which the '
+                             'export has to wait')
+    parser.add_argument('--delta-from', metavar='SNAPSHOT',
+                        help='also write the pages changed since SNAPSHOT '
+                             'to the destination plus ".delta"')
+    parser.add_argument('--apply-delta', metavar='DELTA',
+                        help='instead of taking a snapshot, apply DELTA '
+                             'on top of the source snapshot')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.apply_delta:
+        apply_delta(args.source, args.apply_delta, args.destination)
+        return 0
+
+    try:
+        restarts = snapshot(args.source, args.destination, pages=args.pages)
+    except (SnapshotError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    print('Saved snapshot to {} ({} restarts)'
+          .format(args.destination, restarts))
+    if args.delta_from:
+        delta = args.destination + '.delta'
+        changed = write_delta(args.delta_from, args.destination, delta)
+        print('Saved {} changed pages to {}'.format(changed, delta))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
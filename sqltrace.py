@@ -0,0 +1,189 @@
+"""
+Opt-in tracing of the SQLite statements run by the Dumper and the
+formatters, with per-statement statistics and a slow-query log.
+"""
+import logging
+import re
+import sqlite3
+import threading
+from time import perf_counter
+
+__log__ = logging.getLogger(__name__)
+
+# Statements slower than this many milliseconds are logged by default
+SLOW_QUERY_MS = 100
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMS_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+def normalize(sql):
+    """
+    Normalizes a statement so that those differing only in literals,
+    whitespace or the amount of IN (?, ?, ...) parameters are the same.
+    """
+    sql = _WHITESPACE_RE.sub(' ', sql).strip()
+    sql = _LITERAL_RE.sub('?', sql)
+    return _PARAMS_RE.sub('(...)', sql)
+
+
+class _TracedCursor(sqlite3.Cursor):
+    """A cursor timing its statements and fetches for the tracer"""
+    _sql = None
+    _parameters = None
+
+    def _timed(self, method, sql, parameters, explain):
+        start = perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            self._sql = sql
+            self._parameters = parameters if explain else None
+            self.connection.tracer.add(
+                self.connection, sql, perf_counter() - start,
+                parameters if explain else None
+            )
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters, explain=True)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters,
+                           explain=False)
+
+    def _fetch(self, method, *args):
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self._sql:
+                self.connection.tracer.add(
+                    self.connection, self._sql, perf_counter() - start,
+                    self._parameters, fetch=True
+                )
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        return self._fetch(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        return self._fetch(super().__next__)
+
+
+class _TracedConnection(sqlite3.Connection):
+    """A connection whose cursors and commits are timed by the tracer"""
+    tracer = None
+
+    def cursor(self, factory=_TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.tracer.add(self, 'COMMIT', perf_counter() - start, None)
+
+
+class SqlTracer:
+    """
+    Aggregates the execution count and time of every normalized
+    statement run through connections made by connect() while enabled.
+    Statements (or fetches) slower than threshold_ms are logged along
+    with their query plan, which is explained once per statement.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.threshold = SLOW_QUERY_MS / 1000
+        self._lock = threading.Lock()
+        self._stats = {}  # {normalized: [executions, seconds, slowest]}
+        self._explained = set()
+
+    def enable(self, threshold_ms=SLOW_QUERY_MS):
+        """Enables tracing for the connections made from now on"""
+        self.enabled = True
+        self.threshold = threshold_ms / 1000
+
+    def connect(self, *args, **kwargs):
+        """
+        Same as sqlite3.connect, but the returned connection is traced
+        if tracing is enabled.
+        """
+        if not self.enabled:
+            return sqlite3.connect(*args, **kwargs)
+
+        conn = sqlite3.connect(*args, factory=_TracedConnection, **kwargs)
+        conn.tracer = self
+        return conn
+
+    def add(self, conn, sql, seconds, parameters, fetch=False):
+        """
+        Adds the time taken by an execution (or a fetch, which is not
+        counted as another execution) of the given statement. If it
+        was slow and parameters are given, its query plan is logged.
+        """
+        key = normalize(sql)
+        with self._lock:
+            stats = self._stats.setdefault(key, [0, 0.0, 0.0])
+            if not fetch:
+                stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+        if seconds < self.threshold:
+            return
+
+        __log__.warning('Slow statement (%.1fms%s): %s', seconds * 1000,
+                        ' fetching' if fetch else '', key)
+        if parameters is None or key in self._explained or \
+                not key.upper().startswith(('SELECT', 'UPDATE', 'DELETE',
+                                            'INSERT', 'REPLACE', 'WITH')):
+            return
+
+        self._explained.add(key)
+        try:
+            plan = sqlite3.Connection.execute(
+                conn, 'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            __log__.warning('Could not explain the statement: %s', e)
+        else:
+            __log__.warning('Query plan:\n%s', '\n'.join(
+                '  ' + row[-1] for row in plan))
+
+    def summary(self, top=20):
+        """
+        Returns a table with the top statements by cumulative time,
+        including their execution count and average and maximum time.
+        """
+        with self._lock:
+            stats = sorted(self._stats.items(),
+                           key=lambda t: t[1][1], reverse=True)
+
+        lines = ['{:>9} {:>11} {:>9} {:>9}  {}'.format(
+            'count', 'total ms', 'avg ms', 'max ms', 'statement')]
+        for sql, (count, seconds, slowest) in stats[:top]:
+            lines.append('{:>9} {:>11.1f} {:>9.3f} {:>9.3f}  {}'.format(
+                count, seconds * 1000, seconds * 1000 / max(count, 1),
+                slowest * 1000, sql if len(sql) <= 100 else sql[:97] + '...'
+            ))
+        if len(stats) > top:
+            lines.append('... and {} more statements'.format(len(stats) - top))
+        return '\n'.join(lines)
+
+
+# The tracer of the current run, used by the Dumper and the formatters
+TRACER = SqlTracer()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 """The main telegram-export program"""
+import atexit
 import configparser
+import cProfile
+import datetime
 import difflib
 import logging
 import re
@@ -8,17 +11,25 @@ import argparse
 import os
 
 import sys
+import time
+from collections import namedtuple
+
 from telethon import TelegramClient, utils
 import tqdm
 
 from dumper import Dumper
-from downloader import Downloader
-from formatters import NAME_TO_FORMATTER
+from downloader import BOUNDED_PENDING_ENTITIES, Downloader
+from formatters import NAME_TO_FORMATTER, BaseFormatter
+from metrics import REGISTRY
+from profiler import MEMORY_PROFILER, PROFILER
+from sqltrace import SLOW_QUERY_MS, TRACER
+from scheduler import Scheduler
 
 logger = logging.getLogger('')  # Root logger
 
 
 NO_USERNAME = '<no username>'
+NO_NAME = '<unknown name>'
 SCRIPT_DIR = os.path.dirname(__file__)
 
 
@@ -53,7 +64,16 @@ def load_config(filename):
         'InvalidationTime': '7200',
         'ChunkSize': '100',
         'MaxChunks': '0',
-        'LibraryLogLevel': 'WARNING'
+        'LibraryLogLevel': 'WARNING',
+        'FullTextSearch': 'no',
+        'StoreRawTL': 'no',
+        'ColumnCompression': 'none',
+        'DialogCacheTTL': '1440',
+        'EntityCacheTTL': '1440',
+        'DaemonRequestsPerHour': '1200',
+        'Durability': 'safe',
+        'CommitRows': '10000',
+        'Sharding': 'none'
     }
 
     # Load from file
@@ -81,6 +101,10 @@ def load_config(filename):
     # Convert minutes to seconds
     config['Dumper']['InvalidationTime'] = str(
         config['Dumper'].getint('InvalidationTime', 7200) * 60)
+    config['Dumper']['DialogCacheTTL'] = str(
+        config['Dumper'].getint('DialogCacheTTL', 1440) * 60)
+    config['Dumper']['EntityCacheTTL'] = str(
+        config['Dumper'].getint('EntityCacheTTL', 1440) * 60)
 
     # Convert size to bytes
     max_size = config['Dumper'].get('MaxSize')
@@ -98,6 +122,11 @@ def load_config(filename):
     return config
 
 
+def parse_date(string):
+    """Parses a YYYY-MM-DD date given in the command line"""
+    return datetime.datetime.strptime(string, '%Y-%m-%d')
+
+
 def parse_args():
     """Parse command-line arguments to the script"""
     parser = argparse.ArgumentParser(description="export Telegram data")
@@ -106,7 +135,9 @@ def parse_args():
 
     parser.add_argument('--search-dialogs', type=str, dest='search_string',
                         help='like --list-dialogs but searches for a dialog '
-                             'by name/username/phone')
+                             'by name/username/phone. Uses the dialogs saved '
+                             'by previous runs if any, unless --list-dialogs '
+                             'is also given')
 
     parser.add_argument('--config-file', default=None,
                         help='specify a config file. Default config.ini')
@@ -118,20 +149,114 @@ def parse_args():
                              'formatter and exits. Valid options are: {}'
                         .format(', '.join(NAME_TO_FORMATTER)))
 
+    parser.add_argument('--compress', choices=('gzip', 'zstd'),
+                        help='compresses the files written by --format with '
+                             'the given algorithm (zstd needs zstandard). '
+                             'Not supported by the html format')
+
+    parser.add_argument('--search', type=str, dest='search_query',
+                        help='searches the text of the dumped messages and '
+                             'exits. Requires the search index to be built')
+
+    parser.add_argument('--search-context', type=int,
+                        help='only search messages from the given context ID')
+
+    parser.add_argument('--search-from', type=int,
+                        help='only search messages sent by the given user ID')
+
+    parser.add_argument('--search-after', type=parse_date,
+                        help='only search messages after a YYYY-MM-DD date')
+
+    parser.add_argument('--search-before', type=parse_date,
+                        help='only search messages before a YYYY-MM-DD date')
+
+    parser.add_argument('--build-search-index', action='store_true',
+                        help='builds the full-text search index from the '
+                             'already dumped messages and exits')
+
     parser.add_argument('--download-past-media', type=int,
                         help='downloads past media (i.e. dumped files but'
                              'not downloaded) from the given context ID')
+
+    parser.add_argument('--follow', action='store_true',
+                        help='after dumping, keep running and dump new, '
+                             'edited and deleted messages as they happen')
+
+    parser.add_argument('--no-progress', action='store_true',
+                        help='do not show progress bars, for unattended runs '
+                             '(e.g. from cron or systemd)')
+
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics about the run in the Prometheus '
+                             'format on http://127.0.0.1:<port>/metrics')
+
+    parser.add_argument('--metrics-file', type=str,
+                        help='append a JSON line with the metrics about the '
+                             'run to this file periodically')
+
+    parser.add_argument('--metrics-interval', type=int, default=60,
+                        help='seconds between lines written to '
+                             '--metrics-file. Default 60')
+
+    parser.add_argument('--profile', action='store_true',
+                        help='time the phases of the export (network, '
+                             'serialization, inserts, commits, media and '
+                             'sleeps) and print a breakdown per dialog')
+
+    parser.add_argument('--profile-output', type=str,
+                        help='with --profile, also save the details to this '
+                             'file, as a Chrome trace if it ends in .json '
+                             'or as cProfile stats (for pstats) otherwise')
+
+    parser.add_argument('--trace-sql', type=float, nargs='?',
+                        const=SLOW_QUERY_MS, metavar='MS',
+                        help='time every SQL statement, log those slower '
+                             'than MS milliseconds (default {}) with their '
+                             'query plan, and print a summary at exit'
+                             .format(SLOW_QUERY_MS))
+
+    parser.add_argument('--memory-profile', action='store_true',
+                        help='trace memory allocations and print how much '
+                             'memory every dialog took and where it was '
+                             'allocated')
+
+    parser.add_argument('--bounded-memory', action='store_true',
+                        help='keep at most {} entities waiting to be dumped '
+                             'in memory, saving the rest to the database '
+                             'meanwhile'.format(BOUNDED_PENDING_ENTITIES))
+
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and export every dialog when it '
+                             'is expected to have new messages, checking '
+                             'busy dialogs more often than quiet ones')
+
+    parser.add_argument('--daemon-status', action='store_true',
+                        help='show when every dialog will be exported next '
+                             'by --daemon and how many new messages it is '
+                             'expected to have, then exit')
     return parser.parse_args()
 
 
+DialogInfo = namedtuple('DialogInfo', 'id name username phone')
+
+
+def dialog_to_info(dialog):
+    """Converts a telethon Dialog into a DialogInfo"""
+    return DialogInfo(
+        id=utils.get_peer_id(dialog.entity),
+        name=dialog.name,
+        username=getattr(dialog.entity, 'username', None),
+        phone=getattr(dialog.entity, 'phone', None)
+    )
+
+
 def fmt_dialog(dialog, id_pad=0, username_pad=0):
     """
     Space-fill a row with given padding values to ensure alignment when printing dialogs
     """
-    username = getattr(dialog.entity, 'username', None)
-    username = '@' + username if username else NO_USERNAME
+    username = '@' + dialog.username if dialog.username else NO_USERNAME
     return '{:<{id_pad}} | {:<{username_pad}} | {}'.format(
-        utils.get_peer_id(dialog.entity), username, dialog.name,
+        dialog.id, username, dialog.name,
         id_pad=id_pad, username_pad=username_pad
     )
 
@@ -140,9 +265,8 @@ def find_fmt_dialog_padding(dialogs):
     """Find the correct amount of space padding to give dialogs when printing them"""
     no_username = NO_USERNAME[:-1]  # Account for the added '@' if username
     return (
-        max(len(str(utils.get_peer_id(dialog.entity))) for dialog in dialogs),
-        max(len(getattr(dialog.entity, 'username', no_username) or no_username)
-            for dialog in dialogs) + 1
+        max(len(str(dialog.id)) for dialog in dialogs),
+        max(len(dialog.username or no_username) for dialog in dialogs) + 1
     )
 
 
@@ -159,13 +283,13 @@ def find_dialog(dialogs, query, top=25, threshold=0.7):
             # all substring-matched dialogs have exactly the same score.
             boost = (index/len(dialogs))/25
             name_score = max(name_score, 0.75 + boost)
-        if getattr(dialog.entity, 'username', None):
-            seq.set_seq1(dialog.entity.username)
+        if dialog.username:
+            seq.set_seq1(dialog.username)
             username_score = seq.ratio()
         else:
             username_score = 0
-        if getattr(dialog.entity, 'phone', None):
-            seq.set_seq1(dialog.entity.phone)
+        if dialog.phone:
+            seq.set_seq1(dialog.phone)
             phone_score = seq.ratio()
         else:
             phone_score = 0
@@ -177,50 +301,198 @@ def find_dialog(dialogs, query, top=25, threshold=0.7):
     return matches[:top], num_not_shown
 
 
-def list_or_search_dialogs(args, client):
-    """List the user's dialogs and/or search them for a query"""
+def print_found_dialogs(dialogs, query):
+    """Search the given DialogInfo for a query and print the best matches"""
+    print('Searching for "{}"...'.format(query))
+    found, num_not_shown = find_dialog(dialogs, query)
+    if not found:
+        print('Found no good results with "{}".'.format(query))
+    elif len(found) == 1:
+        print('Top match:', fmt_dialog(found[0]), sep='\n')
+    else:
+        if num_not_shown > 0:
+            print('Showing top {} matches of {}:'.format(
+                len(found), len(found) + num_not_shown))
+        else:
+            print('Showing top {} matches:'.format(len(found)))
+        id_pad, username_pad = find_fmt_dialog_padding(found)
+        for dialog in found:
+            print(fmt_dialog(dialog, id_pad, username_pad))
+
+
+def search_dialog_catalog(args, dumper):
+    """
+    Search the catalog of dialogs saved by previous runs, scoring only
+    the candidates that share trigrams with the query.
+    """
+    print_found_dialogs(
+        [DialogInfo(*row) for row in
+         dumper.get_dialog_candidates(args.search_string)],
+        args.search_string
+    )
+
+
+def list_or_search_dialogs(args, client, dumper):
+    """
+    List the user's dialogs and/or search them for a query,
+    refreshing the catalog of dialogs with the ones fetched.
+    """
     dialogs = client.get_dialogs(limit=None)[::-1]  # Oldest to newest
+    for dialog in dialogs:
+        dumper.dump_dialog(dialog.entity, date_active=dialog.date)
+    dumper.commit()
+
+    dialogs = [dialog_to_info(dialog) for dialog in dialogs]
     if args.list_dialogs:
         id_pad, username_pad = find_fmt_dialog_padding(dialogs)
         for dialog in dialogs:
             print(fmt_dialog(dialog, id_pad, username_pad))
 
     if args.search_string:
-        print('Searching for "{}"...'.format(args.search_string))
-        found, num_not_shown = find_dialog(dialogs, args.search_string)
-        if not found:
-            print('Found no good results with "{}".'.format(args.search_string))
-        elif len(found) == 1:
-            print('Top match:', fmt_dialog(found[0]), sep='\n')
-        else:
-            if num_not_shown > 0:
-                print('Showing top {} matches of {}:'.format(
-                    len(found), len(found) + num_not_shown))
-            else:
-                print('Showing top {} matches:'.format(len(found)))
-            id_pad, username_pad = find_fmt_dialog_padding(found)
-            for dialog in found:
-                print(fmt_dialog(dialog, id_pad, username_pad))
+        print_found_dialogs(dialogs, args.search_string)
 
     client.disconnect()
 
 
+def search_messages(args, dumper):
+    """Search the dumped messages for a query and print the results"""
+    formatter = BaseFormatter(dumper.conn)
+    # Sharded databases have the index in their shards, not the catalog
+    if not any(conn.execute("SELECT name FROM sqlite_master "
+                            "WHERE name = 'MessageSearch'").fetchone()
+               for conn in formatter.iter_context_conns()):
+        print('The search index has not been built yet, '
+              'run with --build-search-index first', file=sys.stderr)
+        return 1
+
+    results = formatter.search_messages(
+        args.search_query, context_id=args.search_context,
+        from_user_id=args.search_from, start_date=args.search_after,
+        end_date=args.search_before
+    )
+    if not results:
+        print('Found no messages matching "{}".'.format(args.search_query))
+    for result in results:
+        print('{} | {} | {} | {}'.format(
+            result.context_id, result.id,
+            result.date.strftime('%Y-%m-%d %H:%M:%S'), result.snippet
+        ))
+
+
+def load_whitelist(downloader, dumper):
+    """Returns the list of whitelisted entities, or None if there's none"""
+    if 'Whitelist' not in dumper.config:
+        return None
+    return list(downloader.load_entities_from_str(
+        dumper.config['Whitelist'], dumper))
+
+
+def get_export_filter(downloader, dumper, whitelist=None):
+    """
+    Returns a function telling whether a context ID should be exported
+    according to the whitelist or blacklist, or None to export them all.
+    The whitelist is loaded unless its entities are given.
+    """
+    if 'Whitelist' in dumper.config:
+        if whitelist is None:
+            whitelist = load_whitelist(downloader, dumper)
+        export = set(utils.get_peer_id(x) for x in whitelist)
+        return lambda context_id: context_id in export
+
+    if 'Blacklist' in dumper.config:
+        avoid = set(utils.get_peer_id(x) for x in
+                    downloader.load_entities_from_str(
+                        dumper.config['Blacklist'], dumper))
+        return lambda context_id: context_id not in avoid
+
+    return None
+
+
+def iter_export_entities(downloader, dumper, cache_file, whitelist=None,
+                         should_export=None):
+    """
+    Yields the entities of the dialogs to export, as configured. The
+    whitelist and export filter are loaded unless they're given.
+    """
+    if 'Whitelist' in dumper.config:
+        # Only whitelist, don't even get the dialogs
+        if whitelist is None:
+            whitelist = load_whitelist(downloader, dumper)
+        yield from whitelist
+        return
+
+    # May be blacklist, so filter out the IDs to avoid
+    if should_export is None:
+        should_export = get_export_filter(downloader, dumper)
+    for entity in downloader.fetch_dialogs(cache_file=cache_file):
+        if not should_export or should_export(utils.get_peer_id(entity)):
+            yield entity
+
+
+def print_schedule(dumper):
+    """Prints the dialogs scheduled by --daemon, due first"""
+    entries = Scheduler(dumper, None).status()
+    if not entries:
+        print('No dialogs have been scheduled yet, run with --daemon first')
+    now = time.time()
+    for entry in entries:
+        print('{} | {} | {} | {:.1f} messages/day | {}'.format(
+            entry.context_id, entry.name or NO_NAME,
+            'due' if entry.next_check <= now else 'in {}'.format(
+                datetime.timedelta(seconds=round(entry.next_check - now))),
+            entry.rate * 24 * 60 * 60,
+            'never checked' if entry.backlog is None else
+            '~{} new messages'.format(round(entry.backlog))
+        ))
+
+
+def finish_profile(args, cprofile):
+    """Prints the --profile report and saves its output, if any"""
+    print(PROFILER.report(), file=sys.stderr)
+    if cprofile:
+        cprofile.disable()
+        cprofile.dump_stats(args.profile_output)
+    elif args.profile_output:
+        PROFILER.save_trace(args.profile_output)
+
+
 def main():
     """The main telegram-export program.
        Goes through the configured dialogs and dumps them into the database"""
     args = parse_args()
     config = load_config(args.config_file)
+    if args.trace_sql is not None:
+        TRACER.enable(args.trace_sql)
+        atexit.register(lambda: print(TRACER.summary(), file=sys.stderr))
     dumper = Dumper(config['Dumper'])
 
+    if args.build_search_index:
+        print('Indexed {} messages.'.format(dumper.rebuild_search_index()))
+        return
+
+    if args.search_query:
+        return search_messages(args, dumper)
+
+    if args.search_string and not args.list_dialogs \
+            and dumper.get_dialog_count():
+        return search_dialog_catalog(args, dumper)
+
+    if args.daemon_status:
+        return print_schedule(dumper)
+
     if args.format:
         if args.format not in NAME_TO_FORMATTER:
             print('Format name "{}" not available"'.format(args.format),
                   file=sys.stderr)
             return 1
 
-        formatter = NAME_TO_FORMATTER[args.format](dumper.conn)
-        for cid in formatter.iter_context_ids():
-            formatter.format(cid, config['Dumper']['OutputDirectory'])
+        try:
+            formatter = NAME_TO_FORMATTER[args.format](
+                dumper.conn, compression=args.compress)
+            formatter.format_all(config['Dumper']['OutputDirectory'])
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
         return
 
     absolute_session_name = os.path.join(
@@ -230,48 +502,70 @@ def main():
     client = TelegramClient(
         absolute_session_name,
         config['TelegramAPI']['ApiId'],
-        config['TelegramAPI']['ApiHash']
+        config['TelegramAPI']['ApiHash'],
+        update_workers=1 if args.follow else None
     ).start(config['TelegramAPI']['PhoneNumber'])
 
     if args.list_dialogs or args.search_string:
-        return list_or_search_dialogs(args, client)
+        return list_or_search_dialogs(args, client, dumper)
 
-    downloader = Downloader(client, config['Dumper'])
+    downloader = Downloader(
+        client, config['Dumper'], progress=not args.no_progress,
+        max_pending_entities=BOUNDED_PENDING_ENTITIES
+        if args.bounded_memory else 0
+    )
+    if args.memory_profile:
+        MEMORY_PROFILER.enable()
+    if args.metrics_port:
+        REGISTRY.serve(args.metrics_port)
+    stop_snapshots = None
+    if args.metrics_file:
+        stop_snapshots = REGISTRY.write_snapshots(args.metrics_file,
+                                                  args.metrics_interval)
     cache_file = os.path.join(absolute_session_name + '.tl')
+    cprofile = None
+    if args.profile:
+        trace = bool(args.profile_output) and \
+            args.profile_output.endswith('.json')
+        PROFILER.enable(trace=trace)
+        if args.profile_output and not trace:
+            cprofile = cProfile.Profile()
+            cprofile.enable()
     try:
         if args.download_past_media:
             downloader.download_past_media(dumper, args.download_past_media)
             return
 
         dumper.check_self_user(client.get_me(input_peer=True).user_id)
-        if 'Whitelist' in dumper.config:
-            # Only whitelist, don't even get the dialogs
-            entities = downloader.load_entities_from_str(
-                dumper.config['Whitelist']
-            )
-            for who in entities:
-                downloader.save_messages(dumper, who)
-
-        elif 'Blacklist' in dumper.config:
-            # May be blacklist, so save the IDs on who to avoid
-            entities = downloader.load_entities_from_str(
-                dumper.config['Blacklist']
-            )
-            avoid = set(utils.get_peer_id(x) for x in entities)
-            for entity in downloader.fetch_dialogs(cache_file=cache_file):
-                if utils.get_peer_id(entity) not in avoid:
-                    downloader.save_messages(dumper, entity)
-        else:
-            # Neither blacklist nor whitelist - get all
-            for entity in downloader.fetch_dialogs(cache_file=cache_file):
-                downloader.save_messages(dumper, entity)
+        if args.daemon:
+            Scheduler(
+                dumper, downloader,
+                config['Dumper'].getint('DaemonRequestsPerHour')
+            ).run(lambda: iter_export_entities(downloader, dumper, cache_file))
+            return
+
+        # Resolved once, for both exporting and following
+        whitelist = load_whitelist(downloader, dumper)
+        should_export = get_export_filter(downloader, dumper, whitelist)
+        for entity in iter_export_entities(downloader, dumper, cache_file,
+                                           whitelist, should_export):
+            downloader.save_messages(dumper, entity)
+
+        if args.follow:
+            downloader.follow(dumper, should_export)
 
     except KeyboardInterrupt:
         pass
     finally:
         logging.getLogger(__name__).info("Closing exporter")
         client.disconnect()
-        dumper.conn.close()
+        dumper.close()
+        if stop_snapshots:
+            stop_snapshots()
+        if args.profile:
+            finish_profile(args, cprofile)
+        if args.memory_profile:
+            print(MEMORY_PROFILER.report(), file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -1,23 +1,53 @@
 import configparser
+import contextlib
+import csv
+import gzip
+import io
+import json
 import random
 import shutil
+import sqlite3
 import string
+import tempfile
+import threading
 import time
+import tracemalloc
 import unittest
 from datetime import datetime, timedelta
 from pathlib import Path
+from types import SimpleNamespace
+from urllib.request import urlopen
 
-from telethon import TelegramClient, utils as tl_utils
+from telethon import TelegramClient, events, utils as tl_utils
 from telethon.errors import (
     PhoneNumberOccupiedError, SessionPasswordNeededError
 )
 from telethon.extensions import markdown
 from telethon.tl import functions, types
 
+import bench
+import compression
+import merge
+import recompress
+import shards
+import simulator
+import snapshot
+import telegram_export
 import utils
-from downloader import Downloader
-from dumper import Dumper
-from formatters import BaseFormatter
+from downloader import (
+    Downloader, _EntityDownloader, _count_participant_requests
+)
+from dumper import DURABILITY_PROFILES, Dumper
+from formatters import (
+    BaseFormatter, ColumnarFormatter, HtmlFormatter, JsonFormatter,
+    TextFormatter
+)
+from metrics import REGISTRY, Metrics
+from profiler import MemoryProfiler, Profiler
+from scheduler import (
+    CHECK_OVERHEAD, FAILURE_BACKOFF, MAX_INTERVAL, UNKNOWN_BACKLOG, Scheduler
+)
+from sqltrace import SqlTracer, normalize
 
 # Configuration as to which tests to run
 ALLOW_NETWORK = False
@@ -374,5 +404,1232 @@ class TestDumpAll(unittest.TestCase):
         assert all(asc[i - 1] < asc[i] for i in range(1, len(asc)))
 
 
+class TestOffline(unittest.TestCase):
+    """Tests which don't need to connect to Telegram"""
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        config = configparser.ConfigParser()
+        config['Dumper'] = {'DBFileName': 'test_db',
+                            'OutputDirectory': self.work_dir,
+                            'InvalidationTime': '7200'}
+        self.dumper_config = config['Dumper']
+        self.dumper = Dumper(self.dumper_config)
+        self.dumper.check_self_user(123)
+
+    def tearDown(self):
+        self.dumper.conn.close()
+        shutil.rmtree(self.work_dir)
+
+    def dump_messages(self, count, context_id=123):
+        """Dumps count messages, one per hour, into context_id"""
+        msg = types.Message(
+            id=1,
+            to_id=types.PeerUser(context_id),
+            date=datetime(year=2010, month=1, day=1),
+            message='hi'
+        )
+        for _ in range(count):
+            self.dumper.dump_message(msg, context_id,
+                                     forward_id=None, media_id=None)
+            msg.id += 1
+            msg.date += timedelta(hours=1)
+        self.dumper.commit()
+
+    def test_formatter_pages(self):
+        """
+        Ensures that the BaseFormatter can page through a context with
+        cursors and seek around a given message.
+        """
+        self.dump_messages(365)
+        fmt = BaseFormatter(self.dumper.conn)
+
+        for order in ('ASC', 'DESC'):
+            ids = []
+            messages, cursor = fmt.get_messages_page(123, limit=50,
+                                                     order=order)
+            ids.extend(m.id for m in messages)
+            while cursor:
+                messages, cursor = fmt.get_messages_page(
+                    123, limit=50, cursor=cursor, order=order)
+                ids.extend(m.id for m in messages)
+            expected = [m.id for m in fmt.get_messages_from_context(
+                123, order=order)]
+            assert ids == expected
+            assert len(ids) == 365
+
+        # Cursors can't be reused with a different order
+        _, cursor = fmt.get_messages_page(123, limit=10, order='ASC')
+        with self.assertRaises(ValueError):
+            fmt.get_messages_page(123, cursor=cursor, order='DESC')
+
+        messages, before, after = fmt.get_messages_around(123, 200, limit=10)
+        assert [m.id for m in messages] == list(range(196, 206))
+        messages, _ = fmt.get_messages_page(123, limit=1, cursor=before,
+                                            order='DESC')
+        assert messages[0].id == 195
+        messages, _ = fmt.get_messages_page(123, limit=1, cursor=after)
+        assert messages[0].id == 206
+
+    def test_html_formatter(self):
+        """
+        Ensures that the HTML site is paginated with working navigation
+        and that formatting entities are rendered as well-nested, safe
+        markup.
+        """
+        self.dump_messages(5)
+        fmt = HtmlFormatter(self.dumper.conn, messages_per_page=2)
+        fmt.format_all(self.work_dir)
+
+        site = Path(self.work_dir) / 'html'
+        context_dir = site / '123'
+        assert (site / 'index.html').is_file()
+        assert (site / 'style.css').is_file()
+        assert (context_dir / 'index.html').is_file()
+        assert sorted(p.name for p in context_dir.glob('*.html')) == [
+            '1.html', '2.html', '3.html', 'index.html']
+
+        pages = [(context_dir / '{}.html'.format(i)).read_text()
+                 for i in (1, 2, 3)]
+        assert pages[0].count('href="2.html">Next') == 2
+        assert 'Previous' not in pages[0]
+        assert pages[1].count('href="1.html">Previous') == 2
+        assert pages[1].count('href="3.html">Next') == 2
+        assert 'Next' not in pages[2]
+        assert sum(page.count('class="message') for page in pages) == 5
+
+        def render(text, entities):
+            return fmt.format_text(text, utils.encode_msg_entities(entities))
+
+        assert render('a < b', []) == 'a &lt; b'
+        assert render('hello world', [
+            types.MessageEntityBold(0, 7),
+            types.MessageEntityItalic(3, 8)
+        ]) == '<b>hel<i>lo w</i></b><i>orld</i>'
+        assert render('hello', [
+            types.MessageEntityBold(2, 0),
+            types.MessageEntityItalic(0, 5)
+        ]) == '<i>hello</i>'
+        # Offsets count astral characters as two, like Telegram does
+        assert render('\U0001F600 ok', [
+            types.MessageEntityCode(3, 2)
+        ]) == '\U0001F600 <code>ok</code>'
+        assert render('click', [
+            types.MessageEntityTextUrl(0, 5, 'https://example.com/?a&b')
+        ]) == '<a href="https://example.com/?a&amp;b">click</a>'
+        assert render('click', [
+            types.MessageEntityTextUrl(0, 5, 'javascript:alert(1)')
+        ]) == 'click'
+
+    def test_json_formatter(self):
+        """
+        Ensures that the JsonFormatter writes one JSON object per message,
+        in chronological order, with its entities.
+        """
+        self.dump_messages(3)
+        text, entities = markdown.parse('some **bold** text')
+        self.dumper.dump_message(types.Message(
+            id=10, to_id=types.PeerUser(123), date=datetime(2011, 1, 1),
+            message=text, entities=entities
+        ), 123, forward_id=None, media_id=None)
+        self.dumper.commit()
+
+        fmt = JsonFormatter(self.dumper.conn)
+        fmt.format(123, self.work_dir)
+        with open(Path(self.work_dir) / '123.jsonl', encoding='utf-8') as f:
+            messages = [json.loads(line) for line in f]
+
+        assert [m['id'] for m in messages] == [1, 2, 3, 10]
+        assert all(m['context_id'] == 123 for m in messages)
+        assert messages[0]['text'] == 'hi'
+        assert messages[1]['date'] - messages[0]['date'] == 3600
+        assert messages[0]['entities'] == []
+        assert messages[3]['text'] == 'some bold text'
+        assert messages[3]['entities'] == [e.to_dict() for e in entities]
+        assert messages[3]['forward'] is None
+        assert messages[3]['media'] is None
+
+    def test_columnar_formatter(self):
+        """
+        Ensures that the ColumnarFormatter partitions the messages by
+        context and month, as Parquet if possible or CSV otherwise.
+        """
+        # One message per hour, from January into February
+        self.dump_messages(800)
+        expected = {
+            'month=2010-01': list(range(1, 745)),
+            'month=2010-02': list(range(745, 801)),
+        }
+
+        fmt = ColumnarFormatter(self.dumper.conn, parquet=False)
+        fmt.format_all(str(Path(self.work_dir) / 'csv'))
+        context_dir = (Path(self.work_dir) / 'csv' / 'columnar'
+                       / 'messages' / 'context_id=123')
+        assert sorted(p.name for p in context_dir.iterdir()) == \
+            sorted(expected)
+        for month, ids in expected.items():
+            with open(context_dir / month / 'part-0.csv',
+                      encoding='utf-8', newline='') as f:
+                rows = list(csv.DictReader(f))
+            assert [int(row['ID']) for row in rows] == ids
+            assert rows[0]['Message'] == 'hi'
+            assert int(rows[1]['Date']) - int(rows[0]['Date']) == 3600
+        assert (Path(self.work_dir) / 'csv' / 'columnar'
+                / 'user.csv').is_file()
+
+        # Line endings are written as they are, both inside quoted
+        # fields and at the end of every row, compressed or not
+        msg = types.Message(id=1, to_id=types.PeerUser(456),
+                            date=datetime(year=2010, month=1, day=1),
+                            message='two\r\nlines')
+        self.dumper.dump_message(msg, 456, forward_id=None, media_id=None)
+        self.dumper.commit()
+        for compression in (None, 'gzip'):
+            fmt = ColumnarFormatter(self.dumper.conn, parquet=False,
+                                    compression=compression)
+            fmt.format(456, self.work_dir)
+            filename = Path(self.work_dir) / '456.csv'
+            if compression:
+                data = gzip.decompress(
+                    (Path(self.work_dir) / '456.csv.gz').read_bytes())
+            else:
+                data = filename.read_bytes()
+            assert data.count(b'\r\r\n') == 0
+            assert data.endswith(b'\r\n')
+            rows = list(csv.DictReader(io.StringIO(data.decode('utf-8'),
+                                                   newline='')))
+            assert rows[0]['Message'] == 'two\r\nlines'
+
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            return
+
+        fmt = ColumnarFormatter(self.dumper.conn, parquet=True)
+        fmt.format_all(str(Path(self.work_dir) / 'parquet'))
+        context_dir = (Path(self.work_dir) / 'parquet' / 'columnar'
+                       / 'messages' / 'context_id=123')
+        for month, ids in expected.items():
+            table = pyarrow.parquet.read_table(
+                str(context_dir / month / 'part-0.parquet'))
+            assert str(table.schema.field('Date').type) == 'int64'
+            assert table.column('ID').to_pylist() == ids
+            dates = table.column('Date').to_pylist()
+            assert dates[1] - dates[0] == 3600
+
+        # Parquet files compress their pages instead of the whole file
+        fmt = ColumnarFormatter(self.dumper.conn, parquet=True,
+                                compression='zstd')
+        fmt.format_all(str(Path(self.work_dir) / 'zstd'))
+        metadata = pyarrow.parquet.ParquetFile(str(
+            Path(self.work_dir) / 'zstd' / 'columnar' / 'messages'
+            / 'context_id=123' / 'month=2010-01' / 'part-0.parquet'
+        )).metadata
+        assert metadata.row_group(0).column(0).compression == 'ZSTD'
+
+    def test_formatter_output(self):
+        """
+        Ensures that formatters write their output to the given file,
+        compressed if requested, and that the HTML site refuses to be.
+        """
+        self.dump_messages(3)
+        work_dir = Path(self.work_dir)
+
+        TextFormatter(self.dumper.conn).format(123, self.work_dir)
+        lines = (work_dir / '123').read_text(encoding='utf-8').splitlines()
+        assert len(lines) == 4
+        assert lines[0].startswith('== Conversation with')
+        assert all(line.endswith(' hi') for line in lines[1:])
+
+        uncompressed = work_dir / 'plain'
+        uncompressed.mkdir()
+        JsonFormatter(self.dumper.conn).format(123, str(uncompressed))
+        expected = (uncompressed / '123.jsonl').read_bytes()
+
+        JsonFormatter(self.dumper.conn, compression='gzip').format(
+            123, self.work_dir)
+        with gzip.open(str(work_dir / '123.jsonl.gz')) as f:
+            assert f.read() == expected
+
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+        if zstandard:
+            JsonFormatter(self.dumper.conn, compression='zstd').format(
+                123, self.work_dir)
+            with open(str(work_dir / '123.jsonl.zst'), 'rb') as f:
+                data = zstandard.ZstdDecompressor().stream_reader(f).read()
+            assert data == expected
+
+        with self.assertRaises(ValueError):
+            BaseFormatter(self.dumper.conn, compression='rar')
+        with self.assertRaises(ValueError):
+            HtmlFormatter(self.dumper.conn,
+                          compression='gzip').format_all(self.work_dir)
+
+    def test_search_messages(self):
+        """
+        Ensures that the search index can be built in bulk, is kept up to
+        date as messages are dumped and that results can be filtered.
+        """
+        self.dump_messages(10)
+        assert self.dumper.rebuild_search_index() == 10
+
+        fmt = BaseFormatter(self.dumper.conn)
+        assert len(fmt.search_messages('hi')) == 10
+        assert len(fmt.search_messages('hi', context_id=321)) == 0
+        assert len(fmt.search_messages(
+            'hi', end_date=datetime(year=2010, month=1, day=1, hour=3))) == 3
+
+        self.dumper.full_text_search = True
+        msg = types.Message(
+            id=11,
+            to_id=types.PeerUser(123),
+            date=datetime(year=2010, month=2, day=1),
+            message='Searching for needles in haystacks'
+        )
+        self.dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        msg.message = 'Edited to find the needle'
+        self.dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        self.dumper.commit()
+
+        results = fmt.search_messages('needle')
+        assert [(r.context_id, r.id) for r in results] == [(123, 11)]
+        assert results[0].snippet == 'Edited to find the [needle]'
+        assert not fmt.search_messages('haystacks')
+
+        # Removing the text (e.g. of a media) drops it from the index
+        msg.message = ''
+        self.dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        self.dumper.commit()
+        assert not fmt.search_messages('needle')
+        assert self.dumper.conn.execute(
+            "SELECT COUNT(*) FROM MessageSearchID").fetchone()[0] == 10
+
+    def test_dialog_catalog(self):
+        """
+        Ensures that dialogs can be found through their trigrams and that
+        renaming a dialog updates its trigrams.
+        """
+        self.dumper.dump_dialog(types.User(id=1, first_name='Alice',
+                                           username='wonderland'))
+        self.dumper.dump_dialog(types.User(id=2, first_name='Bob',
+                                           phone='1234567'))
+        self.dumper.dump_dialog(types.Channel(
+            id=3, title='Python Developers', photo=None, date=None,
+            version=0, username='pydevs'))
+        self.dumper.commit()
+        assert self.dumper.get_dialog_count() == 3
+
+        def candidates(query):
+            return {row[0] for row in
+                    self.dumper.get_dialog_candidates(query)}
+
+        assert candidates('alice') == {1}
+        assert candidates('1234') == {2}
+        assert tl_utils.get_peer_id(types.PeerChannel(3)) \
+            in candidates('developers')
+        assert candidates('a') == {1, 2, tl_utils.get_peer_id(
+            types.PeerChannel(3))}
+
+        self.dumper.dump_dialog(types.User(id=1, first_name='Carol'))
+        assert candidates('alice') == set()
+        assert candidates('carol') == {1}
+
+    def test_dialog_cache(self):
+        """
+        Ensures that the dialog cache is used for the unchanged dialogs,
+        and that everything is fetched again after the TTL expires.
+        """
+        class Client:
+            def __init__(self):
+                self.dialogs = []
+                self.fetched = 0
+
+            def iter_dialogs(self, limit=None):
+                for dialog in self.dialogs:
+                    self.fetched += 1
+                    yield dialog
+
+        def make_dialog(user_id, top_message):
+            return SimpleNamespace(
+                id=user_id, pinned=False,
+                dialog=SimpleNamespace(top_message=top_message),
+                entity=types.User(id=user_id, first_name=str(user_id))
+            )
+
+        client = Client()
+        client.dialogs = [make_dialog(i, 100 - i) for i in range(1, 11)]
+        config = configparser.ConfigParser()
+        config['Dumper'] = {'MaxSize': '0', 'MediaFilenameFmt': '',
+                            'OutputDirectory': self.work_dir,
+                            'DialogCacheTTL': '60'}
+        downloader = Downloader(client, config['Dumper'])
+        cache_file = str(Path(self.work_dir) / 'dialogs.tl')
+
+        def fetch():
+            client.fetched = 0
+            return [e.id for e in downloader.fetch_dialogs(cache_file)]
+
+        assert fetch() == list(range(1, 11))
+        assert client.fetched == 10
+
+        # Dialog 5 got a new message, so it's the first now
+        client.dialogs.insert(0, client.dialogs.pop(4))
+        client.dialogs[0].dialog.top_message = 200
+        assert fetch() == [5] + [i for i in range(1, 11) if i != 5]
+        assert client.fetched == 2
+
+        # Nothing changed, but the cache expired
+        downloader.dialog_cache_ttl = -1
+        assert fetch() == [5] + [i for i in range(1, 11) if i != 5]
+        assert client.fetched == 10
+
+    def test_entity_cache(self):
+        """
+        Ensures that entities are resolved through the cache by any of
+        their keys, and that expired entries are fetched again.
+        """
+        class Client:
+            def __init__(self):
+                self.resolved = []
+
+            def get_entity(self, who):
+                self.resolved.append(who)
+                return types.User(id=7, access_hash=1, username='Someone',
+                                  phone='1234')
+
+        client = Client()
+        config = configparser.ConfigParser()
+        config['Dumper'] = {'MaxSize': '0', 'MediaFilenameFmt': '',
+                            'OutputDirectory': self.work_dir,
+                            'EntityCacheTTL': '60'}
+        downloader = Downloader(client, config['Dumper'])
+
+        entities = list(downloader.load_entities_from_str(
+            '@someone, someone: Some one, +1234, 7,', self.dumper))
+        assert [e.id for e in entities] == [7, 7, 7, 7]
+        assert client.resolved == ['@someone']
+
+        downloader.entity_cache_ttl = -1
+        downloader.get_entity(self.dumper, 7)
+        assert client.resolved == ['@someone', 7]
+
+    def test_follow_events(self):
+        """
+        Ensures that the events received while following are dumped,
+        that deletions are recorded only for the followed contexts, and
+        that edits and the whitelist don't repeat work.
+        """
+        config = configparser.ConfigParser()
+        config['Dumper'] = {'MaxSize': '0', 'MediaFilenameFmt': '',
+                            'OutputDirectory': self.work_dir}
+        downloader = Downloader(None, config['Dumper'])
+        entity_downloader = _EntityDownloader(None, self.dumper)
+        user = types.User(id=7, first_name='Someone', access_hash=1)
+        self.dumper.cache_entity(user)
+
+        fwd = types.MessageFwdHeader(date=datetime(year=2009, month=1, day=1),
+                                     from_id=8)
+
+        def new_message(msg_id, text, fwd_from=None):
+            return events.NewMessage.Event(types.Message(
+                id=msg_id, to_id=types.PeerUser(123), from_id=7,
+                date=datetime(year=2010, month=1, day=1), message=text,
+                fwd_from=fwd_from
+            ))
+
+        downloader._dump_events(self.dumper, [
+            new_message(1, 'hi', fwd),
+            new_message(2, 'bye'),
+            events.MessageEdited.Event(types.Message(
+                id=1, to_id=types.PeerUser(123), from_id=7,
+                date=datetime(year=2010, month=1, day=1), message='hello',
+                fwd_from=fwd
+            )),
+            events.MessageDeleted.Event([2, 3], None),
+            events.MessageDeleted.Event([2], types.PeerChannel(1))
+        ], lambda cid: cid == 7, entity_downloader)
+        self.dumper.commit()
+
+        assert self.dumper.conn.execute(
+            "SELECT ID, Message FROM Message WHERE ContextID = 7 "
+            "ORDER BY ID").fetchall() == [(1, 'hello'), (2, 'bye')]
+        # Editing a forwarded message doesn't dump its forward again
+        forward_id, = self.dumper.conn.execute(
+            "SELECT ID FROM Forward").fetchall()
+        assert self.dumper.get_forward_id(7, 1) == forward_id[0]
+        assert self.dumper.conn.execute(
+            "SELECT ContextID, ID FROM MessageDeletion "
+            "ORDER BY ContextID").fetchall() == [(7, 2)]
+
+        # Deletions in followed channels are recorded even if the
+        # deleted messages were never dumped
+        channel_id = tl_utils.get_peer_id(types.PeerChannel(1))
+        downloader._dump_events(self.dumper, [
+            events.MessageDeleted.Event([5], types.PeerChannel(1))
+        ], lambda cid: cid == channel_id, entity_downloader)
+        self.dumper.commit()
+        assert self.dumper.conn.execute(
+            "SELECT ContextID, ID FROM MessageDeletion "
+            "ORDER BY ContextID").fetchall() == [(channel_id, 5), (7, 2)]
+
+        # Deletions without a context may have more IDs than SQLite
+        # can bind in a single query
+        self.dump_messages(3, context_id=456)
+        self.dumper.dump_deleted_messages(range(1, 40000))
+        self.dumper.commit()
+        assert self.dumper.conn.execute(
+            "SELECT ContextID, ID FROM MessageDeletion WHERE ContextID > 0 "
+            "ORDER BY ContextID, ID").fetchall() == [
+                (7, 1), (7, 2), (456, 1), (456, 2), (456, 3)]
+
+        # The whitelist is resolved once for both exporting and following
+        class CountingDownloader:
+            loads = 0
+
+            def load_entities_from_str(self, string, dumper):
+                self.loads += 1
+                return iter([user])
+
+        counting = CountingDownloader()
+        self.dumper.config['Whitelist'] = '7'
+        whitelist = telegram_export.load_whitelist(counting, self.dumper)
+        should_export = telegram_export.get_export_filter(
+            counting, self.dumper, whitelist)
+        assert list(telegram_export.iter_export_entities(
+            counting, self.dumper, None, whitelist, should_export)) == [user]
+        assert should_export(7) and not should_export(8)
+        assert counting.loads == 1
+
+    def test_scheduler(self):
+        """
+        Ensures that busy dialogs are scheduled to be checked more often
+        than quiet ones, that the request budget is respected, and that
+        dialogs failing to export don't stop the others.
+        """
+        now = datetime(year=2010, month=1, day=31).timestamp()
+        self.dump_messages(30 * 24, context_id=1)  # One per hour
+        self.dump_messages(1, context_id=2)  # One a month ago
+        scheduler = Scheduler(self.dumper, None, requests_per_hour=10)
+        scheduler.add([1, 2, 3])
+        assert {e.context_id for e in scheduler.status()} == {1, 2, 3}
+
+        for context_id in (1, 2, 3):
+            scheduler.reschedule(context_id, now=now)
+        entries = scheduler.status(now=now + 60 * 60)
+        assert [e.context_id for e in entries] == [1, 2, 3]
+        assert entries[0].next_check - now < entries[1].next_check - now
+        assert round(entries[0].backlog) == 1
+        assert entries[2].next_check - now == MAX_INTERVAL
+
+        # Dialogs never checked are expected to have all the messages
+        # since the last one dumped, or their whole history
+        backlog = scheduler.estimate_backlog(2, now=now)
+        assert 0 < backlog < scheduler.dumper.chunk_size
+        assert scheduler.estimate_backlog(3, now=now) == UNKNOWN_BACKLOG
+        assert scheduler.get_cost(UNKNOWN_BACKLOG) > CHECK_OVERHEAD
+
+        assert scheduler._wait_for_budget(8, now) == 0
+        scheduler._spent.append((now, 8))
+        assert scheduler._wait_for_budget(2, now) == 0
+        assert scheduler._wait_for_budget(3, now) == 3600
+        assert scheduler._wait_for_budget(3, now + 3600) == 0
+
+        # A dialog failing to export is retried later, backing off,
+        # without stopping the export of the others
+        class Stop(BaseException):
+            pass
+
+        exported = []
+
+        class FailingDownloader:
+            def save_messages(self, dumper, entity):
+                if entity.id == 4:
+                    raise ConnectionError('Connection lost')
+                exported.append(entity.id)
+                raise Stop
+
+        scheduler = Scheduler(self.dumper, FailingDownloader())
+        for context_id in (1, 2, 3):
+            self.dumper.delete_schedule(context_id)
+        scheduler.add([4])
+        start = time.time()
+        with self.assertRaises(Stop):
+            scheduler.run(lambda: [types.User(id=4), types.User(id=5)])
+        assert exported == [5]
+        entry, = [e for e in scheduler.status() if e.context_id == 4]
+        assert entry.next_check - round(start) >= FAILURE_BACKOFF
+        assert entry.last_check is None
+        assert scheduler.backoff(entry) == 2 * FAILURE_BACKOFF
+
+    def test_metrics(self):
+        """
+        Ensures that the metrics are exported in the Prometheus format,
+        both directly and over HTTP.
+        """
+        metrics = Metrics()
+        metrics.inc('requests_total', type='GetHistoryRequest')
+        metrics.inc('requests_total', 2, type='GetHistoryRequest')
+        metrics.set('queue_depth', 5, queue='entities')
+        metrics.observe('commit_seconds', 0.5)
+        metrics.observe('commit_seconds', 1.5)
+
+        snapshot = metrics.snapshot()
+        assert snapshot['requests_total{type="GetHistoryRequest"}'] == 3
+        assert snapshot['commit_seconds_sum'] == 2
+
+        text = metrics.to_prometheus()
+        assert '# TYPE telegram_export_queue_depth gauge' in text
+        assert 'telegram_export_queue_depth{queue="entities"} 5' in text
+        assert 'telegram_export_commit_seconds_count 2' in text
+
+        server = metrics.serve(0)
+        try:
+            with urlopen('http://127.0.0.1:{}/metrics'.format(
+                    server.server_address[1])) as response:
+                assert response.read().decode('utf-8') == text
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Getting participants is counted as the requests it makes
+        def count(name):
+            return REGISTRY.snapshot().get(
+                'requests_total{{type="{}"}}'.format(name), 0)
+
+        before = count('GetParticipantsRequest')
+        channel = types.InputPeerChannel(1, 0)
+        assert len(list(_count_participant_requests(
+            channel, range(450)))) == 450
+        assert count('GetParticipantsRequest') - before == 4
+
+        before = count('GetFullChatRequest')
+        list(_count_participant_requests(types.InputPeerChat(1), range(10)))
+        assert count('GetFullChatRequest') - before == 1
+
+    def test_profiler(self):
+        """
+        Ensures that phases are only timed while enabled, attributed to
+        the right dialog and saved as Chrome trace events.
+        """
+        profiler = Profiler()
+        with profiler.phase('network'):
+            pass
+        assert 'network' not in profiler.report()
+
+        profiler.enable(trace=True)
+        with profiler.dialog('Some chat'):
+            with profiler.phase('network'):
+                time.sleep(0.01)
+            with profiler.phase('insert'):
+                pass
+        with profiler.phase('commit'):
+            pass
+
+        report = profiler.report()
+        assert report.startswith('Some chat')
+        assert '<no dialog>' in report and 'Overall' in report
+
+        trace_file = str(Path(self.work_dir) / 'trace.json')
+        profiler.save_trace(trace_file)
+        with open(trace_file) as f:
+            events = json.load(f)['traceEvents']
+        assert [(e['name'], e['cat']) for e in events] == [
+            ('network', 'Some chat'), ('insert', 'Some chat'),
+            ('commit', '<no dialog>')]
+        assert events[0]['dur'] >= 10000
+
+    def test_bounded_memory(self):
+        """
+        Ensures that pending entities over the limit are spilled to the
+        database and come back in order.
+        """
+        entity_downloader = _EntityDownloader(None, self.dumper,
+                                              max_pending=2)
+        entity_downloader.extend_pending(
+            types.User(id=i, first_name=str(i)) for i in range(1, 6))
+        assert len(entity_downloader._pending) == 2
+        assert len(entity_downloader) == 5
+
+        dumped = []
+        entity_downloader._dump_entity = lambda e: dumped.append(e.id) or 0
+        while entity_downloader:
+            entity_downloader.pop_pending()
+        assert dumped == [1, 2, 3, 4, 5]
+        assert not self.dumper.unspill_entities(id(entity_downloader), 10)
+
+    def test_memory_profiler(self):
+        """
+        Ensures that the memory profiler reports the allocations made
+        since it was enabled, by dialog, even where the peak can't be
+        reset (before Python 3.9).
+        """
+        profiler = MemoryProfiler(top=3)
+        profiler.snapshot('Ignored')
+        profiler.enable()
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        try:
+            garbage = [bytes(1024) for _ in range(1024)]
+            profiler.snapshot('Some chat')
+            if reset_peak:
+                del tracemalloc.reset_peak
+            profiler.snapshot('Old Python')
+            report = profiler.report()
+        finally:
+            if reset_peak:
+                tracemalloc.reset_peak = reset_peak
+            tracemalloc.stop()
+        assert report.startswith('Some chat: ')
+        assert 'MiB peak since start' in report.split('Old Python: ')[1]
+        assert 'Ignored' not in report
+        assert 'tests.py' in report and len(garbage) == 1024
+
+    def test_bench(self):
+        """
+        Ensures that the benchmarks run over synthetic data and that
+        slower results than the baseline are reported as regressions.
+        """
+        results = bench.run_benchmarks(20, repeat=1, file=None,
+                                       names=['utils.', 'formatter.text'])
+        assert set(results['results']) == {
+            'utils.encode_msg_entities', 'utils.decode_msg_entities',
+            'utils.sanitize_dict', 'formatter.text'}
+        assert all(r['operations'] == 20 for r in results['results'].values())
+
+        baseline = json.loads(json.dumps(results))
+        baseline['results']['formatter.text']['ops_per_second'] *= 2
+        comparison = {name: regression for name, _, _, _, regression
+                      in bench.compare(results, baseline)}
+        assert comparison == {'utils.encode_msg_entities': False,
+                              'utils.decode_msg_entities': False,
+                              'utils.sanitize_dict': False,
+                              'formatter.text': True}
+
+    def test_simulated_export(self):
+        """
+        Ensures that whole exports against the simulated backend dump
+        every message despite flood waits, disconnections and files in
+        other DCs, and that the simulation is deterministic.
+        """
+        profile = simulator.Profile(
+            latency=0.1, jitter=0.1, flood_wait_rate=0.2, flood_wait=30,
+            disconnect_rate=0.2, reconnect_time=5, migrate_time=1,
+            bandwidth=None
+        )
+        reconnects = REGISTRY.snapshot().get('reconnects_total', 0)
+        migrations = REGISTRY.snapshot().get('migrations_total', 0)
+        results = [simulator.run_profile(profile, dialogs=4, messages=250,
+                                         participants=5) for _ in range(2)]
+        assert results[0]['messages'] == 4 * 250
+        assert results[0]['flood_waits'] and results[0]['disconnects']
+        assert results[0]['migrations']
+        # The Downloader itself reconnected and followed the files
+        assert REGISTRY.snapshot()['reconnects_total'] > reconnects
+        assert REGISTRY.snapshot()['migrations_total'] > migrations
+        assert results[0]['seconds'] == results[1]['seconds']
+        assert results[0]['requests'] == results[1]['requests']
+
+        with self.assertRaises(ValueError):
+            simulator.SimulatedClient()(functions.help.GetConfigRequest())
+
+    def test_snapshot(self):
+        """
+        Ensures that snapshots are complete copies, that applying the
+        delta between two of them on the first results in the second,
+        and that sharded databases (which they can't copy) are refused.
+        """
+        self.dump_messages(1000)
+        db_file = str(Path(self.work_dir) / 'test_db.db')
+        first = str(Path(self.work_dir) / 'first.db')
+        second = str(Path(self.work_dir) / 'second.db')
+        assert snapshot.snapshot(db_file, first, pages=8) == 0
+
+        self.dump_messages(10, context_id=456)
+        snapshot.snapshot(db_file, second, pages=8)
+        delta = str(Path(self.work_dir) / 'second.delta')
+        changed = snapshot.write_delta(first, second, delta)
+        assert 0 < changed < Path(second).stat().st_size // 4096
+
+        restored = str(Path(self.work_dir) / 'restored.db')
+        snapshot.apply_delta(first, delta, restored)
+        assert Path(restored).read_bytes() == Path(second).read_bytes()
+        fmt = BaseFormatter(restored)
+        assert len(list(fmt.get_messages_from_context(123))) == 1000
+        assert len(list(fmt.get_messages_from_context(456))) == 10
+        fmt.dbconn.close()
+
+        # Sharded databases keep their messages out of the catalog, so
+        # they're refused instead of copied without them
+        config = configparser.ConfigParser()
+        config['Dumper'] = dict(self.dumper_config)
+        config['Dumper']['DBFileName'] = 'sharded'
+        config['Dumper']['Sharding'] = 'context'
+        self.dumper.close()
+        self.dumper = Dumper(config['Dumper'])
+        self.dumper.check_self_user(123)
+        self.dump_messages(10)
+        sharded = str(Path(self.work_dir) / 'sharded.db')
+        sharded_copy = str(Path(self.work_dir) / 'sharded_copy.db')
+        with self.assertRaises(ValueError):
+            snapshot.snapshot(sharded, sharded_copy)
+        assert not Path(sharded_copy).exists()
+        assert not Path(sharded_copy + '.tmp').exists()
+
+        # Copying in steps gives up instead of blocking a busy writer,
+        # and file names are not mistaken for parts of the URI
+        busy = str(Path(self.work_dir) / 'busy?#.db')
+        conn = sqlite3.connect(busy, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.execute('CREATE TABLE Data (Value BLOB)')
+        conn.executemany('INSERT INTO Data VALUES (?)',
+                         ((bytes(4096),) for _ in range(64)))
+        conn.commit()
+        assert snapshot.snapshot(busy, first, pages=8) == 0
+
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                conn.execute('INSERT INTO Data VALUES (?)', (b'x',))
+                conn.commit()
+                time.sleep(0.001)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            with self.assertRaises(snapshot.SnapshotError):
+                snapshot.snapshot(busy, second, pages=1, sleep=0.002,
+                                  max_restarts=2)
+        finally:
+            stop.set()
+            writer.join()
+        conn.close()
+
+    def test_durability(self):
+        """
+        Ensures that the durability profiles set their pragmas, and that
+        maybe_commit only commits after their interval or enough rows, so
+        a crash only loses what was dumped since the last commit.
+        """
+        # The safest profile is the default
+        assert self.dumper.durability == DURABILITY_PROFILES['safe']
+        assert self.dumper.conn.execute(
+            'PRAGMA journal_mode').fetchone()[0] == 'delete'
+
+        # Not syncing at all may corrupt the database on power loss
+        assert all(p.synchronous != 'OFF'
+                   for p in DURABILITY_PROFILES.values())
+
+        config = configparser.ConfigParser()
+        config['Dumper'] = dict(self.dumper_config)
+        config['Dumper']['DBFileName'] = 'durability'
+        for name, profile in DURABILITY_PROFILES.items():
+            config['Dumper']['Durability'] = name
+            dumper = Dumper(config['Dumper'])
+            assert dumper.conn.execute('PRAGMA journal_mode').fetchone()[0]\
+                == profile.journal_mode.lower()
+            assert dumper.conn.execute('PRAGMA synchronous').fetchone()[0]\
+                == ('OFF', 'NORMAL', 'FULL').index(profile.synchronous)
+            assert dumper.conn.execute('PRAGMA cache_size').fetchone()[0]\
+                == -(profile.cache_size // 1024)
+            assert dumper.conn.execute('PRAGMA mmap_size').fetchone()[0]\
+                == profile.mmap_size
+            assert dumper.conn.execute('PRAGMA temp_store').fetchone()[0]\
+                == ('DEFAULT', 'FILE', 'MEMORY').index(profile.temp_store)
+            dumper.conn.close()
+
+        config['Dumper']['Durability'] = 'fast'
+        with self.assertRaises(ValueError):
+            Dumper(config['Dumper'])
+
+        config['Dumper']['Durability'] = 'bulk-import'
+        dumper = Dumper(config['Dumper'])
+        dumper.check_self_user(123)
+        msg = types.Message(id=1, to_id=types.PeerUser(123),
+                            date=datetime.now(), message='hi')
+        dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        dumper.save_resume(123, msg=1)
+        assert not dumper.maybe_commit()
+        dumper._last_commit -= dumper.durability.commit_interval
+        assert dumper.maybe_commit()
+        msg.id = 2
+        dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        dumper.save_resume(123, msg=2)
+        assert not dumper.maybe_commit()
+        dumper.conn.close()  # Crash without committing
+
+        dumper = Dumper(config['Dumper'])
+        assert dumper.get_message_count(123) == 1
+        assert dumper.get_resume(123)[0] == 1
+        dumper.conn.close()
+
+        # Commits are also grouped by the amount of rows
+        config['Dumper']['CommitInterval'] = '3600'
+        config['Dumper']['CommitRows'] = '3'
+        dumper = Dumper(config['Dumper'])
+        dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        dumper.save_resume(123, msg=2)
+        assert not dumper.maybe_commit()
+        msg.id = 3
+        dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        assert dumper.maybe_commit()
+        assert not dumper.maybe_commit()
+
+        # Rows written in bulk count too, not only those inserted alone
+        dumper.dump_deleted_messages([1, 2, 3], context_id=123)
+        assert dumper.maybe_commit()
+        dumper.dump_dialog(types.User(id=7, first_name='Someone'))
+        assert dumper.maybe_commit()
+        dumper.conn.close()
+
+    def test_msg_entities_encoding(self):
+        """
+        Ensures that every kind of entity survives the binary encoding,
+        and that databases with the old text encoding are upgraded.
+        """
+        entities = [
+            types.MessageEntityBold(10, 5),
+            types.MessageEntityTextUrl(2, 3, 'https://a.com/?q=1,2;3'),
+            types.MessageEntityPre(0, 300, 'python'),
+            types.MessageEntityMentionName(40, 4, 123456789),
+            types.MessageEntityTextUrl(50, 3, 'https://a.com/?q=1,2;3'),
+        ] + [cls(60 + i, 1) for i, cls in enumerate((
+            types.MessageEntityUnknown, types.MessageEntityMention,
+            types.MessageEntityHashtag, types.MessageEntityBotCommand,
+            types.MessageEntityUrl, types.MessageEntityEmail,
+            types.MessageEntityCode, types.MessageEntityItalic
+        ))]
+        encoded = utils.encode_msg_entities(entities)
+        assert isinstance(encoded, bytes)
+        assert utils.decode_msg_entities(encoded) == entities
+        assert utils.encode_msg_entities([]) is None
+        assert utils.decode_msg_entities(None) is None
+        with self.assertRaises(ValueError):
+            utils.decode_msg_entities(b'\xff' + encoded[1:])
+
+        text = utils.msg_entities_to_text(entities)
+        assert len(encoded) < len(text)
+        assert utils.decode_msg_entities(text) == entities
+
+        self.dumper.check_self_user(123)
+        msg = types.Message(id=1, to_id=types.PeerUser(123),
+                            date=datetime.now(), message='hi')
+        self.dumper.dump_message(msg, 123, forward_id=None, media_id=None)
+        self.dumper.conn.execute(
+            'UPDATE Message SET Formatting = ?', ('bold,0,2;pre,0,1',))
+        self.dumper.conn.execute('UPDATE Version SET Version = 6')
+        self.dumper.commit()
+        self.dumper.conn.close()
+
+        self.dumper = Dumper(self.dumper_config)
+        formatting, = self.dumper.conn.execute(
+            'SELECT Formatting FROM Message').fetchone()
+        assert utils.decode_msg_entities(formatting) == [
+            types.MessageEntityBold(0, 2), types.MessageEntityPre(0, 1, '')]
+
+    def test_store_raw_tl(self):
+        """
+        Ensures that media and actions stored as raw TL objects are read
+        back as the same dictionaries as those stored as JSON.
+        """
+        media = bench.make_media(random.Random(0), 1)
+        action = types.MessageActionChatEditTitle('Title')
+        msg = types.MessageService(id=1, to_id=types.PeerChat(123),
+                                   date=datetime.now(), action=action)
+        config = configparser.ConfigParser()
+        config['Dumper'] = dict(self.dumper_config)
+        config['Dumper']['DBFileName'] = 'raw'
+        config['Dumper']['StoreRawTL'] = 'true'
+        raw_dumper = Dumper(config['Dumper'])
+        for dumper in (self.dumper, raw_dumper):
+            dumper.check_self_user(123)
+            media_id = dumper.dump_media(media)
+            dumper.dump_message_service(msg, 123, media_id=media_id)
+            dumper.commit()
+
+        extra, = raw_dumper.conn.execute(
+            'SELECT Extra FROM Media').fetchone()
+        assert isinstance(extra, bytes)
+        assert utils.decode_tl_object(extra) == media
+
+        for dumper in (self.dumper, raw_dumper):
+            fmt = BaseFormatter(dumper.conn)
+            message = next(fmt.get_messages_from_context(123))
+            assert utils.tl_data_to_dict(message.text, keep_type=False) == \
+                {'title': 'Title'}
+            extra = fmt.get_media(message.media_id).extra
+            assert utils.tl_data_to_dict(extra)['_'] == type(media).__name__
+        raw_dumper.conn.close()
+
+    def test_column_compression(self):
+        """
+        Ensures that compressed columns are read back transparently, that
+        a dictionary is trained after enough values, and that existing
+        databases can be recompressed (or decompressed).
+        """
+        rng = random.Random(0)
+        config = configparser.ConfigParser()
+        config['Dumper'] = dict(self.dumper_config)
+        config['Dumper']['DBFileName'] = 'compressed'
+        config['Dumper']['ColumnCompression'] = 'zstd'
+        dumper = Dumper(config['Dumper'])
+        dumper.compressor.train_samples = 100
+        dumper.check_self_user(123)
+        media = [bench.make_media(rng, i) for i in range(1, 201)]
+        ids = [dumper.dump_media(m) for m in media]
+        dumper.commit()
+
+        assert dumper.compressor.dict_id
+        extras = [row[0] for row in dumper.conn.execute(
+            'SELECT Extra FROM Media')]
+        compressed = [e for e in extras if isinstance(e, bytes)]
+        assert len(compressed) > len(extras) // 2
+        assert all(e.startswith(compression.MAGIC) for e in compressed)
+
+        def check():
+            fmt = BaseFormatter(dumper.conn)
+            for media_id, m in zip(ids, media):
+                extra = utils.tl_data_to_dict(fmt.get_media(media_id).extra)
+                assert extra['_'] == type(m).__name__
+
+        check()
+        reports = recompress.recompress(dumper, 'zlib')
+        assert reports[0].rows == len(extras)
+        assert reports[0].size_after < reports[0].size_plain
+        assert not dumper.conn.execute(
+            'SELECT COUNT(*) FROM CompressionDict').fetchone()[0]
+        check()
+        reports = recompress.recompress(dumper, None)
+        assert reports[0].size_after == reports[0].size_plain
+        assert isinstance(dumper.conn.execute(
+            'SELECT Extra FROM Media').fetchone()[0], str)
+        check()
+        dumper.conn.close()
+
+    def test_sharding(self):
+        """
+        Ensures that the messages of every context are stored in its shard
+        (or hash bucket), and that formatters read them back from there.
+        """
+        for sharding, files in (('context', {'shard1.db', 'shard2.db',
+                                             'shard5.db'}),
+                                ('2', {'shard0.db', 'shard1.db'})):
+            config = configparser.ConfigParser()
+            config['Dumper'] = dict(self.dumper_config)
+            config['Dumper']['DBFileName'] = 'sharded' + sharding
+            config['Dumper']['Sharding'] = sharding
+            config['Dumper']['FullTextSearch'] = 'yes'
+            self.dumper.conn.close()
+            self.dumper = Dumper(config['Dumper'])
+            self.dumper.check_self_user(123)
+            for context_id in (1, 2, 5):
+                self.dump_messages(context_id, context_id=context_id)
+            self.dumper.save_resume(5, msg=5, msg_date=0, stop_at=0)
+            self.dumper.commit()
+
+            directory = Path(self.work_dir, 'sharded' + sharding + '.shards')
+            assert {p.name for p in directory.glob('*.db')} == files
+            assert not self.dumper.conn.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'Message'"
+            ).fetchone()
+            assert self.dumper.get_message_count(5) == 5
+            assert self.dumper.get_resume(5) == (5, 0, 0)
+
+            self.dumper.close()
+            self.dumper = Dumper(config['Dumper'])
+            assert self.dumper.shard_buckets == shards.parse_sharding(sharding)
+            assert self.dumper.get_message_count(2) == 2
+
+            # Reading contexts without messages doesn't create their shard
+            assert self.dumper.get_resume(7) == (0, 0, 0)
+            assert self.dumper.get_message_count(7) == 0
+            assert self.dumper.get_activity(7, 0) == (0, None)
+            assert {p.name for p in directory.glob('*.db')} == files
+            assert not self.dumper.conn.execute(
+                'SELECT * FROM Shard WHERE ContextID = 7').fetchone()
+
+            args = SimpleNamespace(search_query='hi', search_context=2,
+                                   search_from=None, search_after=None,
+                                   search_before=None)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                assert telegram_export.search_messages(
+                    args, self.dumper) is None
+            assert len(out.getvalue().splitlines()) == 2
+
+            fmt = BaseFormatter(str(Path(self.work_dir,
+                                         'sharded' + sharding + '.db')))
+            assert sorted(fmt.iter_context_ids()) == [1, 2, 5]
+            messages, _ = fmt.get_messages_page(5, limit=10)
+            assert [m.id for m in messages] == [1, 2, 3, 4, 5]
+            assert fmt.get_message_by_id(2, 2).text == 'hi'
+            assert fmt.get_message_by_id(1, 2) is None
+            assert len(fmt.search_messages('hi')) == 8
+            assert len(fmt.search_messages('hi', context_id=2)) == 2
+            fmt.shard_pool.close()
+            fmt.dbconn.close()
+
+            # Channels have their own IDs, so their shards aren't opened
+            # to find the context of deleted messages
+            self.dump_messages(1, context_id=-1001000000001)
+            self.dumper.close()
+            self.dumper = Dumper(config['Dumper'])
+            self.dumper.dump_deleted_messages([1])
+            assert len(self.dumper.shard_pool.open_conns()) == len(files)
+            assert sum(conn.execute(
+                'SELECT COUNT(*) FROM MessageDeletion').fetchone()[0]
+                for conn in self.dumper.shard_pool.open_conns()) == 3
+
+        config['Dumper']['DBFileName'] = 'unindexed'
+        config['Dumper']['FullTextSearch'] = 'no'
+        self.dumper.close()
+        self.dumper = Dumper(config['Dumper'])
+        self.dumper.check_self_user(123)
+        self.dump_messages(1)
+        with contextlib.redirect_stderr(io.StringIO()):
+            assert telegram_export.search_messages(args, self.dumper) == 1
+
+        with self.assertRaises(ValueError):
+            shards.parse_sharding('-1')
+
+    def test_merge(self):
+        """
+        Ensures that databases are merged with their media and forwards
+        remapped, that duplicate media and messages are skipped, and that
+        compressed values can still be read after.
+        """
+        rng = random.Random(0)
+        media = [bench.make_media(rng, i) for i in range(1, 41)]
+
+        def make_dumper(name, sharding):
+            config = configparser.ConfigParser()
+            config['Dumper'] = dict(self.dumper_config)
+            config['Dumper']['DBFileName'] = name
+            config['Dumper']['Sharding'] = sharding
+            config['Dumper']['StoreRawTL'] = 'yes'
+            config['Dumper']['ColumnCompression'] = 'zstd'
+            dumper = Dumper(config['Dumper'])
+            dumper.compressor.train_samples = 10
+            return dumper
+
+        def make_source(name, sharding, self_id, contexts, media):
+            dumper = make_dumper(name, sharding)
+            dumper.check_self_user(self_id)
+            for context_id, minutes in contexts:
+                for i, m in enumerate(media, start=1):
+                    fwd = types.MessageFwdHeader(
+                        date=datetime(year=2010, month=1, day=1),
+                        from_id=context_id)
+                    msg = types.Message(
+                        id=i, to_id=types.PeerUser(context_id),
+                        date=datetime(year=2010, month=1, day=1,
+                                      minute=minutes) + timedelta(hours=i),
+                        message='hi', fwd_from=fwd)
+                    dumper.dump_message(
+                        msg, context_id, forward_id=dumper.dump_forward(fwd),
+                        media_id=dumper.dump_media(m))
+            me = types.User(id=self_id, first_name=name)
+            dumper.dump_user(photo_id=dumper.dump_media(media[0]), timestamp=1,
+                             user_full=types.UserFull(
+                                 user=me, link=types.contacts.Link(
+                                     my_link=types.ContactLinkContact(),
+                                     foreign_link=types.ContactLinkContact(),
+                                     user=me),
+                                 notify_settings=types.PeerNotifySettings(
+                                     0, 'beep'),
+                                 common_chats_count=0))
+            dumper.commit()
+            dumper.close()
+            return str(Path(self.work_dir, name + '.db'))
+
+        # The second one has 10 of the media, and different messages
+        # with the same IDs in context 20 (like another account would).
+        # The third one is another export of the second account.
+        first = make_source('first', 'none', 1, ((10, 0), (20, 0)),
+                            media[:30])
+        second = make_source('second', 'context', 2, ((20, 1), (30, 0)),
+                             media[20:])
+        third = make_source('third', 'none', 2, ((20, 1),), media[20:])
+
+        merged = make_dumper('merged', '2')
+        reports = [merge.merge(merged, first), merge.merge(merged, second),
+                   merge.merge(merged, third)]
+        assert reports[0].duplicate_media == 0
+        assert reports[1].duplicate_media > 10
+        assert [r.messages for r in reports] == [60, 40, 0]
+        assert [r.conflicts for r in reports] == [0, 0, 0]
+        assert [r.forwards for r in reports] == [60, 40, 20]
+        assert merged.conn.execute('SELECT COUNT(*) FROM Media').fetchone()[0] \
+            == sum(r.media for r in reports)
+        assert merged.conn.execute(
+            'SELECT COUNT(*) FROM CompressionDict').fetchone()[0] == 2
+
+        # The private chats of the second account got their own IDs
+        rows = merged.conn.execute(
+            'SELECT SourceContextID, SourceID, ContextID FROM MergedContext '
+            'ORDER BY 1, 2').fetchall()
+        assert [row[:2] for row in rows] == \
+            [(10, 1), (20, 1), (20, 2), (20, 3), (30, 2)]
+        context_ids = {(source, old): new for old, source, new in rows}
+        assert context_ids[1, 10] == 10 and context_ids[1, 20] == 20
+        assert context_ids[2, 20] == context_ids[3, 20] \
+            <= merge.OTHER_ACCOUNT_CONTEXT_ID
+        assert context_ids[2, 30] <= merge.OTHER_ACCOUNT_CONTEXT_ID
+        with self.assertRaises(ValueError):
+            merge.merge(merged, first)
+        merged.close()
+
+        def files(fmt):
+            """Returns {(context, message): (media file, extra type)}"""
+            result = {}
+            for context_id in fmt.iter_context_ids():
+                for msg in fmt.get_messages_from_context(context_id):
+                    m = fmt.get_media(msg.media_id)
+                    result[context_id, msg.id] = (
+                        m.local_id, m.volume_id, m.secret,
+                        utils.tl_data_to_dict(m.extra)['_'],
+                        fmt.get_forward(msg.forward_id).from_id)
+            return result
+
+        fmt = BaseFormatter(str(Path(self.work_dir, 'merged.db')))
+        expected = files(BaseFormatter(first))
+        expected.update(((context_ids[2, c], i), v) for (c, i), v
+                        in files(BaseFormatter(second)).items())
+        assert files(fmt) == expected
+
+        picture = fmt.get_media(fmt.get_user(2).picture_id)
+        assert (picture.local_id, picture.volume_id, picture.secret) == \
+            expected[context_ids[2, 30], 1][:3]
+
+    def test_sql_trace(self):
+        """
+        Ensures that traced statements are aggregated by their normalized
+        form, and that slow ones are logged with their query plan.
+        """
+        assert normalize("SELECT *  FROM Media\nWHERE ID IN (?, ?, ?)"
+                         " AND Name = 'a'") == \
+            'SELECT * FROM Media WHERE ID IN (...) AND Name = ?'
+
+        tracer = SqlTracer()
+        tracer.enable(threshold_ms=0)
+        conn = tracer.connect(':memory:')
+        conn.execute('CREATE TABLE Media (ID INT, LocalID INT)')
+        conn.executemany('INSERT INTO Media VALUES (?, ?)',
+                         ((i, i) for i in range(100)))
+        with self.assertLogs('sqltrace', level='WARNING') as logs:
+            for i in range(3):
+                conn.execute('SELECT ID FROM Media WHERE LocalID = ?',
+                             (i,)).fetchone()
+        conn.commit()
+        conn.close()
+
+        assert any('SCAN Media' in line for line in logs.output)
+        summary = tracer.summary()
+        assert '        3 ' in summary
+        assert 'SELECT ID FROM Media WHERE LocalID = ?' in summary
+        assert 'COMMIT' in summary
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,21 @@
 """Utility functions for telegram-export which aren't specific to one purpose"""
+import json
+import re
+from base64 import b64encode
+from datetime import datetime
+
+from telethon.extensions import BinaryReader
 from telethon.tl import types
+from telethon.utils import get_peer_id
 
 
 ENTITY_TO_TEXT = {
+    types.MessageEntityUnknown: 'unknown',
+    types.MessageEntityMention: 'mention',
+    types.MessageEntityHashtag: 'hashtag',
+    types.MessageEntityBotCommand: 'botcommand',
+    types.MessageEntityUrl: 'url',
+    types.MessageEntityEmail: 'email',
     types.MessageEntityPre: 'pre',
     types.MessageEntityCode: 'code',
     types.MessageEntityBold: 'bold',
@@ -13,38 +26,141 @@ ENTITY_TO_TEXT = {
 
 TEXT_TO_ENTITY = {v: k for k, v in ENTITY_TO_TEXT.items()}
 
+# Version of the binary encoding of the entities, its first byte
+MSG_ENTITIES_VERSION = 1
+
+# The codes of every entity in the binary encoding, which must never
+# change. Unknown types are encoded as MessageEntityUnknown.
+ENTITY_TO_CODE = {
+    types.MessageEntityUnknown: 0,
+    types.MessageEntityMention: 1,
+    types.MessageEntityHashtag: 2,
+    types.MessageEntityBotCommand: 3,
+    types.MessageEntityUrl: 4,
+    types.MessageEntityEmail: 5,
+    types.MessageEntityPre: 6,
+    types.MessageEntityCode: 7,
+    types.MessageEntityBold: 8,
+    types.MessageEntityItalic: 9,
+    types.MessageEntityTextUrl: 10,
+    types.MessageEntityMentionName: 11
+}
+
+CODE_TO_ENTITY = {v: k for k, v in ENTITY_TO_CODE.items()}
+
+# The entities with a string (or integer) besides the offset and length
+_STRING_ENTITIES = {
+    types.MessageEntityPre: 'language',
+    types.MessageEntityTextUrl: 'url'
+}
+_STRING_CODES = {ENTITY_TO_CODE[t] for t in _STRING_ENTITIES}
+_INT_CODE = ENTITY_TO_CODE[types.MessageEntityMentionName]
+
+
+def _write_varint(out, value):
+    """Appends the unsigned value as a LEB128 varint to the bytearray"""
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    """Reads a LEB128 varint from data at pos, returns (value, next pos)"""
+    value = data[pos]
+    if value < 0x80:  # Most values fit in a single byte
+        return value, pos + 1
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
 
 def encode_msg_entities(entities):
     """
-    Encodes a list of MessageEntity into a string so it
-    can easily be dumped into e.g. Dumper's database.
+    Encodes a list of MessageEntity into bytes so it can easily be
+    dumped into e.g. Dumper's database, or None if there are none.
+
+    After the version byte come the distinct strings (URLs and code
+    languages) as (varint length, UTF-8), which the entities refer to
+    by index, and then (varint code, zigzag varint offset delta, varint
+    length and the string index or user ID if any) for every entity.
     """
     if not entities:
         return None
-    parsed = []
+
+    strings = {}
+    body = bytearray()
+    _write_varint(body, len(entities))
+    last_offset = 0
     for entity in entities:
-        if entity.__class__ in ENTITY_TO_TEXT:
-            if isinstance(entity, types.MessageEntityTextUrl):
-                extra = ',{}'.format(
-                    entity.url.replace(',', '%2c').replace(';', '%3b')
-                )
-            elif isinstance(entity, types.MessageEntityMentionName):
-                extra = ',{}'.format(entity.user_id)
-            else:
-                extra = ''
-            parsed.append('{},{},{}{}'.format(
-                ENTITY_TO_TEXT[type(entity)],
-                entity.offset, entity.length, extra
-            ))
-    return ';'.join(parsed)
+        cls = type(entity)
+        code = ENTITY_TO_CODE.get(cls, 0)
+        delta = entity.offset - last_offset
+        last_offset = entity.offset
+        _write_varint(body, code)
+        _write_varint(body, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        _write_varint(body, entity.length)
+        if code in _STRING_CODES:
+            string = getattr(entity, _STRING_ENTITIES[cls]) or ''
+            _write_varint(body, strings.setdefault(string, len(strings)))
+        elif code == _INT_CODE:
+            _write_varint(body, entity.user_id)
 
+    out = bytearray((MSG_ENTITIES_VERSION,))
+    _write_varint(out, len(strings))
+    for string in strings:  # Dictionaries keep the insertion order
+        data = string.encode('utf-8')
+        _write_varint(out, len(data))
+        out += data
+    return bytes(out + body)
+
+
+def _decode_msg_entities(data):
+    """Decodes the binary encoding made by ``encode_msg_entities``"""
+    if data[0] != MSG_ENTITIES_VERSION:
+        raise ValueError('Unknown entities encoding version {}'
+                         .format(data[0]))
+
+    # The strings are read first, then every other value is a varint
+    count, pos = _read_varint(data, 1)
+    strings = []
+    for _ in range(count):
+        size, pos = _read_varint(data, pos)
+        strings.append(data[pos:pos + size].decode('utf-8'))
+        pos += size
+
+    values = []
+    end = len(data)
+    while pos < end:
+        value, pos = _read_varint(data, pos)
+        values.append(value)
 
-def decode_msg_entities(string):
-    """
-    Reverses the transformation made by ``utils.encode_msg_entities``.
-    """
-    if not string:
-        return None
+    parsed = []
+    i = 1  # values[0] is the amount of entities
+    offset = 0
+    while i < len(values):
+        code, delta, length = values[i], values[i + 1], values[i + 2]
+        i += 3
+        offset += -((delta + 1) >> 1) if delta & 1 else delta >> 1
+        cls = CODE_TO_ENTITY.get(code, types.MessageEntityUnknown)
+        if code in _STRING_CODES:
+            parsed.append(cls(offset, length, strings[values[i]]))
+            i += 1
+        elif code == _INT_CODE:
+            parsed.append(cls(offset, length, values[i]))
+            i += 1
+        else:
+            parsed.append(cls(offset, length))
+    return parsed
+
+
+def _decode_msg_entities_text(string):
+    """Decodes the text encoding used by older versions of the database"""
     parsed = []
     for part in string.split(';'):
         split = part.split(',')
@@ -52,17 +168,142 @@ def decode_msg_entities(string):
         if kind in TEXT_TO_ENTITY:
             if kind == 'texturl':
                 parsed.append(types.MessageEntityTextUrl(
-                    offset, length, split[-1]
+                    offset, length,
+                    split[-1].replace('%3b', ';').replace('%2c', ',')
                 ))
             elif kind == 'mentionname':
                 parsed.append(types.MessageEntityMentionName(
                     offset, length, int(split[-1])
                 ))
+            elif kind == 'pre':
+                parsed.append(types.MessageEntityPre(
+                    offset, length, split[3] if len(split) > 3 else ''
+                ))
             else:
                 parsed.append(TEXT_TO_ENTITY[kind](offset, length))
     return parsed
 
 
+def decode_msg_entities(data):
+    """
+    Reverses the transformation made by ``utils.encode_msg_entities``.
+    The text encoding used by older versions is also understood.
+    """
+    if not data:
+        return None
+    if isinstance(data, str):
+        return _decode_msg_entities_text(data)
+    return _decode_msg_entities(data)
+
+
+def msg_entities_to_text(entities):
+    """
+    Returns a human-readable string for a list of MessageEntity, such
+    as "bold,0,5;texturl,10,4,https://example.com" (with commas and
+    semicolons in URLs and languages escaped as %2c and %3b).
+    """
+    if not entities:
+        return None
+    parsed = []
+    for entity in entities:
+        kind = ENTITY_TO_TEXT.get(type(entity), 'unknown')
+        extra = ''
+        if isinstance(entity, types.MessageEntityMentionName):
+            extra = ',{}'.format(entity.user_id)
+        elif type(entity) in _STRING_ENTITIES:
+            extra = ',{}'.format(
+                (getattr(entity, _STRING_ENTITIES[type(entity)]) or '')
+                .replace(',', '%2c').replace(';', '%3b')
+            )
+        parsed.append('{},{},{}{}'.format(
+            kind, entity.offset, entity.length, extra))
+    return ';'.join(parsed)
+
+
+def sanitize_dict(dictionary):
+    """
+    Sanitizes a dictionary, encoding all bytes as
+    Base64 so that it can be serialized as JSON.
+
+    Assumes that there are no containers with bytes inside,
+    and that the dictionary doesn't contain self-references.
+    """
+    for k, v in dictionary.items():
+        if isinstance(v, bytes):
+            dictionary[k] = str(b64encode(v), encoding='ascii')
+        elif isinstance(v, datetime):
+            dictionary[k] = v.timestamp()
+        elif isinstance(v, dict):
+            sanitize_dict(v)
+        elif isinstance(v, list):
+            for d in v:
+                if isinstance(d, dict):
+                    sanitize_dict(d)
+
+
+def decode_tl_object(data):
+    """
+    Returns the TLObject stored in a Media's Extra, an AdminLog's Data
+    or a service message's text if it was dumped as raw bytes (with
+    StoreRawTL), or None if it was dumped as JSON or not at all.
+    """
+    if not isinstance(data, bytes):
+        return None
+    return BinaryReader(data).tgread_object()
+
+
+def tl_data_to_dict(data, keep_type=True):
+    """
+    Returns the (sanitized) dictionary stored in a Media's Extra, an
+    AdminLog's Data or a service message's text, whether it was dumped
+    as JSON or as raw bytes, which are only decoded now. Actions have
+    no '_' with the name of their type when dumped as JSON, so it's
+    only kept for the raw ones if keep_type is set.
+    """
+    if not data:
+        return None
+    if isinstance(data, str):
+        return json.loads(data)
+
+    result = decode_tl_object(data).to_dict()
+    if not keep_type:
+        del result['_']
+    sanitize_dict(result)
+    return result
+
+
+def trigrams(string):
+    """
+    Returns the set of lowercase trigrams of every word in the string,
+    padding each word with two spaces before and one after it so that
+    short words and word beginnings also produce trigrams.
+    """
+    result = set()
+    for word in re.findall(r'\w+', (string or '').lower()):
+        word = '  {} '.format(word)
+        result.update(word[i:i + 3] for i in range(len(word) - 2))
+    return result
+
+
+def get_resolve_key(who):
+    """
+    Returns the key under which the entity for 'who' is kept in the
+    entity cache. 'who' may be a marked ID, an "@username" or username,
+    a "+phone" number or a peer. Returns None if it can't be cached.
+    """
+    if isinstance(who, str):
+        who = who.strip()
+        if who.startswith('+'):
+            return '+' + ''.join(c for c in who if c.isdigit())
+        return '@' + who.lstrip('@').lower() if who.lstrip('@') else None
+    if not isinstance(who, int):
+        try:
+            who = get_peer_id(who)
+        except TypeError:
+            return None
+    return str(who)
+
+
 def action_to_name(action):
     """
     Returns a namespace'd "friendly" name for the given